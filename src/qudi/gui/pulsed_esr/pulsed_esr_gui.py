@@ -81,7 +81,6 @@ class PulsedESRGui(GuiBase):
         )
         self._pulsed_esr_logic().add_iteration_txt.connect(self.add_iteration_text)
         # from gui slots to logic
-        self.frame_to_logic_signal.connect(self._pulsed_esr_logic().prepare_frame)
         self.simulation_to_logic.connect(self._pulsed_esr_logic().Run_Simulation)
 
         ####### RUn Experiment #######
@@ -91,6 +90,10 @@ class PulsedESRGui(GuiBase):
         # from gui slots to logic
         self.run_exp_to_logic_signal.connect(self._pulsed_esr_logic().Run_experiment)
         self.stop_exp_to_logic_signal.connect(self._pulsed_esr_logic().Stop_Experiment)
+        # from logic to gui window, emitted in the thread of the NI driver
+        self._pulsed_esr_logic().apd_counts_signal.connect(
+            self._mw.update_apd_counts, Qt.QueuedConnection
+        )
 
         ###### Clear Gui #######
         # from gui window to gui slots
@@ -190,7 +193,6 @@ class PulsedESRGui(GuiBase):
 
     def prepare_frame(self):
         Frame_i = self._mw.iteration_frame_spinbox.value()
-        self._mw.sequence_diagram_plot.clear()
         self._mw.sequence_diagram_plot.enableAutoRange(
             axis=pg.ViewBox.XAxis, enable=False
         )
@@ -212,7 +214,6 @@ class PulsedESRGui(GuiBase):
         # Disable the button after click
 
     def prepare_next_frame_simulation(self, Frame_i):
-        self._mw.sequence_diagram_plot.clear()
         self._mw.sequence_diagram_plot.enableAutoRange(
             axis=pg.ViewBox.XAxis, enable=False
         )
@@ -228,6 +229,8 @@ class PulsedESRGui(GuiBase):
     def clear_gui(self):
 
         self._mw.channel_list_listwidget.clear()
+        self._mw.frame.clear()
+        self._mw.apd_counts_dataline.setData([], [])
         self._mw.sequence_diagram_plot.clear()
         self._mw.loop_duration_label.setText("Duration: ( )")
         self._mw.current_iteration_label.setText("current iteration: ( )")
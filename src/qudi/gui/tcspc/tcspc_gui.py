@@ -69,7 +69,7 @@ class TCSPCGui(GuiBase):
             self._tcspc_logic().pause_measurement, Qt.QueuedConnection
         )
         self._mw.start_button.clicked.connect(
-            self._tcspc_logic().start_fifo_measurement, Qt.QueuedConnection
+            self._tcspc_logic().start_measurement, Qt.QueuedConnection
         )
 
         self._mw.save_button.clicked.connect(
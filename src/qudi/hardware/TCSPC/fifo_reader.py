@@ -0,0 +1,387 @@
+"""
+Continuous draining of the SPC FIFO in a background thread.
+
+Contains:
+
+- RecordRingBuffer: single producer / single consumer ring buffer of FIFO
+  records that is written by the reader thread and read by the logic
+  without taking any lock.
+- FifoReaderThread: thread that keeps calling a FIFO read function and
+  pushes the records into a `RecordRingBuffer`.
+- SimulatedFifo: stand-in for `spcm.read_fifo_to_array` that produces
+  synthetic records at a fixed rate, so sustained throughput can be
+  measured without the hardware.
+"""
+import threading
+import time
+
+import numpy as np
+
+from qudi.hardware.tcspc.spc_fifo import as_records, simulate_fifo_records
+
+
+class RecordRingBuffer:
+    """
+    Lock-free single producer / single consumer ring buffer of uint32 FIFO
+    records.
+
+    The producer only ever advances `_write` and the consumer only ever
+    advances `_read`. Both counters grow monotonically, the position in the
+    storage array is the counter modulo the capacity. A counter is only
+    advanced after the records have been copied, so the other side never
+    sees a partially written or partially read region.
+
+    Records that do not fit into the buffer are dropped and counted in
+    `lost_records`.
+
+    Attributes
+    ----------
+    capacity : int
+        Number of records that fit into the buffer
+    lost_records : int
+        Number of records dropped because the buffer was full
+    """
+
+    def __init__(self, capacity: int = 2 ** 24) -> None:
+
+        self.capacity = int(capacity)
+        self._storage = np.zeros(self.capacity, dtype=np.uint32)
+        self._out = np.zeros(self.capacity, dtype=np.uint32)
+        self._write = 0
+        self._read = 0
+        self.lost_records = 0
+
+    def __len__(self) -> int:
+        return self._write - self._read
+
+    def clear(self) -> None:
+        """
+        Discards all stored records and resets the lost record counter.
+
+        Must only be called when the producer is not running.
+        """
+        self._read = self._write
+        self.lost_records = 0
+
+    def write(self, records: np.ndarray) -> int:
+        """
+        Appends records to the buffer. Called by the producer only.
+
+        Parameters
+        ----------
+        records : np.ndarray
+            uint32 records to append
+
+        Returns
+        -------
+        int
+            Number of records actually stored
+        """
+        free = self.capacity - (self._write - self._read)
+        n = records.size
+        if n > free:
+            self.lost_records += n - free
+            n = free
+        if n == 0:
+            return 0
+        start = self._write % self.capacity
+        first = min(n, self.capacity - start)
+        self._storage[start:start + first] = records[:first]
+        self._storage[:n - first] = records[first:n]
+        self._write += n
+        return n
+
+    def read(self, max_records: int = None) -> np.ndarray:
+        """
+        Takes the stored records out of the buffer. Called by the consumer
+        only.
+
+        Parameters
+        ----------
+        max_records : int, optional
+            Maximum number of records to take. Default takes all records.
+
+        Returns
+        -------
+        np.ndarray
+            The records in the order they were written. The array is a view
+            on an internal buffer that is overwritten by the next call.
+        """
+        n = self._write - self._read
+        if max_records is not None:
+            n = min(n, max_records)
+        start = self._read % self.capacity
+        first = min(n, self.capacity - start)
+        self._out[:first] = self._storage[start:start + first]
+        self._out[first:n] = self._storage[:n - first]
+        self._read += n
+        return self._out[:n]
+
+
+class FifoReaderThread(threading.Thread):
+    """
+    Continuously reads the FIFO of one module into a `RecordRingBuffer`.
+
+    Parameters
+    ----------
+    ring_buffer : RecordRingBuffer
+        Buffer the records are written to
+    read_function : callable
+        Called as `read_function(module_no, buf_size)` and returns the
+        FIFO contents, like `spcm.read_fifo_to_array`
+    overflow_function : callable, optional
+        Called as `overflow_function(module_no)`, returns True if the
+        hardware FIFO has overflowed
+    module_no : int
+        Module to read from
+    buf_size : int
+        Maximum number of 16 bit words per read
+    idle_sleep : float
+        Seconds to sleep after a read that returned no records
+    state_interval : float
+        Seconds between two checks of the FIFO overflow state
+
+    Attributes
+    ----------
+    records_read : int
+        Total number of records read from the FIFO
+    reads : int
+        Number of calls to `read_function` that returned records
+    fifo_overflows : int
+        Number of times the hardware FIFO was found to have overflowed
+    """
+
+    def __init__(self, ring_buffer: RecordRingBuffer, read_function,
+                 overflow_function=None, module_no: int = 0,
+                 buf_size: int = 32768, idle_sleep: float = 1e-3,
+                 state_interval: float = 0.1) -> None:
+
+        super().__init__(name=f'SPC FIFO reader {module_no}', daemon=True)
+        self.ring_buffer = ring_buffer
+        self.read_function = read_function
+        self.overflow_function = overflow_function
+        self.module_no = module_no
+        self.buf_size = buf_size
+        self.idle_sleep = idle_sleep
+        self.state_interval = state_interval
+
+        self.records_read = 0
+        self.reads = 0
+        self.fifo_overflows = 0
+        self.error = None
+        self.start_time = None
+        self.stop_time = None
+        self._overflowed = False
+        self._stop_event = threading.Event()
+
+    def _read_once(self) -> int:
+
+        records = as_records(self.read_function(self.module_no, self.buf_size))
+        if records.size:
+            self.ring_buffer.write(records)
+            self.records_read += records.size
+            self.reads += 1
+        return records.size
+
+    def _check_overflow(self) -> None:
+
+        overflowed = bool(self.overflow_function(self.module_no))
+        if overflowed and not self._overflowed:
+            self.fifo_overflows += 1
+        self._overflowed = overflowed
+
+    def run(self) -> None:
+
+        self.start_time = time.perf_counter()
+        last_state_check = self.start_time
+        try:
+            while not self._stop_event.is_set():
+                n = self._read_once()
+                now = time.perf_counter()
+                if self.overflow_function is not None and \
+                        now - last_state_check >= self.state_interval:
+                    self._check_overflow()
+                    last_state_check = now
+                if n == 0:
+                    self._stop_event.wait(self.idle_sleep)
+            # Drain what is left once the measurement has been stopped
+            while self._read_once() > 0:
+                pass
+        except Exception as e:
+            self.error = e
+        self.stop_time = time.perf_counter()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """
+        Stops the thread after draining the FIFO and waits for it to end.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    @property
+    def throughput(self) -> float:
+        """
+        Average number of records read per second.
+        """
+        if self.start_time is None:
+            return 0.0
+        end = self.stop_time if self.stop_time is not None else time.perf_counter()
+        elapsed = end - self.start_time
+        return self.records_read / elapsed if elapsed > 0 else 0.0
+
+    def get_stats(self) -> dict:
+        """
+        Returns the reader counters as a dict.
+        """
+        return {
+            'records_read': self.records_read,
+            'reads': self.reads,
+            'lost_records': self.ring_buffer.lost_records,
+            'fifo_overflows': self.fifo_overflows,
+            'buffered_records': len(self.ring_buffer),
+            'throughput': self.throughput,
+        }
+
+
+class SimulatedFifo:
+    """
+    Produces synthetic FIFO records at a fixed rate.
+
+    The records accumulate in a simulated hardware FIFO of `fifo_size`
+    records from the moment `start` is called. When the FIFO is not read
+    fast enough the excess records are lost and the overflow flag is set,
+    like `SPC_FOVFL` on the real module.
+
+    Parameters
+    ----------
+    count_rate : float
+        Records per second written into the FIFO
+    fifo_size : int
+        Capacity of the simulated hardware FIFO in records
+    pool_size : int
+        Number of distinct synthetic records that are cycled through
+    seed : int, optional
+        Seed used to generate the records
+    """
+
+    def __init__(self, count_rate: float = 1e6, fifo_size: int = 2 ** 21,
+                 pool_size: int = 2 ** 20, seed: int = None) -> None:
+
+        self.count_rate = count_rate
+        self.fifo_size = fifo_size
+        self._pool = simulate_fifo_records(pool_size, seed=seed)
+        self._pool_pos = 0
+        self._pending = 0.0
+        self._last_time = None
+        self.overflowed = False
+        self.generated_records = 0
+        self.lost_records = 0
+
+    def start(self) -> None:
+
+        self._pending = 0.0
+        self._last_time = time.perf_counter()
+        self.overflowed = False
+
+    def stop(self) -> None:
+
+        self._update()
+        self._last_time = None
+
+    def _update(self) -> None:
+
+        if self._last_time is None:
+            return
+        now = time.perf_counter()
+        new = (now - self._last_time) * self.count_rate
+        self._last_time = now
+        self.generated_records += int(new)
+        self._pending += new
+        if self._pending > self.fifo_size:
+            self.lost_records += int(self._pending - self.fifo_size)
+            self._pending = float(self.fifo_size)
+            self.overflowed = True
+
+    def read_fifo_to_array(self, module_no: int, buf_size: int) -> np.ndarray:
+        """
+        Reads up to `buf_size` 16 bit words, like `spcm.read_fifo_to_array`.
+        """
+        self._update()
+        n = min(int(self._pending), buf_size // 2)
+        self._pending -= n
+        pool_size = self._pool.size
+        indices = np.arange(self._pool_pos, self._pool_pos + n) % pool_size
+        self._pool_pos = (self._pool_pos + n) % pool_size
+        return self._pool[indices].view(np.uint16)
+
+    def fifo_overflowed(self, module_no: int) -> bool:
+
+        return self.overflowed
+
+
+if __name__ == '__main__':
+
+    from qudi.hardware.tcspc.spc_fifo import SPCFifoDecoder
+
+    duration = 3.0
+    tick = 0.5
+    for count_rate in (1e6, 1e7, 4e7):
+        fifo = SimulatedFifo(count_rate=count_rate, seed=0)
+        ring_buffer = RecordRingBuffer()
+        reader = FifoReaderThread(
+            ring_buffer, fifo.read_fifo_to_array, fifo.fifo_overflowed,
+            buf_size=2 ** 20
+        )
+        decoder = SPCFifoDecoder()
+        fifo.start()
+        reader.start()
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            time.sleep(tick)
+            decoder.accumulate(ring_buffer.read())
+        fifo.stop()
+        reader.stop()
+        decoder.accumulate(ring_buffer.read())
+        stats = reader.get_stats()
+        print(
+            f'Rate {count_rate:.0e} records/s: read {stats["records_read"]} '
+            f'({stats["throughput"]:.3e} records/s), decoded {decoder.records}, '
+            f'lost in ring buffer {stats["lost_records"]}, '
+            f'FIFO overflows {stats["fifo_overflows"]} '
+            f'({fifo.lost_records} records lost in FIFO)'
+        )
+
+    # One reader thread and ring buffer per module, like TCSPCHardware with
+    # several modules
+    count_rate = 5e6
+    for n_modules in (1, 2, 4):
+        fifos = [SimulatedFifo(count_rate=count_rate, seed=i) for i in range(n_modules)]
+        ring_buffers = [RecordRingBuffer() for _ in range(n_modules)]
+        readers = [
+            FifoReaderThread(ring_buffer, fifo.read_fifo_to_array, fifo.fifo_overflowed,
+                             module_no=i, buf_size=2 ** 20)
+            for i, (fifo, ring_buffer) in enumerate(zip(fifos, ring_buffers))
+        ]
+        decoders = [SPCFifoDecoder() for _ in range(n_modules)]
+        for fifo, reader in zip(fifos, readers):
+            fifo.start()
+            reader.start()
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            time.sleep(tick)
+            for decoder, ring_buffer in zip(decoders, ring_buffers):
+                decoder.accumulate(ring_buffer.read())
+        for fifo, reader in zip(fifos, readers):
+            fifo.stop()
+            reader.stop()
+        for decoder, ring_buffer in zip(decoders, ring_buffers):
+            decoder.accumulate(ring_buffer.read())
+        throughput = sum(reader.throughput for reader in readers)
+        lost = sum(ring_buffer.lost_records for ring_buffer in ring_buffers) + \
+            sum(fifo.lost_records for fifo in fifos)
+        print(
+            f'{n_modules} modules at {count_rate:.0e} records/s each: '
+            f'{throughput:.3e} records/s in total, decoded '
+            f'{sum(decoder.records for decoder in decoders)}, lost {lost}'
+        )
@@ -7,6 +7,7 @@ from qudi.hardware.tcspc.spc_def import *
 import struct
 import time
 from qudi.hardware.tcspc.tcspc import SPCDllWrapper
+from qudi.hardware.tcspc.spc_stream import phot_info_to_array
 import os
 import matplotlib.pyplot as plt
 import copy
@@ -55,7 +56,7 @@ def empty_memory_bank(tcspc, module_no, block, page, fill_value):
     while continue_fill:
         status_code = test_state(tcspc, module_no)
 
-        if 'SPC_HFILL_NRDY' in status_code:
+        if SPCState.HFILL_NRDY in status_code:
             print('Memory bank not filled')
             time.sleep(1)
         else:
@@ -161,10 +162,12 @@ def save_photons_in_file(filepath, words_in_buf, data_buffer):
     return 0
 
 def create_histogram(data, t_values):
-    crhistogram = []
-    for t in t_values:
-        count = sum(1 for d in data if d == t)
-        crhistogram.append(count)
+    # Counts of the integer values in t_values with one bincount instead of
+    # one pass over the data per value
+    data = np.asarray(data, dtype=np.intp)
+    t_values = np.asarray(t_values)
+    counts = np.bincount(data[data >= 0], minlength=int(t_values.max()) + 1)
+    crhistogram = counts[t_values]
     return crhistogram, t_values
 
 
@@ -216,9 +219,9 @@ if __name__ == '__main__':
         phot_cnt = photon_left
         phot_ptr = pointer(phot_buffer[phot_in_buf])
 
-        if 'SPC_ARMED' in status_code:
+        if SPCState.ARMED in status_code:
             
-            if 'SPC_FEMPTY' in status_code:
+            if SPCState.FEMPTY in status_code:
                 print('FIFO empty')
                 continue
 
@@ -246,11 +249,11 @@ if __name__ == '__main__':
 
             total_photons_read += current_cnt.value / words_per_photon
 
-        if 'SPC_FOVFL' in status_code:
+        if SPCState.FOVFL in status_code:
             print('FIFO overrun')
             continue_acquisition = False
 
-        if 'SPC_TIME_OVER' in status_code:
+        if SPCState.TIME_OVER in status_code:
             print('Time over')
             continue_acquisition = False
             current_cnt = photon_left * words_per_photon
@@ -289,39 +292,21 @@ if __name__ == '__main__':
     print(f'Photon buffer {phot_buffer[10]}')
 
     total_phot = phot_cnt.value
-    micro_times = []
-    converted_times = []
-    macro_times = []
-    flags = []
-    for i in range(int(total_photons_read)):
-        macro_time = phot_buffer[i].mtime
-        #macro_times.append(macro_time)
-        micro_time = phot_buffer[i].micro_time #& 0xFFF
-        adc_value = 4095 - micro_time & 0xFFF
-        flag = phot_buffer[i].flags
-        rout_chan = phot_buffer[i].rout_chan
-        flagstr = format(flag, '016b')
-        flagstr = ' '.join(flagstr[i:i + 4] for i in range(0, len(flagstr), 4))
-        #if flag != 0:
-            #print(flag)
-            #print(f'Photon {i}: Micro time {phot_ptr[i].micro_time} Flags {flagstr} Routing channel {phot_ptr[i].rout_chan}')
-        #    if flag & NOT_PHOTON:
-        #        print('Not a photon')
-        if not (flag & NOT_PHOTON):
-            if (micro_time != 0):
-                #if rout_chan != 0:
-                micro_times.append(micro_time)
-                converted_times.append(adc_value)
-                flags.append(flag)
-                macro_times.append(macro_time)
+    # Zero copy structured view of the PhotInfo64 buffer, the photons are
+    # filtered with one mask instead of a loop over the structures
+    photons = phot_info_to_array(phot_buffer, int(total_photons_read))
+    valid = photons[((photons['flags'] & NOT_PHOTON) == 0) & (photons['micro_time'] != 0)]
+    micro_times = valid['micro_time']
+    converted_times = (4095 - micro_times) & 0xFFF
+    flags = valid['flags']
+    macro_times = valid['mtime']
     print(f'Micro time: {rphot_ptr.contents.micro_time}')
     photon_left -= phot_cnt.value
     phot_in_buf += phot_cnt.value
     recovered_photons -= phot_cnt.value
 
     print(len(micro_times))
-    micro_times = np.array(micro_times)
-    macro_times = np.array(macro_times) #* 2e-7
+    macro_times = macro_times #* 2e-7
     #print(macro_times)
     #print(micro_times)
     #micro_times = micro_times[micro_times < 5000]
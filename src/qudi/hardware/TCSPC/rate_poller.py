@@ -0,0 +1,260 @@
+"""
+Polling of the SPC rate counters in a background thread.
+
+`spcm.read_rates` fails while the rate counters are not ready yet, so it
+is retried a limited number of times with an increasing delay. The
+polling runs in its own thread and does not take the lock used for the
+FIFO reads, so a slow or failing rate read never delays the FIFO.
+
+Contains:
+
+- RATE_FIELDS: names of the rate counters
+- RateHistory: ring buffer of timestamped rate values
+- RatePollerThread: thread that reads the rates at a fixed interval
+"""
+import threading
+import time
+
+import numpy as np
+
+
+RATE_FIELDS = ('sync_rate', 'cfd_rate', 'tac_rate', 'adc_rate')
+
+
+class RateHistory:
+    """
+    Ring buffer of the last `capacity` rate readings.
+
+    The rows are only copied while holding the lock of the history, which
+    is not shared with anything else.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of readings kept
+    """
+
+    def __init__(self, capacity: int = 600) -> None:
+
+        self.capacity = int(capacity)
+        self._times = np.zeros(self.capacity)
+        self._rates = np.zeros((self.capacity, len(RATE_FIELDS)))
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return min(self._count, self.capacity)
+
+    def clear(self) -> None:
+
+        with self._lock:
+            self._count = 0
+
+    def append(self, timestamp: float, rates) -> None:
+        """
+        Adds a reading.
+
+        Parameters
+        ----------
+        timestamp : float
+            Time of the reading in seconds
+        rates : sequence
+            Sync, CFD, TAC and ADC rate in counts/s
+        """
+        with self._lock:
+            position = self._count % self.capacity
+            self._times[position] = timestamp
+            self._rates[position] = rates
+            self._count += 1
+
+    def latest(self) -> tuple:
+        """
+        Returns the newest reading as (timestamp, rates), or None if
+        there is none.
+        """
+        with self._lock:
+            if self._count == 0:
+                return None
+            position = (self._count - 1) % self.capacity
+            return self._times[position], tuple(self._rates[position])
+
+    def get_history(self) -> tuple:
+        """
+        Returns the readings from the oldest to the newest.
+
+        Returns
+        -------
+        tuple
+            (times, rates) with the timestamps of shape (n,) and the rates
+            of shape (n, 4) in the order of `RATE_FIELDS`
+        """
+        with self._lock:
+            n = min(self._count, self.capacity)
+            order = np.arange(self._count - n, self._count) % self.capacity
+            return self._times[order], self._rates[order]
+
+
+class RatePollerThread(threading.Thread):
+    """
+    Reads the rate counters of one module at a fixed interval into a
+    `RateHistory`.
+
+    A failed read is retried up to `max_retries` times, waiting
+    `backoff`, 2 * `backoff`, 4 * `backoff`, ... seconds, at most
+    `max_backoff`, in between. If all retries fail the reading is skipped
+    and the poller waits for the next interval.
+
+    Parameters
+    ----------
+    history : RateHistory
+        History the readings are appended to
+    read_function : callable
+        Called as `read_function(module_no)` and returns an object with
+        the attributes in `RATE_FIELDS`, like `spcm.read_rates`
+    module_no : int
+        Module to read from
+    interval : float
+        Seconds between two readings
+    max_retries : int
+        Number of retries after a failed read
+    backoff : float
+        Seconds to wait before the first retry
+    max_backoff : float
+        Longest wait between two retries
+
+    Attributes
+    ----------
+    polls : int
+        Number of successful readings
+    retries : int
+        Number of failed reads that were retried
+    failed_polls : int
+        Number of readings skipped because all retries failed
+    last_error : Exception
+        Error of the last failed read
+    """
+
+    def __init__(self, history: RateHistory, read_function, module_no: int = 0,
+                 interval: float = 1.0, max_retries: int = 5,
+                 backoff: float = 0.01, max_backoff: float = 0.2) -> None:
+
+        super().__init__(name=f'SPC rate poller {module_no}', daemon=True)
+        self.history = history
+        self.read_function = read_function
+        self.module_no = module_no
+        self.interval = interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.polls = 0
+        self.retries = 0
+        self.failed_polls = 0
+        self.last_error = None
+        self._stop_event = threading.Event()
+
+    def _read_rates(self):
+        """
+        Reads the rates, retrying failed reads. Returns None if all
+        retries failed or the poller was stopped.
+        """
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.read_function(self.module_no)
+            except Exception as e:
+                self.last_error = e
+            if attempt == self.max_retries or self._stop_event.wait(delay):
+                break
+            self.retries += 1
+            delay = min(2 * delay, self.max_backoff)
+        return None
+
+    def poll(self) -> bool:
+        """
+        Takes one reading. Returns True if it was added to the history.
+        """
+        rates = self._read_rates()
+        if rates is None:
+            self.failed_polls += 1
+            return False
+        self.history.append(
+            time.time(), [getattr(rates, field) for field in RATE_FIELDS]
+        )
+        self.polls += 1
+        return True
+
+    def run(self) -> None:
+
+        next_poll = time.monotonic()
+        while not self._stop_event.is_set():
+            self.poll()
+            next_poll += self.interval
+            # Skip the readings that were missed while retrying
+            now = time.monotonic()
+            if next_poll < now:
+                next_poll = now + self.interval
+            self._stop_event.wait(next_poll - now)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """
+        Stops the thread and waits for it to end.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the poller counters as a dict.
+        """
+        return {
+            'polls': self.polls,
+            'retries': self.retries,
+            'failed_polls': self.failed_polls,
+            'last_error': repr(self.last_error) if self.last_error is not None else None,
+        }
+
+
+if __name__ == '__main__':
+
+    import collections
+    from qudi.hardware.tcspc.fifo_reader import (
+        RecordRingBuffer, FifoReaderThread, SimulatedFifo
+    )
+
+    Rates = collections.namedtuple('Rates', RATE_FIELDS)
+    rng = np.random.default_rng(0)
+
+    def flaky_read_rates(module_no):
+        # Counters not ready in 40 % of the reads, every read takes 5 ms
+        time.sleep(5e-3)
+        if rng.random() < 0.4:
+            raise RuntimeError('rate counters not ready')
+        return Rates(*rng.normal(1e6, 1e4, len(RATE_FIELDS)))
+
+    fifo = SimulatedFifo(count_rate=1e7, seed=0)
+    ring_buffer = RecordRingBuffer()
+    reader = FifoReaderThread(ring_buffer, fifo.read_fifo_to_array, buf_size=2 ** 20)
+    history = RateHistory(capacity=100)
+    poller = RatePollerThread(history, flaky_read_rates, interval=0.02, max_retries=2)
+
+    duration = 3.0
+    fifo.start()
+    reader.start()
+    poller.start()
+    records = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        time.sleep(0.1)
+        records += ring_buffer.read().size
+    poller.stop()
+    fifo.stop()
+    reader.stop()
+    stats = reader.get_stats()
+    print(f'Rate poller: {poller.get_stats()}')
+    print(f'FIFO reader: {stats["throughput"]:.3e} records/s, '
+          f'{records} records taken, {stats["lost_records"]} records lost')
+    times, rates = history.get_history()
+    print(f'History of {len(history)} readings over {times[-1] - times[0]:.2f} s, '
+          f'mean CFD rate {rates[:, 1].mean():.3e} counts/s')
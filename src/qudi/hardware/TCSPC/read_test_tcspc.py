@@ -6,7 +6,7 @@ from ctypes import (
 from qudi.hardware.tcspc.spc_def import (
     SPCdata, SPCModInfo, SPC_EEP_Data, SPC_Adjust_Para,
     SPCMemConfig, PhotStreamInfo, PhotInfo, PhotInfo64,
-    rate_values
+    rate_values, SPCState
 )
 import time
 from qudi.hardware.tcspc.tcspc import SPCDllWrapper
@@ -78,7 +78,7 @@ class TCSPCReader:
         while continue_fill:
             status_code = self.test_state(module_no)
 
-            if 'SPC_HFILL_NRDY' in status_code:
+            if SPCState.HFILL_NRDY in status_code:
                 print('Memory bank not filled')
                 time.sleep(1)
             else:
@@ -134,7 +134,7 @@ class TCSPCReader:
             print(f'Read data frame status: {status} with mod_no: {mod_no}, frame: {frame}, page: {page} and data: {data}')
             print(f'Data list: {list(data)}')
 
-            if 'SPC_TIME_OVER' in state:
+            if SPCState.TIME_OVER in state:
                 self.continue_acquisition = False
                 print('Acquisition finished')
                 break
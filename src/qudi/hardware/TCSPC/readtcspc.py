@@ -34,7 +34,7 @@ def empty_memory_bank(tcspc, module_no):
     #while continue_fill:
     #    status_code = test_state(tcspc, module_no)
 
-        #if 'SPC_HFILL_NRDY' in status_code:
+        #if SPCState.HFILL_NRDY in status_code:
         #    print('Memory bank not filled')
         #    time.sleep(1)
         #else:
@@ -133,7 +133,7 @@ while continue_acquisition:
     #print(f'Read data frame status: {status} with mod_no: {mod_no}, frame: {frame}, page: {page} and data: {data}')
     #print(f'Data list: {list(data_buffer)}')
 
-    #if 'SPC_TIME_OVER' in status_code:
+    #if SPCState.TIME_OVER in status_code:
     #    continue_acquisition = False
     #    print('Acquisition finished')
 
@@ -6,7 +6,7 @@ from ctypes import (
 from qudi.hardware.TCSPC.spc_def import (
     SPCdata, SPCModInfo, SPC_EEP_Data, SPC_Adjust_Para,
     SPCMemConfig, PhotStreamInfo, PhotInfo, PhotInfo64,
-    rate_values
+    rate_values, SPCState
 )
 import time
 from qudi.hardware.TCSPC.tcspc import SPCDllWrapper
@@ -32,7 +32,7 @@ def empty_memory_bank(tcspc, module_no, mem_info):
     while continue_fill:
         status_code = test_state(tcspc, module_no)
 
-        if 'SPC_HFILL_NRDY' in status_code:
+        if SPCState.HFILL_NRDY in status_code:
             print('Memory bank not filled')
             time.sleep(1)
         else:
@@ -115,7 +115,7 @@ def read_tcspc_sequencer():
 
             status_code = test_state(tcspc, module_no, True)
 
-            if 'SPC_ARMED' not in status_code:
+            if SPCState.ARMED not in status_code:
                 continue_acquisition = False
                 print('Block ready to be read')
 
@@ -138,7 +138,7 @@ def read_tcspc_sequencer():
     status_code = tcspc.translate_status(state)
     print(f'Status code: {status_code}')
 
-    if 'SPC_ARMED' not in status_code:
+    if SPCState.ARMED not in status_code:
         status, mod_no, block, page, reduction_factor, var_from, var_to, data = tcspc.SPC_read_data_block(module_no, 0, page_no, red_factor, 0, no_of_points - 1, data_buffer)
         print(f'Read data block status: {status} with mod_no: {mod_no}, block: {block}, page: {page}, reduction_factor: {reduction_factor}, var_from: {var_from}, var_to: {var_to} and data: {data}')
         print(f'Data list: {list(data_buffer)}')
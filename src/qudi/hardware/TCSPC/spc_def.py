@@ -3,6 +3,7 @@ from ctypes import (
     c_int, c_uint, c_uint64, c_double, Structure,
     c_long
 )
+import enum
 
 class SPCdata(Structure):
     _fields_ = [
@@ -179,6 +180,9 @@ class PhotInfo64(Structure):
         ('flags', c_ushort),
     ]
 
+# flags of PhotInfo / PhotInfo64
+NOT_PHOTON = 0x1  # entry is not a valid photon
+
 # masks for SPC module state - function SPC_test_state
 SPC_OVERFL = 0x1  # stopped on overflow
 SPC_OVERFLOW = 0x2  # overflow occurred
@@ -209,6 +213,32 @@ SPC_HFILL_NRDY = 0x8000  # hardware fill not finished
 SPC_SEQ_STOP = 0x4000  # disarmed (measurement stopped) by sequencer
 SPC_SEQ_GAP150 = 0x2000  # SPC15x, SPC16x,18x, SPC131-7 - Sequencer is waiting for other bank to be armed
 
+
+class SPCState(enum.IntFlag):
+    """
+    Bits of the module state returned by SPC_test_state for the SPC-130.
+
+    Checks like `SPCState.ARMED in state` or `state & SPCState.FEMPTY`
+    are single bitwise operations on the state value.
+    """
+    OVERFL = SPC_OVERFL
+    OVERFLOW = SPC_OVERFLOW
+    TIME_OVER = SPC_TIME_OVER
+    COLTIM_OVER = SPC_COLTIM_OVER
+    CMD_STOP = SPC_CMD_STOP
+    REPTIM_OVER = SPC_REPTIM_OVER
+    SEQ_GAP = SPC_SEQ_GAP
+    ARMED = SPC_ARMED
+    COLTIM_2OVER = SPC_COLTIM_2OVER
+    REPTIM_2OVER = SPC_REPTIM_2OVER
+    FOVFL = SPC_FOVFL
+    FEMPTY = SPC_FEMPTY
+    WAIT_TRG = SPC_WAIT_TRG
+    SEQ_GAP150 = SPC_SEQ_GAP150
+    SEQ_STOP = SPC_SEQ_STOP
+    HFILL_NRDY = SPC_HFILL_NRDY
+
+
 # normal and Scan In modes when sequencer is enabled
 # mask for SPC140, SPC830, SPC15x, SPC16x,18x, DPC230 modules ( in FIFO IMAGE mode )
 SPC_WAIT_FR = 0x2000  # FIFO IMAGE measurement waits for the frame signal to stop
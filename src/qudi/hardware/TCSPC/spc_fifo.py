@@ -0,0 +1,544 @@
+"""
+Decoding of the 32 bit FIFO records produced by the SPC-130 in FIFO mode.
+
+Every record read from the FIFO is a 32 bit word with the layout
+
+    bit 31      INVALID
+    bit 30      MTOV (macro time overflow)
+    bit 29      GAP
+    bit 28      MARK
+    bits 27-16  ADC value (micro time, measured from photon to SYNC)
+    bits 15-12  ROUT (routing channel)
+    bits 11-0   MT (macro time)
+
+The functions and classes in here operate directly on the uint32 view of
+the buffer returned by `spcm.read_fifo_to_array` and never loop over the
+records in Python.
+"""
+import time
+
+import numpy as np
+
+
+INVALID = 1 << 31
+MTOV = 1 << 30
+GAP = 1 << 29
+MARK = 1 << 28
+
+# Records with any of these flags set are not photons
+PHOTON_FLAG_MASK = INVALID | MARK
+
+ADC_SHIFT = 16
+ADC_BITS = 12
+ADC_MASK = (1 << ADC_BITS) - 1  # 4095
+
+ROUT_SHIFT = 12
+ROUT_MASK = 0xF
+
+MT_MASK = 0xFFF
+MT_BITS = 12
+
+# Number of overflows stored in a multiple macro time overflow record
+OVERFLOW_COUNT_MASK = (1 << 28) - 1
+
+PHOTON_DTYPE = np.dtype([
+    ('macrotime', np.uint64),
+    ('microtime', np.uint16),
+    ('channel', np.uint8),
+])
+
+
+def as_records(data) -> np.ndarray:
+    """
+    Returns the uint32 record view of a FIFO buffer without copying it.
+
+    Parameters
+    ----------
+    data : array_like
+        Buffer as returned by `spcm.read_fifo_to_array`, either 16 bit
+        words or 32 bit records.
+
+    Returns
+    -------
+    np.ndarray
+        One dimensional uint32 array with one element per FIFO record
+    """
+    return np.ascontiguousarray(data).reshape(-1).view(np.uint32)
+
+
+class SPCFifoDecoder:
+    """
+    Accumulates the micro times of FIFO photon records into a histogram.
+
+    The histogram and all scratch buffers are allocated once and reused for
+    every batch, so decoding a batch does not allocate arrays proportional
+    to the number of records after the first call with that batch size.
+
+    Non-photon records (invalid, marker and overflow records) are not
+    removed from the batch. Instead their bin index is redirected to an
+    extra sentinel bin that is discarded, which avoids compacting the
+    batch with a boolean index.
+
+    Attributes
+    ----------
+    n_bins : int
+        Number of bins of the histogram
+    reverse : bool
+        If True the micro times are reversed, because the raw ADC value
+        is measured from the photon to the SYNC and not from SYNC to
+        photon.
+    histogram : np.ndarray
+        Accumulated histogram, updated in place
+    photons : int
+        Total number of photon records accumulated
+    records : int
+        Total number of records processed
+    last_counts : np.ndarray
+        Counts per bin of the last batch, including the sentinel bin at
+        index `n_bins`
+    """
+
+    def __init__(self, n_bins: int = ADC_MASK + 1, reverse: bool = True) -> None:
+
+        self.n_bins = n_bins
+        self.reverse = reverse
+        self.histogram = np.zeros(n_bins, dtype=np.int64)
+        self.photons = 0
+        self.records = 0
+        self.last_counts = np.zeros(n_bins + 1, dtype=np.int64)
+        self._bins = np.empty(0, dtype=np.intp)
+        self._flags = np.empty(0, dtype=np.uint32)
+        self._not_photon = np.empty(0, dtype=bool)
+
+    def clear(self) -> None:
+        """
+        Sets the histogram and the counters back to zero.
+        """
+        self.histogram.fill(0)
+        self.last_counts.fill(0)
+        self.photons = 0
+        self.records = 0
+
+    def _scratch(self, size: int) -> tuple:
+
+        if self._bins.size < size:
+            self._bins = np.empty(size, dtype=np.intp)
+            self._flags = np.empty(size, dtype=np.uint32)
+            self._not_photon = np.empty(size, dtype=bool)
+        return self._bins[:size], self._flags[:size], self._not_photon[:size]
+
+    def bin_indices(self, records: np.ndarray) -> np.ndarray:
+        """
+        Computes the histogram bin of every record of a batch.
+
+        Parameters
+        ----------
+        records : np.ndarray
+            uint32 FIFO records
+
+        Returns
+        -------
+        np.ndarray
+            Bin index of each record. Non-photon records are assigned to
+            the sentinel bin `n_bins`. The array is a scratch buffer that
+            is overwritten by the next call.
+        """
+        bins, flags, not_photon = self._scratch(records.size)
+        np.bitwise_and(records, PHOTON_FLAG_MASK, out=flags)
+        np.not_equal(flags, 0, out=not_photon)
+        np.right_shift(records, ADC_SHIFT, out=bins)
+        np.bitwise_and(bins, ADC_MASK, out=bins)
+        if self.reverse:
+            np.subtract(ADC_MASK, bins, out=bins)
+        if self.n_bins <= ADC_MASK:
+            # Micro times beyond the histogram range are dropped
+            np.minimum(bins, self.n_bins, out=bins)
+        np.copyto(bins, self.n_bins, where=not_photon)
+        return bins
+
+    def accumulate(self, data) -> int:
+        """
+        Adds the photons of a FIFO buffer to the histogram.
+
+        Parameters
+        ----------
+        data : array_like
+            Buffer as returned by `spcm.read_fifo_to_array`
+
+        Returns
+        -------
+        int
+            Number of photons added to the histogram
+        """
+        records = as_records(data)
+        if records.size == 0:
+            self.last_counts = np.zeros(self.n_bins + 1, dtype=np.int64)
+            return 0
+        bins = self.bin_indices(records)
+        counts = np.bincount(bins, minlength=self.n_bins + 1)
+        self.last_counts = counts
+        self.histogram += counts[:self.n_bins]
+        photons = records.size - int(counts[self.n_bins])
+        self.photons += photons
+        self.records += records.size
+        return photons
+
+
+class SPCFifoPhotonDecoder:
+    """
+    Decodes FIFO records into time tagged photons.
+
+    The 12 bit macro time of each record is extended to an absolute 64 bit
+    timestamp by counting the macro time overflows. A record with MTOV set
+    and INVALID cleared is a photon preceded by one overflow, a record with
+    both MTOV and INVALID set and MARK cleared carries the number of
+    overflows in bits 27-0. A marker record (INVALID and MARK set) with MTOV
+    set is preceded by one overflow, its bits 27-0 are not a count.
+    The overflow count is carried over between batches, so consecutive
+    calls to `decode` produce one continuous stream.
+
+    Attributes
+    ----------
+    overflows : int
+        Number of macro time overflows counted so far
+    reverse : bool
+        If True the micro times are reversed like in `SPCFifoDecoder`
+    last_macrotime : int
+        Macro time of the last decoded photon
+    """
+
+    def __init__(self, reverse: bool = True) -> None:
+
+        self.reverse = reverse
+        self.overflows = 0
+        self.last_macrotime = 0
+
+    def clear(self) -> None:
+
+        self.overflows = 0
+        self.last_macrotime = 0
+
+    def start_new_segment(self) -> None:
+        """
+        Continues the time axis after a restart of the measurement.
+
+        The module resets its macro time counter when a measurement is
+        started again, so the overflow count is moved past the last decoded
+        photon to keep the timestamps increasing.
+        """
+        self.overflows = (self.last_macrotime >> MT_BITS) + 1
+
+    @property
+    def time_reached(self) -> int:
+        """
+        Macro time up to which the stream is complete. Photons decoded
+        later have a macro time of at least this value.
+        """
+        return max(self.last_macrotime, self.overflows << MT_BITS)
+
+    def decode(self, data) -> np.ndarray:
+        """
+        Decodes the photon records of a FIFO buffer.
+
+        Parameters
+        ----------
+        data : array_like
+            Buffer as returned by `spcm.read_fifo_to_array`
+
+        Returns
+        -------
+        np.ndarray
+            Photons with `PHOTON_DTYPE`, in the order they were recorded
+        """
+        records = as_records(data)
+        if records.size == 0:
+            return np.zeros(0, dtype=PHOTON_DTYPE)
+
+        # Overflow records are rare, so the running overflow count is
+        # computed per overflow record and expanded to all records with
+        # np.repeat instead of a cumulative sum over the whole batch.
+        overflow_index = np.flatnonzero(records & MTOV)
+        overflow_records = records[overflow_index]
+        is_count = (overflow_records & (INVALID | MARK)) == INVALID
+        increments = np.where(
+            is_count, overflow_records & OVERFLOW_COUNT_MASK, 1
+        ).astype(np.uint64)
+        levels = np.empty(overflow_index.size + 1, dtype=np.uint64)
+        levels[0] = 0
+        np.cumsum(increments, out=levels[1:])
+        levels += np.uint64(self.overflows)
+        self.overflows = int(levels[-1])
+        lengths = np.diff(overflow_index, prepend=0, append=records.size)
+        overflow_count = np.repeat(levels, lengths)
+
+        is_photon = np.flatnonzero((records & PHOTON_FLAG_MASK) == 0)
+        photon_records = records[is_photon]
+        photons = np.empty(photon_records.size, dtype=PHOTON_DTYPE)
+        macrotime = photons['macrotime']
+        np.left_shift(overflow_count[is_photon], MT_BITS, out=macrotime)
+        macrotime |= photon_records & MT_MASK
+        microtime = (photon_records >> ADC_SHIFT) & ADC_MASK
+        if self.reverse:
+            microtime = ADC_MASK - microtime
+        photons['microtime'] = microtime
+        photons['channel'] = (photon_records >> ROUT_SHIFT) & ROUT_MASK
+        if photons.size:
+            self.last_macrotime = int(macrotime[-1])
+        return photons
+
+
+class PhotonStreamMerger:
+    """
+    Merges the photon streams of several modules into one stream ordered
+    by macro time.
+
+    The modules are read independently, so a batch of one module can end
+    earlier than the batch of another. Photons are therefore only released
+    up to the macro time all streams have reached, the rest is held back
+    until the next call. A module without photons produces no records, so
+    the time its stream has reached has to be passed with `advance`, or it
+    holds back the photons of all other modules. The routing channel of
+    stream `i` is moved to `i * channels_per_stream + channel`, so the
+    channels of all modules stay distinct.
+
+    Parameters
+    ----------
+    n_streams : int
+        Number of streams, one per module
+    channels_per_stream : int, optional
+        Number of routing channels of one module
+    """
+
+    def __init__(self, n_streams: int, channels_per_stream: int = ROUT_MASK + 1) -> None:
+
+        self.n_streams = n_streams
+        self.channels_per_stream = channels_per_stream
+        self.clear()
+
+    def clear(self) -> None:
+
+        # Batches of every stream, concatenated once in `pop`
+        self._pending = [[] for _ in range(self.n_streams)]
+        self._reached = [0] * self.n_streams
+
+    @property
+    def time_reached(self) -> int:
+        """
+        Latest macro time any stream has reached.
+        """
+        return max(self._reached)
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of photons held back.
+        """
+        return sum(batch.size for batches in self._pending for batch in batches)
+
+    def advance(self, index: int, time_reached: int) -> None:
+        """
+        Marks a stream complete up to a macro time without adding photons,
+        e.g. when the FIFO of an idle module is empty.
+
+        Parameters
+        ----------
+        index : int
+            Index of the stream
+        time_reached : int
+            Macro time up to which the stream is complete
+        """
+        self._reached[index] = max(self._reached[index], time_reached)
+
+    def push(self, index: int, photons: np.ndarray, time_reached: int) -> None:
+        """
+        Adds a batch of photons of one stream.
+
+        Parameters
+        ----------
+        index : int
+            Index of the stream
+        photons : np.ndarray
+            Photons with `PHOTON_DTYPE`, later than all previous batches
+            of this stream
+        time_reached : int
+            Macro time up to which the stream is complete, see
+            `SPCFifoPhotonDecoder.time_reached`
+        """
+        self.advance(index, time_reached)
+        if photons.size == 0:
+            return
+        if index:
+            photons = photons.copy()
+            photons['channel'] += index * self.channels_per_stream
+        self._pending[index].append(photons)
+
+    @staticmethod
+    def _join(batches: list) -> np.ndarray:
+
+        if not batches:
+            return np.zeros(0, dtype=PHOTON_DTYPE)
+        return batches[0] if len(batches) == 1 else np.concatenate(batches)
+
+    def pop(self, final: bool = False) -> np.ndarray:
+        """
+        Returns the merged photons up to the macro time all streams have
+        reached.
+
+        Parameters
+        ----------
+        final : bool, optional
+            Returns all photons held back, after the last batch
+
+        Returns
+        -------
+        np.ndarray
+            Photons with `PHOTON_DTYPE` ordered by macro time
+        """
+        if self.n_streams == 1 or final:
+            parts = [self._join(batches) for batches in self._pending]
+            self._pending = [[] for _ in range(self.n_streams)]
+        else:
+            limit = np.uint64(min(self._reached))
+            parts = []
+            for index, batches in enumerate(self._pending):
+                # Only the batches before the limit are joined, the ones
+                # after it stay in the list untouched
+                count = 0
+                while count < len(batches) and batches[count]['macrotime'][-1] < limit:
+                    count += 1
+                released = batches[:count]
+                rest = batches[count:]
+                if rest:
+                    split = np.searchsorted(rest[0]['macrotime'], limit)
+                    if split:
+                        released.append(rest[0][:split])
+                        rest[0] = rest[0][split:]
+                parts.append(self._join(released))
+                self._pending[index] = rest
+        if len(parts) == 1:
+            return parts[0]
+        merged = np.concatenate(parts)
+        # The stable sort merges the already sorted runs of the streams
+        return merged[np.argsort(merged['macrotime'], kind='stable')]
+
+
+def simulate_fifo_records(
+        n_records: int, lifetime_bins: float = 400.0, overflow_every: int = 200,
+        invalid_fraction: float = 0.01, seed: int = None) -> np.ndarray:
+    """
+    Generates synthetic SPC-130 FIFO records.
+
+    Parameters
+    ----------
+    n_records : int
+        Number of records to generate
+    lifetime_bins : float, optional
+        Decay constant of the micro time distribution in ADC bins
+    overflow_every : int, optional
+        Mean number of records between macro time overflows
+    invalid_fraction : float, optional
+        Fraction of invalid records
+    seed : int, optional
+        Seed for the random generator
+
+    Returns
+    -------
+    np.ndarray
+        uint32 array of FIFO records
+    """
+    rng = np.random.default_rng(seed)
+    micro = np.minimum(rng.exponential(lifetime_bins, n_records), ADC_MASK)
+    adc = (ADC_MASK - micro.astype(np.uint32)) << ADC_SHIFT
+    macro = np.sort(rng.integers(0, MT_MASK + 1, n_records, dtype=np.uint32))
+    rout = rng.integers(0, 2, n_records, dtype=np.uint32) << ROUT_SHIFT
+    records = adc | rout | macro
+    overflow = rng.random(n_records) < 1 / overflow_every
+    records[overflow] |= MTOV
+    # INVALID together with MTOV would be a multiple overflow record
+    records[~overflow & (rng.random(n_records) < invalid_fraction)] |= INVALID
+    return records
+
+
+def _legacy_histogram(data, time_bins):
+    """
+    Previous implementation of `TCSPCLogic.convert_data`, kept for the
+    benchmark.
+    """
+    records = np.array(data).view(np.uint32)
+    photons = np.extract(np.bitwise_and(records, 0b1001 << 28) == 0, records)
+    max_12bit = (1 << 12) - 1
+    microtimes = np.bitwise_and(np.right_shift(photons, 16), max_12bit)
+    microtimes = max_12bit - microtimes
+    histogram, bin_edges = np.histogram(microtimes, bins=time_bins)
+    return histogram
+
+
+if __name__ == '__main__':
+
+    batch_size = 2 ** 20
+    repeats = 20
+    records = simulate_fifo_records(batch_size, seed=0)
+    words = records.view(np.uint16)
+
+    time_bins = np.arange(4096)
+    legacy_histogram = np.zeros(4095, dtype=np.int64)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        legacy_histogram = legacy_histogram + _legacy_histogram(words, time_bins)
+    legacy_time = time.perf_counter() - start
+
+    decoder = SPCFifoDecoder()
+    decoder.accumulate(words)  # Allocates the scratch buffers
+    decoder.clear()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        decoder.accumulate(words)
+    decoder_time = time.perf_counter() - start
+
+    total = batch_size * repeats
+    print(f'Legacy convert_data: {total / legacy_time:.3e} records/s')
+    print(f'SPCFifoDecoder:      {total / decoder_time:.3e} records/s')
+    print(f'Speed up: {legacy_time / decoder_time:.1f}x')
+    # The legacy histogram merges the last two bins into one
+    print('Histograms match:', np.array_equal(
+        legacy_histogram[:-1], decoder.histogram[:-2]
+    ) and legacy_histogram[-1] == decoder.histogram[-2:].sum())
+
+    # A multiple overflow record counts the overflows in bits 27-0, a
+    # marker record with MTOV set only one, whatever its other bits are
+    overflow_records = np.array([
+        INVALID | MTOV | 1000,
+        INVALID | MTOV | MARK | (ADC_MASK << ADC_SHIFT) | MT_MASK,
+        5,
+    ], dtype=np.uint32)
+    photon_decoder = SPCFifoPhotonDecoder()
+    photons = photon_decoder.decode(overflow_records)
+    print('Overflow and marker records counted:',
+          photon_decoder.overflows == 1001 and int(photons['macrotime'][0]) == (1001 << MT_BITS) + 5)
+
+    # Two modules, the second one idle. Without `advance` it holds back
+    # every photon of the first module until the end, with `advance` after
+    # every batch, as when its FIFO is found empty, the photons come out
+    # batch by batch. The pending batches are only joined when released.
+    photon_decoder = SPCFifoPhotonDecoder()
+    batches = [photon_decoder.decode(part) for part in np.array_split(records, 200)]
+    total = sum(photons.size for photons in batches)
+    for advance in (False, True):
+        merger = PhotonStreamMerger(2)
+        photon_decoder.clear()
+        outputs = []
+        released_live = 0
+        start = time.perf_counter()
+        for part in np.array_split(records, 200):
+            photons = photon_decoder.decode(part)
+            merger.push(0, photons, photon_decoder.time_reached)
+            if advance:
+                merger.advance(1, photon_decoder.time_reached)
+            outputs.append(merger.pop())
+            released_live += outputs[-1].size
+        outputs.append(merger.pop(final=True))
+        elapsed = time.perf_counter() - start
+        merged = np.concatenate(outputs)
+        print(f'Idle module, advance {advance}: {released_live} of {total} photons released '
+              f'while running, 200 batches in {1e3 * elapsed:.0f} ms, all photons in order: '
+              f'{merged.size == total and bool(np.all(np.diff(merged["macrotime"].astype(np.int64)) >= 0))}')
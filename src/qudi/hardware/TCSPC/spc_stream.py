@@ -0,0 +1,287 @@
+"""
+Buffered photon streams of the SPC DLL as NumPy arrays.
+
+In the buffered stream mode the DLL reads the FIFO into its own stream
+buffers (`SPC_read_fifo_to_stream`) and extracts the photons into an array
+of `PhotInfo64` structures (`SPC_get_photons_from_stream`). The functions
+in here map that ctypes array onto a NumPy structured array without
+copying it, so flags, micro times and routing channels are filtered and
+histogrammed with vectorized operations instead of looping over the
+structures in Python.
+
+Contains:
+
+- PHOT_INFO64_DTYPE: NumPy dtype with the layout of `PhotInfo64`
+- phot_info_to_array(buffer, count)
+- photons_from_phot_info(phot_info, reverse)
+- histogram_from_phot_info(phot_info, n_bins, reverse)
+- BufferedPhotonStream: buffered stream of one module
+"""
+import ctypes
+import time
+
+import numpy as np
+
+from qudi.hardware.tcspc.spc_def import PhotInfo64, PhotStreamInfo, NOT_PHOTON
+from qudi.hardware.tcspc.spc_fifo import ADC_MASK, PHOTON_DTYPE
+
+
+# Same field offsets and padding as the ctypes structure
+PHOT_INFO64_DTYPE = np.dtype(PhotInfo64)
+
+
+def phot_info_to_array(buffer, count: int = None) -> np.ndarray:
+    """
+    Returns a structured array view on a ctypes `PhotInfo64` array.
+
+    Parameters
+    ----------
+    buffer : ctypes array of PhotInfo64
+        Buffer filled by `SPC_get_photons_from_stream`
+    count : int, optional
+        Number of valid entries. Default is the whole buffer.
+
+    Returns
+    -------
+    np.ndarray
+        Array with `PHOT_INFO64_DTYPE` sharing the memory of the buffer
+    """
+    array = np.frombuffer(buffer, dtype=PHOT_INFO64_DTYPE)
+    return array if count is None else array[:count]
+
+
+def photons_from_phot_info(phot_info: np.ndarray, reverse: bool = True) -> np.ndarray:
+    """
+    Converts `PhotInfo64` entries to photons with `PHOTON_DTYPE`.
+
+    Entries flagged with `NOT_PHOTON` are dropped.
+
+    Parameters
+    ----------
+    phot_info : np.ndarray
+        Array with `PHOT_INFO64_DTYPE`
+    reverse : bool, optional
+        If True the micro times are reversed, 4095 - micro_time, like in
+        `SPCFifoDecoder`
+
+    Returns
+    -------
+    np.ndarray
+        Photons with `PHOTON_DTYPE`
+    """
+    valid = phot_info[(phot_info['flags'] & NOT_PHOTON) == 0]
+    photons = np.empty(valid.size, dtype=PHOTON_DTYPE)
+    photons['macrotime'] = valid['mtime']
+    microtime = valid['micro_time'] & ADC_MASK
+    photons['microtime'] = ADC_MASK - microtime if reverse else microtime
+    photons['channel'] = valid['rout_chan']
+    return photons
+
+
+def histogram_from_phot_info(phot_info: np.ndarray, n_bins: int = ADC_MASK + 1,
+                             reverse: bool = True) -> np.ndarray:
+    """
+    Micro time histogram of `PhotInfo64` entries.
+
+    Parameters
+    ----------
+    phot_info : np.ndarray
+        Array with `PHOT_INFO64_DTYPE`
+    n_bins : int, optional
+        Number of bins
+    reverse : bool, optional
+        Reverses the micro times, see `photons_from_phot_info`
+
+    Returns
+    -------
+    np.ndarray
+        Counts per micro time bin
+    """
+    microtime = (phot_info['micro_time'] & ADC_MASK).astype(np.intp)
+    if reverse:
+        np.subtract(ADC_MASK, microtime, out=microtime)
+    # Entries that are not photons go to a sentinel bin that is dropped
+    microtime[(phot_info['flags'] & NOT_PHOTON) != 0] = n_bins
+    np.minimum(microtime, n_bins, out=microtime)
+    return np.bincount(microtime, minlength=n_bins + 1)[:n_bins]
+
+
+class BufferedPhotonStream:
+    """
+    Buffered photon stream of one module.
+
+    The photons are extracted into one preallocated `PhotInfo64` buffer,
+    and every call to `read` returns a NumPy view on the photons added by
+    that call.
+
+    Parameters
+    ----------
+    dll : SPCDllWrapper
+        Wrapper of the SPC DLL
+    module_no : int
+        Module the FIFO is read from
+    max_photons : int
+        Size of the photon buffer. When it is full `read` starts again at
+        the beginning of the buffer, so the views returned before become
+        invalid.
+    what_to_read : int, optional
+        1 extracts only valid photons
+
+    Attributes
+    ----------
+    photons_read : int
+        Total number of photons extracted from the stream
+    words_read : int
+        Total number of 16 bit words read from the FIFO
+    """
+
+    WORDS_PER_PHOTON = 2
+
+    def __init__(self, dll, module_no: int = 0, max_photons: int = 2 ** 22,
+                 what_to_read: int = 1) -> None:
+
+        self.dll = dll
+        self.module_no = module_no
+        self.max_photons = max_photons
+        self.what_to_read = what_to_read
+        self._buffer = (PhotInfo64 * max_photons)()
+        self._array = phot_info_to_array(self._buffer)
+        self._position = 0
+        self.stream_handle = None
+        self.photons_read = 0
+        self.words_read = 0
+
+    def open(self) -> int:
+        """
+        Initialises the buffered stream with the FIFO settings of the
+        module.
+
+        Returns
+        -------
+        int
+            Stream handle, negative on error
+        """
+        ret, mod_no, fifo_type, stream_type, mt_clock, spc_header = \
+            self.dll.SPC_get_fifo_init_vars(self.module_no, 0, 0, 0, 0)
+        self.mt_clock = mt_clock.value
+        ret, *_ = self.dll.SPC_init_buf_stream(
+            fifo_type.value, stream_type.value, self.what_to_read, mt_clock.value, 0
+        )
+        self.stream_handle = ret
+        self._position = 0
+        self.photons_read = 0
+        self.words_read = 0
+        return ret
+
+    def read(self, max_photons: int = None) -> np.ndarray:
+        """
+        Reads the FIFO into the stream and extracts the photons.
+
+        Parameters
+        ----------
+        max_photons : int, optional
+            Maximum number of photons to extract. Default fills the rest
+            of the buffer.
+
+        Returns
+        -------
+        np.ndarray
+            View with `PHOT_INFO64_DTYPE` on the extracted photons
+        """
+        if self._position == self.max_photons:
+            self._position = 0
+        free = self.max_photons - self._position
+        count = free if max_photons is None else min(max_photons, free)
+
+        ret, _, _, words = self.dll.SPC_read_fifo_to_stream(
+            self.stream_handle, self.module_no, count * self.WORDS_PER_PHOTON
+        )
+        self.words_read += words.value
+
+        # The photons are written directly behind the ones already in the buffer
+        ret, _, _, extracted = self.dll.SPC_get_photons_from_stream(
+            self.stream_handle,
+            ctypes.byref(self._buffer, self._position * ctypes.sizeof(PhotInfo64)),
+            count
+        )
+        start = self._position
+        self._position += extracted.value
+        self.photons_read += extracted.value
+        return self._array[start:self._position]
+
+    def get_info(self) -> PhotStreamInfo:
+        """
+        Returns the stream counters of the DLL.
+        """
+        ret, _, info = self.dll.SPC_get_phot_stream_info(self.stream_handle, PhotStreamInfo())
+        return info
+
+    def close(self) -> None:
+
+        if self.stream_handle is not None and self.stream_handle >= 0:
+            self.dll.SPC_close_phot_stream(self.stream_handle)
+        self.stream_handle = None
+
+
+def _legacy_extract(phot_buffer, total_photons):
+    """
+    Previous per photon loop of `fifobufreadtcspc`, kept for the benchmark.
+    """
+    micro_times = []
+    converted_times = []
+    macro_times = []
+    for i in range(int(total_photons)):
+        micro_time = phot_buffer[i].micro_time
+        adc_value = 4095 - micro_time & 0xFFF
+        if not (phot_buffer[i].flags & NOT_PHOTON):
+            if micro_time != 0:
+                micro_times.append(micro_time)
+                converted_times.append(adc_value)
+                macro_times.append(phot_buffer[i].mtime)
+    return micro_times, converted_times, macro_times
+
+
+def _legacy_histogram(data, t_values):
+    """
+    Previous `create_histogram` of `fifobufreadtcspc`, kept for the benchmark.
+    """
+    crhistogram = []
+    for t in t_values:
+        count = sum(1 for d in data if d == t)
+        crhistogram.append(count)
+    return crhistogram, t_values
+
+
+if __name__ == '__main__':
+
+    from qudi.hardware.tcspc.spc_fifo import SPCFifoPhotonDecoder, simulate_fifo_records
+
+    n_photons = 10 ** 7
+    buffer = (PhotInfo64 * n_photons)()
+    phot_info = phot_info_to_array(buffer)
+    photons = SPCFifoPhotonDecoder().decode(simulate_fifo_records(n_photons, seed=0))
+    phot_info['mtime'][:photons.size] = photons['macrotime']
+    phot_info['micro_time'][:photons.size] = ADC_MASK - photons['microtime']
+    phot_info['rout_chan'][:photons.size] = photons['channel']
+    phot_info['flags'][photons.size:] = NOT_PHOTON
+
+    start = time.perf_counter()
+    extracted = photons_from_phot_info(phot_info)
+    histogram = histogram_from_phot_info(phot_info)
+    vectorized_time = time.perf_counter() - start
+    print(f'Vectorized: {n_photons} entries in {vectorized_time:.3f} s, '
+          f'{n_photons / vectorized_time:.3e} photons/s')
+
+    n_legacy = 10 ** 5
+    start = time.perf_counter()
+    _, converted_times, _ = _legacy_extract(buffer, n_legacy)
+    legacy_time = (time.perf_counter() - start) * n_photons / n_legacy
+    n_histogram = 2000
+    start = time.perf_counter()
+    _legacy_histogram(converted_times[:n_histogram], np.arange(ADC_MASK + 1))
+    histogram_time = (time.perf_counter() - start) * n_photons / n_histogram
+    print(f'Legacy loop: {legacy_time:.1f} s, create_histogram: {histogram_time:.0f} s, '
+          f'extrapolated for {n_photons} entries')
+    print(f'Speed up: {(legacy_time + histogram_time) / vectorized_time:.0f}x')
+    print('Photons match:', np.array_equal(extracted, photons),
+          'histogram total:', histogram.sum() == photons.size)
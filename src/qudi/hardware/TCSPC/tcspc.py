@@ -10,16 +10,35 @@ from ctypes import (
 from qudi.hardware.tcspc.spc_def import (
     SPCdata, SPCModInfo, SPC_EEP_Data, SPC_Adjust_Para,
     SPCMemConfig, PhotStreamInfo, PhotInfo, PhotInfo64,
-    rate_values
+    rate_values, SPCState
 )
 
 
+# SPCState of every possible 16 bit state value, filled on first use
+_STATE_TABLE = None
+
+
+def get_state_table():
+    """
+    Returns the lookup table from 16 bit state values to `SPCState`.
+
+    Creating an IntFlag with a combination of bits is slow, so all 65536
+    combinations are created once and `translate_status` is a table
+    lookup.
+    """
+    global _STATE_TABLE
+    if _STATE_TABLE is None:
+        _STATE_TABLE = tuple(SPCState(value) for value in range(1 << 16))
+    return _STATE_TABLE
+
+
 class SPCDllWrapper:
     
 
     def __init__(self) -> None:
         
         self.__dll = CDLL(os.path.abspath('C:\Program Files (x86)\BH\SPCM\DLL\spcm64.dll'))
+        self._state_table = get_state_table()
 
         # Initialisation functions
         self.__SPC_init = self.__dll.SPC_init
@@ -230,7 +249,7 @@ class SPCDllWrapper:
 
         self.__SPC_get_photons_from_stream = self.__dll.SPC_get_photons_from_stream
         self.__SPC_get_photons_from_stream.restype = c_short
-        self.__SPC_get_photons_from_stream.argtypes = [c_short, POINTER(PhotInfo), POINTER(c_int)] # This should be a pointer to a structure of PhotInfo64
+        self.__SPC_get_photons_from_stream.argtypes = [c_short, POINTER(PhotInfo64), POINTER(c_int)]
 
         self.__SPC_stream_start_condition = self.__dll.SPC_stream_start_condition
         self.__SPC_stream_start_condition.restype = c_short
@@ -708,38 +727,24 @@ class SPCDllWrapper:
         return ret
 
     def translate_status(self, status):
-        
-        # Define the status codes
-        status_codes = {
-            0: 'SPC_OVERFL',
-            1: 'SPC_OVERFLOW',
-            2: 'SPC_TIME_OVER',
-            3: 'SPC_COLTIM_OVER',
-            4: 'SPC_CMD_STOP',
-            5: 'SPC_REPTIM_OVER',
-            6: 'SPC_SEQ_GAP',
-            7: 'SPC_ARMED',
-            8: 'SPC_COLTIM_2OVER',
-            9: 'SPC_REPTIM_2OVER',
-            10: 'SPC_FOVFL',
-            11: 'SPC_FEMPTY',
-            12: 'SPC_WAIT_TRG',
-            13: 'SPC_SEQ_GAP150',
-            14: 'SPC_SEQ_STOP',
-            15: 'SPC_HFILL_NRDY'
-        }
-
-        # Convert the byte string to an integer
-        status = int.from_bytes(status, byteorder='little')
-        binary_str = bin(status)[2:]
-        binary_str = binary_str.zfill(16)
-        binary_str = binary_str[::-1]
-        status_msg = []
-        # Check each status code
-        for bit_index, code in status_codes.items():
-            if binary_str[bit_index] == '1':
-                status_msg.append(code)
-        return status_msg
+        """
+        Converts the state returned by SPC_test_state to an `SPCState`.
+
+        Args:
+        status: c_short, bytes or int
+            The module state
+
+        Returns:
+        SPCState
+            The state bits, e.g. `SPCState.ARMED in state`
+        """
+        if isinstance(status, int):
+            value = status
+        elif hasattr(status, 'value'):
+            value = status.value
+        else:
+            value = int.from_bytes(status, byteorder='little')
+        return self._state_table[value & 0xFFFF]
     
 if __name__ == '__main__':
 
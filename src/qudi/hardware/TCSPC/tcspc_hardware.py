@@ -10,6 +10,14 @@ from qudi.util.mutex import Mutex
 from qudi.hardware.tcspc.tcspc import SPCDllWrapper
 from qudi.core.module import Base
 from qudi.hardware.tcspc.spc_def import *
+from qudi.hardware.tcspc.fifo_reader import (
+    RecordRingBuffer, FifoReaderThread, SimulatedFifo
+)
+from qudi.hardware.tcspc.spc_stream import (
+    BufferedPhotonStream, photons_from_phot_info
+)
+from qudi.hardware.tcspc.rate_poller import RateHistory, RatePollerThread
+from qudi.hardware.tcspc.spc_memory import MemoryHistogramReader
 import bh_spc
 from bh_spc import spcm
 import os
@@ -18,20 +26,60 @@ import ctypes
 import numpy as np
 
 
+# Parameters the DLL rounds or limits to what the hardware can set. After
+# writing one of them the value actually set is read back from the module.
+COERCED_PARAMS = frozenset(
+    name for name, c_type in SPCdata._fields_ if c_type is ctypes.c_float
+) | {'tac_gain', 'adc_resolution', 'sync_freq_div', 'macro_time_clk'}
+
 
 class TCSPCHardware(Base):
 
+    # Numbers of the SPC modules used together, e.g. one per detector
+    _modules = ConfigOption(name='modules', default=[0])
+    _ring_buffer_size = ConfigOption(name='fifo_ring_buffer_size', default=2 ** 24)
+    _simulated_fifo_rate = ConfigOption(name='simulated_fifo_rate', default=None)
+    _rate_history_length = ConfigOption(name='rate_history_length', default=600)
+    _rate_max_retries = ConfigOption(name='rate_max_retries', default=5)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._mutex = Mutex()
         self.module_no = 0
+        # Each module has its own lock, so the FIFOs are drained in parallel
+        self._module_locks = {}
+        self._ring_buffers = {}
+        self._fifo_readers = {}
+        self._simulated_fifos = {}
+        self._dll = None
+        self._photon_stream = None
+        self._memory_readers = {}
+        self._rate_history = None
+        self._rate_poller = None
+        self._tcspc_params = None
+        self._dirty_params = set()
+        self._param_calls = {
+            'dll_reads': 0, 'dll_writes': 0, 'cached_reads': 0,
+            'skipped_writes': 0, 'saved_calls': 0
+        }
 
 
     def on_activate(self) -> None:
-        pass
+        self._modules = [int(module_no) for module_no in self._modules]
+        self.module_no = self._modules[0]
+        self._module_locks = {module_no: Mutex() for module_no in self._modules}
+
+    def get_modules(self):
+        """
+        Returns the numbers of the modules used, the first one is the
+        module the parameters are read from.
+        """
+        return list(self._modules)
 
     def on_deactivate(self) -> None:
+        self.stop_rate_poller()
+        self.stop_fifo_reader()
+        self.close_buffered_stream()
         spcm.close()
 
     def initialise_tcspc(self, simulation=False):
@@ -52,41 +100,157 @@ class TCSPCHardware(Base):
             ini_file_path = os.path.abspath(r'C:\EXP\python\Qoptics_exp\new_settings.ini')
             self.log.info('Initialising TCSPC hardware with file {}'.format(ini_file_path))
             spcm.init(ini_file_path)
-            spcm.set_mode(spcm.DLLOperationMode.HARDWARE, True, [True])
+            spcm.set_mode(
+                spcm.DLLOperationMode.HARDWARE, True,
+                [module_no in self._modules for module_no in range(max(self._modules) + 1)]
+            )
 
-        self.module_no = 0
-        status = spcm.get_init_status(self.module_no)
-        self._tcspc_params = spcm.get_parameters(self.module_no)
+        status = {module_no: spcm.get_init_status(module_no) for module_no in self._modules}
+        self.get_SPC_params_from_module(self.module_no)
 
         return status
 
-    def set_SPC_param(self, param : str, value):
+    def set_SPC_param(self, param: str, value, flush: bool = True):
+        """
+        Sets a parameter in the cached SPCdata and writes it to the modules.
+
+        Writing a value equal to the cached one is skipped. Parameters
+        the DLL rounds to the hardware resolution (`COERCED_PARAMS`) are
+        read back after writing, the others are taken from the cache.
+
+        Args:
+        param: str
+            Name of the parameter, e.g. 'collect_time'
+        value:
+            Value to set
+        flush: bool
+            If False the parameter is only marked as changed and written
+            with the next `flush_SPC_params`
 
-        setted_param = self._set_SPC_param_to_module(param, value)
+        Returns:
+        The value of the parameter in the cache
+        """
+        if self._tcspc_params is None:
+            self.get_SPC_params_from_module(self.module_no)
+        name = param.lower()
+        if name not in self._dirty_params and getattr(self._tcspc_params, name) == value:
+            self._param_calls['skipped_writes'] += 1
+            return value
+        setattr(self._tcspc_params, name, value)
+        self._dirty_params.add(name)
+        if flush:
+            self.flush_SPC_params()
+        return getattr(self._tcspc_params, name)
+
+    def set_SPC_params(self, params: dict):
+        """
+        Sets several parameters with a single write to the module.
+
+        Args:
+        params: dict
+            Parameter names and values
+
+        Returns:
+        dict
+            The values of the parameters after writing
+        """
+        for param, value in params.items():
+            self.set_SPC_param(param, value, flush=False)
+        self.flush_SPC_params()
+        return {param: getattr(self._tcspc_params, param.lower()) for param in params}
+
+    def flush_SPC_params(self):
+        """
+        Writes the parameters changed in the cache to the module.
+
+        The changed parameters are written with `spcm.set_parameter`.
+        With a single module several changed parameters are written with
+        one `spcm.set_parameters` of the whole SPCdata instead. The cache
+        holds the parameters of the first module, so with several modules
+        only the changed parameters are written, the others (CFD, TAC,
+        sync) keep the settings of each module. The cache is only read
+        back from the module if a changed parameter is in
+        `COERCED_PARAMS`.
+
+        Returns:
+        dict
+            The values of the written parameters
+        """
+        if not self._dirty_params:
+            return {}
+        dirty = sorted(self._dirty_params)
+        calls = self._param_calls['dll_reads'] + self._param_calls['dll_writes']
+        if len(dirty) > 1 and len(self._modules) == 1:
+            spcm.set_parameters(self._modules[0], self._tcspc_params)
+            self._param_calls['dll_writes'] += 1
+            if COERCED_PARAMS.intersection(dirty):
+                self._tcspc_params = spcm.get_parameters(self.module_no)
+                self._param_calls['dll_reads'] += 1
+        else:
+            for name in dirty:
+                value = self._set_SPC_param_to_module(name, getattr(self._tcspc_params, name))
+                setattr(self._tcspc_params, name, value)
+        self._dirty_params.clear()
+
+        # Writing each parameter to every module and reading it back takes
+        # two calls per module
+        calls = self._param_calls['dll_reads'] + self._param_calls['dll_writes'] - calls
+        self._param_calls['saved_calls'] += 2 * len(dirty) * len(self._modules) - calls
+        written = {name: getattr(self._tcspc_params, name) for name in dirty}
+        self.log.info(f'Parameters set to {written}')
+        return written
+
+    def get_SPC_param(self, param: str, from_module: bool = False):
+        """
+        Returns a parameter from the cached SPCdata.
+
+        Args:
+        param: str
+            Name of the parameter
+        from_module: bool
+            Reads the parameter from the module instead of the cache
+        """
+        if from_module or self._tcspc_params is None:
+            return self._get_SPC_param_from_module(param)
+        self._param_calls['cached_reads'] += 1
+        self._param_calls['saved_calls'] += 1
         return getattr(self._tcspc_params, param.lower())
 
-    def get_SPC_param(self, param: str):
+    def get_param_call_stats(self):
+        """
+        Returns the counters of the parameter cache.
 
-        return self._get_SPC_param_from_module(param)
+        Returns:
+        dict
+            dll_reads, dll_writes, cached_reads, skipped_writes and
+            saved_calls, the number of DLL calls avoided compared with
+            writing and reading back every parameter individually
+        """
+        return dict(self._param_calls)
 
     def _get_SPC_param_from_module(self, param: str):
 
         param_id = getattr(spcm.ParID, param.upper())
         value = spcm.get_parameter(self.module_no, param_id)
+        self._param_calls['dll_reads'] += 1
         return value
 
     def _set_SPC_param_to_module(self, param: str, value):
 
         param_id = getattr(spcm.ParID, param.upper())
-        spcm.set_parameter(self.module_no, param_id, value)
-        setted_parameter = self._get_SPC_param_from_module(param)
-        self.log.info(f'Parameter {param} set to value {setted_parameter}')
-        setattr(self._tcspc_params, param.lower(), setted_parameter)
-        return setted_parameter
+        for module_no in self._modules:
+            spcm.set_parameter(module_no, param_id, value)
+            self._param_calls['dll_writes'] += 1
+        if param.lower() in COERCED_PARAMS:
+            value = self._get_SPC_param_from_module(param)
+        return value
 
     def get_SPC_params_from_module(self, module_no: int = 0):
         """
         Get the parameters of the SPCdata object from the TCSPC hardware
+
+        Replaces the parameter cache, changes that were not flushed are
+        discarded.
         
         Args:
         module_no: int
@@ -97,7 +261,9 @@ class TCSPCHardware(Base):
             The SPCdata object
         """
         params = spcm.get_parameters(module_no)
+        self._param_calls['dll_reads'] += 1
         self._tcspc_params = params
+        self._dirty_params.clear()
         return params
 
     def set_SPC_params_to_module(self, module_no):
@@ -116,15 +282,15 @@ class TCSPCHardware(Base):
             The SPCdata object
         """
         spcm.set_parameters(module_no, self._tcspc_params)
+        self._param_calls['dll_writes'] += 1
         params = self.get_SPC_params_from_module(module_no)
         return params
     
     def init_fifo_measurement(self, module_no):
 
         self.log.info('Initialising FIFO measurement')
-        self.set_SPC_param('mode', 1) # Sets FIFO Mode
-        self._tcspc_params.stop_on_time = 1
-        self.set_SPC_params_to_module(module_no)
+        # FIFO mode, stopped after the collection time
+        self.set_SPC_params({'mode': 1, 'stop_on_time': 1})
 
     def start_measurement(self, module_no):
 
@@ -136,6 +302,82 @@ class TCSPCHardware(Base):
         rates = spcm.read_rates(module_no)
         return rates
 
+    def start_rate_poller(self, module_no, interval=1.0):
+        """
+        Starts a thread that reads the rate counters every `interval`
+        seconds into the rate history.
+
+        A failed read is retried with an increasing delay, at most
+        `rate_max_retries` times. The poller does not take the lock of the
+        FIFO reads.
+
+        Args:
+        module_no: int
+            The module number
+        interval: float
+            Seconds between two readings
+        """
+        self.stop_rate_poller()
+        if self._rate_history is None:
+            self._rate_history = RateHistory(self._rate_history_length)
+        self._rate_poller = RatePollerThread(
+            self._rate_history,
+            self.read_rate_counter,
+            module_no=module_no,
+            interval=interval,
+            max_retries=self._rate_max_retries
+        )
+        self._rate_poller.start()
+        self.log.info(f'Rate poller started for module {module_no}')
+
+    def stop_rate_poller(self):
+        """
+        Stops the rate poller thread. The rate history is kept.
+        """
+        if self._rate_poller is None:
+            return
+        self._rate_poller.stop()
+        self.log.info(f'Rate poller stopped: {self._rate_poller.get_stats()}')
+        self._rate_poller = None
+
+    def get_latest_rates(self):
+        """
+        Returns the newest rate reading without accessing the module.
+
+        Returns:
+        tuple
+            (timestamp, (sync_rate, cfd_rate, tac_rate, adc_rate)), None
+            if there is no reading yet
+        """
+        if self._rate_history is None:
+            return None
+        return self._rate_history.latest()
+
+    def get_rate_history(self):
+        """
+        Returns the rate readings from the oldest to the newest.
+
+        Returns:
+        tuple
+            (times, rates) with the timestamps in seconds and the rates of
+            shape (n, 4) in the order sync, CFD, TAC, ADC
+        """
+        if self._rate_history is None:
+            return np.zeros(0), np.zeros((0, 4))
+        return self._rate_history.get_history()
+
+    def get_rate_poller_stats(self):
+        """
+        Returns the counters of the rate poller.
+
+        Returns:
+        dict
+            polls, retries, failed_polls and last_error
+        """
+        if self._rate_poller is None:
+            return {}
+        return self._rate_poller.get_stats()
+
     def stop_measurement(self, module_no):
 
         spcm.stop_measurement(module_no)
@@ -144,16 +386,267 @@ class TCSPCHardware(Base):
             
         spcm.clear_rates(module_no)
 
+    def _module_lock(self, module_no):
+
+        if module_no not in self._module_locks:
+            self._module_locks[module_no] = Mutex()
+        return self._module_locks[module_no]
+
     def read_data_from_tcspc(self, module_no, buf_size):
 
-        with self._mutex:
+        with self._module_lock(module_no):
             buf = spcm.read_fifo_to_array(module_no, buf_size)
         return buf
 
 
     def test_state(self, module_no):
 
-        with self._mutex:
+        with self._module_lock(module_no):
             status = spcm.test_state(module_no)
         return status
 
+    def _fifo_overflowed(self, module_no):
+
+        status = self.test_state(module_no)
+        return spcm.MeasurementState.FIFO_OVERFLOW in status
+
+    def start_fifo_reader(self, module_no, buf_size=32768):
+        """
+        Starts a thread that continuously drains the FIFO of a module into
+        the ring buffer of that module.
+
+        Every module has its own reader thread and ring buffer, so the
+        FIFOs of several modules are drained in parallel. If the
+        `simulated_fifo_rate` config option is set, the records are
+        produced by a `SimulatedFifo` at that rate instead of the module.
+
+        Args:
+        module_no: int
+            The module number
+        buf_size: int
+            Maximum number of 16 bit words read from the FIFO per call
+        """
+        self.stop_fifo_reader(module_no)
+        if module_no not in self._ring_buffers:
+            self._ring_buffers[module_no] = RecordRingBuffer(self._ring_buffer_size)
+        ring_buffer = self._ring_buffers[module_no]
+        ring_buffer.clear()
+
+        if self._simulated_fifo_rate is not None:
+            simulated_fifo = SimulatedFifo(count_rate=self._simulated_fifo_rate)
+            simulated_fifo.start()
+            self._simulated_fifos[module_no] = simulated_fifo
+            read_function = simulated_fifo.read_fifo_to_array
+            overflow_function = simulated_fifo.fifo_overflowed
+        else:
+            read_function = self.read_data_from_tcspc
+            overflow_function = self._fifo_overflowed
+
+        fifo_reader = FifoReaderThread(
+            ring_buffer,
+            read_function,
+            overflow_function,
+            module_no=module_no,
+            buf_size=buf_size
+        )
+        fifo_reader.start()
+        self._fifo_readers[module_no] = fifo_reader
+        self.log.info(f'FIFO reader started for module {module_no}')
+
+    def stop_fifo_reader(self, module_no=None):
+        """
+        Stops the FIFO reader thread of a module after it has drained the
+        FIFO.
+
+        The records read until then stay in the ring buffer.
+
+        Args:
+        module_no: int
+            The module number, None stops the readers of all modules
+        """
+        if module_no is None:
+            for module_no in list(self._fifo_readers):
+                self.stop_fifo_reader(module_no)
+            return
+        simulated_fifo = self._simulated_fifos.pop(module_no, None)
+        if simulated_fifo is not None:
+            simulated_fifo.stop()
+        fifo_reader = self._fifo_readers.pop(module_no, None)
+        if fifo_reader is not None:
+            fifo_reader.stop()
+            if fifo_reader.error is not None:
+                self.log.error(f'FIFO reader of module {module_no} failed: {fifo_reader.error}')
+            self.log.info(f'FIFO reader of module {module_no} stopped: {fifo_reader.get_stats()}')
+
+    def read_fifo_records(self, module_no=0):
+        """
+        Takes all records collected by the FIFO reader of a module so far.
+
+        Args:
+        module_no: int
+            The module number
+
+        Returns:
+        np.ndarray
+            uint32 FIFO records. The array is overwritten by the next call
+            for the same module.
+        """
+        if module_no not in self._ring_buffers:
+            return np.zeros(0, dtype=np.uint32)
+        return self._ring_buffers[module_no].read()
+
+    def get_fifo_reader_stats(self, module_no=None):
+        """
+        Returns the counters of the FIFO readers.
+
+        Args:
+        module_no: int
+            The module number, None sums the counters of all modules
+
+        Returns:
+        dict
+            records_read, reads, lost_records, fifo_overflows,
+            buffered_records and throughput (records/s)
+        """
+        if module_no is not None:
+            if module_no not in self._fifo_readers:
+                return {}
+            return self._fifo_readers[module_no].get_stats()
+        if not self._fifo_readers:
+            return {}
+        stats = {}
+        for fifo_reader in self._fifo_readers.values():
+            for key, value in fifo_reader.get_stats().items():
+                stats[key] = stats.get(key, 0) + value
+        stats['modules'] = len(self._fifo_readers)
+        return stats
+
+    def init_memory_measurement(self, adc_resolution=12):
+        """
+        Prepares the histogram (memory) mode of all modules.
+
+        The modules build the histograms in their memory and stop after
+        each collection time. Every collection period is measured into the
+        other memory bank, so a finished bank is read while the module
+        measures.
+
+        Args:
+        adc_resolution: int
+            ADC resolution in bits
+
+        Returns:
+        int
+            Number of bins of the histograms
+        """
+        self.log.info('Initialising memory measurement')
+        if self._dll is None:
+            self._dll = SPCDllWrapper()
+        # Normal (histogram) mode, stopped after the collection time
+        self.set_SPC_params({'mode': 0, 'stop_on_time': 1, 'adc_resolution': adc_resolution})
+        self._memory_readers = {}
+        for module_no in self._modules:
+            reader = MemoryHistogramReader(self._dll, module_no, adc_resolution)
+            with self._module_lock(module_no):
+                reader.configure()
+            self._memory_readers[module_no] = reader
+        return reader.n_bins
+
+    def start_memory_measurement(self, module_no):
+        """
+        Clears both memory banks of a module and starts the measurement.
+        """
+        with self._module_lock(module_no):
+            self._memory_readers[module_no].start()
+
+    def memory_period_finished(self, module_no):
+        """
+        Returns True if the collection period of a module has ended and
+        its memory bank can be swapped.
+        """
+        with self._module_lock(module_no):
+            return self._memory_readers[module_no].is_finished()
+
+    def swap_memory_bank(self, module_no):
+        """
+        Restarts the measurement of a module in the other memory bank and
+        reads the histograms of the finished collection period.
+
+        Returns:
+        np.ndarray
+            uint16 counts of shape (blocks, bins), one block per routing
+            channel. The array is overwritten by the next read of the
+            same bank.
+        """
+        with self._module_lock(module_no):
+            return self._memory_readers[module_no].swap()
+
+    def stop_memory_measurement(self, module_no):
+        """
+        Stops the measurement of a module and reads the histograms of the
+        last collection period.
+
+        Returns:
+        np.ndarray
+            uint16 counts of shape (blocks, bins)
+        """
+        with self._module_lock(module_no):
+            return self._memory_readers[module_no].stop()
+
+    def open_buffered_stream(self, module_no, max_photons=2 ** 22):
+        """
+        Opens a buffered photon stream of the DLL for a FIFO measurement.
+
+        The DLL reads the FIFO into its stream buffers and extracts the
+        photons into a preallocated `PhotInfo64` buffer that is read as a
+        NumPy array without copying.
+
+        Args:
+        module_no: int
+            The module number
+        max_photons: int
+            Number of photons the extraction buffer holds
+
+        Returns:
+        int
+            The stream handle, negative on error
+        """
+        self.close_buffered_stream()
+        if self._dll is None:
+            self._dll = SPCDllWrapper()
+        self._photon_stream = BufferedPhotonStream(self._dll, module_no, max_photons)
+        handle = self._photon_stream.open()
+        if handle < 0:
+            self.log.error(f'Could not open buffered stream: {handle}')
+            self._photon_stream = None
+        else:
+            self.log.info(f'Buffered stream {handle} opened for module {module_no}')
+        return handle
+
+    def read_buffered_stream(self, max_photons=None):
+        """
+        Reads the FIFO into the buffered stream and returns the new photons.
+
+        Args:
+        max_photons: int
+            Maximum number of photons to extract, default fills the buffer
+
+        Returns:
+        np.ndarray
+            Photons with `PHOTON_DTYPE`, entries flagged as not photons
+            are removed
+        """
+        with self._module_lock(self._photon_stream.module_no):
+            phot_info = self._photon_stream.read(max_photons)
+        return photons_from_phot_info(phot_info)
+
+    def close_buffered_stream(self):
+        """
+        Closes the buffered photon stream.
+        """
+        if self._photon_stream is None:
+            return
+        self.log.info(
+            f'Buffered stream closed after {self._photon_stream.photons_read} photons'
+        )
+        self._photon_stream.close()
+        self._photon_stream = None
@@ -0,0 +1,563 @@
+"""
+Software PulseBlaster with the same functions as `qudi.hardware.spinapi`.
+
+The `pb_*` functions of this module record the instructions of a program
+instead of sending them to the board, and `pb_start` executes the program
+with `run_program`, without hardware. The board reports that it is running
+until the duration of the program has passed, so `wait_for_stop` and the
+status polling of the logic work as with the board. The output waveform of
+the program is returned as an array of edges, the times at which the
+outputs change, and `check_timing` lists the instructions the board could
+not play.
+
+The emulator is opt-in, so a board that fails to load is never replaced
+silently. It replaces spinapi in the modules that use it when `install()`
+is called before they are imported:
+
+    from qudi.hardware import spinapi_emulator
+    spinapi_emulator.install()
+    from qudi.logic.pulsed_esr_logic import PulsedESRLogic
+
+Contains:
+
+- PulseBlasterEmulator: program memory and status of one board
+- check_timing(instructions, clock): instructions the board can not play
+- channel_pulses(edges, channel): pulses of one output in an edge array
+- board: the emulated board used by the pb_* functions
+- install(): makes `qudi.hardware.spinapi` import this module
+- pb_*: same functions as spinapi
+"""
+import sys
+import time
+
+import numpy as np
+
+from qudi.logic.pulse_compiler import (
+    EDGE_DTYPE, INSTRUCTION_DTYPE, MAX_INSTRUCTIONS, MAX_LOOP_COUNT, run_program
+)
+
+
+PULSE_PROGRAM = 0
+FREQ_REGS = 1
+
+ns = 1.0
+us = 1000.0
+ms = 1000000.0
+
+MHz = 1.0
+kHz = 0.001
+Hz = 0.000001
+
+# Defines for status bits
+STATUS_STOPPED = 1
+STATUS_RESET = 2
+STATUS_RUNNING = 4
+STATUS_WAITING = 8
+
+
+def enum(**enums):
+    return type('Enum', (), enums)
+
+
+# Instruction enum
+Inst = enum(
+    CONTINUE=0,
+    STOP=1,
+    LOOP=2,
+    END_LOOP=3,
+    JSR=4,
+    RTS=5,
+    BRANCH=6,
+    LONG_DELAY=7,
+    WAIT=8,
+    RTI=9
+)
+
+CONTINUE = 0
+STOP = 1
+LOOP = 2
+END_LOOP = 3
+JSR = 4
+RTS = 5
+BRANCH = 6
+LONG_DELAY = 7
+WAIT = 8
+RTI = 9
+
+ONE_PERIOD = 0x200000
+TWO_PERIOD = 0x400000
+THREE_PERIOD = 0x600000
+FOUR_PERIOD = 0x800000
+FIVE_PERIOD = 0xA00000
+ON = 0xE00000
+
+# The upper 3 bits of the flags select the short pulse feature, the others
+# are the outputs
+OUTPUT_MASK = 0x1FFFFF
+
+# Shortest instruction in clock periods
+MIN_INSTRUCTION_CYCLES = 5
+
+
+def check_timing(instructions: np.ndarray, clock: float = 500.0,
+                 max_instructions: int = MAX_INSTRUCTIONS) -> list:
+    """
+    Lists the instructions the board can not play as they are.
+
+    Checks the length of the instructions, which must be at least
+    `MIN_INSTRUCTION_CYCLES` clock periods and is rounded to whole clock
+    periods by the board, the loop counts, the addresses of END_LOOP,
+    JSR and BRANCH, and the size of the program.
+
+    Parameters
+    ----------
+    instructions : np.ndarray
+        Instructions with `INSTRUCTION_DTYPE`
+    clock : float, optional
+        Core clock in MHz
+    max_instructions : int, optional
+        Number of instructions the board holds
+
+    Returns
+    -------
+    list of str
+        One message per problem, empty if the program is fine
+    """
+    instructions = np.asarray(instructions, dtype=INSTRUCTION_DTYPE)
+    problems = []
+    n = instructions.size
+    if n > max_instructions:
+        problems.append(f'{n} instructions, the board holds {max_instructions}')
+    period = 1000.0 / clock
+    inst = instructions['inst']
+    length = instructions['length']
+    data = instructions['inst_data']
+    played = inst != STOP
+    cycles = length / period
+    for address in np.flatnonzero(played & (cycles < MIN_INSTRUCTION_CYCLES - 1e-6)):
+        problems.append(
+            f'Instruction {address}: {length[address]:g} ns is shorter than '
+            f'{MIN_INSTRUCTION_CYCLES} clock periods ({MIN_INSTRUCTION_CYCLES * period:g} ns)'
+        )
+    rounded = np.abs(cycles - np.round(cycles)) > 1e-6
+    for address in np.flatnonzero(played & rounded):
+        problems.append(
+            f'Instruction {address}: {length[address]:g} ns is not a multiple of '
+            f'the clock period ({period:g} ns)'
+        )
+    for address in np.flatnonzero((inst == LOOP) & ((data < 1) | (data > MAX_LOOP_COUNT))):
+        problems.append(f'Instruction {address}: loop count {data[address]} out of range')
+    for address in np.flatnonzero(inst == END_LOOP):
+        target = data[address]
+        if not (0 <= target < address and inst[target] == LOOP):
+            problems.append(f'Instruction {address}: END_LOOP to {target}, which is no LOOP')
+    for address in np.flatnonzero((inst == JSR) | (inst == BRANCH)):
+        if not 0 <= data[address] < n:
+            problems.append(f'Instruction {address}: jump to {data[address]} outside the program')
+    if n > 0 and not (inst == STOP).any() and not (inst == BRANCH).any():
+        problems.append('The program neither stops nor branches')
+    return problems
+
+
+def channel_pulses(edges: np.ndarray, channel: int) -> tuple:
+    """
+    Pulses of one output in an edge array.
+
+    Parameters
+    ----------
+    edges : np.ndarray
+        Edges with `EDGE_DTYPE`, e.g. from `PulseBlasterEmulator.get_waveform`
+    channel : int
+        Bit mask of the output
+
+    Returns
+    -------
+    tuple
+        (starts, ends) in ns. A pulse that is still on at the last edge
+        ends at infinity.
+    """
+    on = (edges['flags'] & channel) != 0
+    change = np.diff(on.astype(np.int8), prepend=0, append=0)
+    ends = np.append(edges['time'], np.inf)[change == -1]
+    return edges['time'][change[:-1] == 1], ends
+
+
+class PulseBlasterEmulator:
+    """
+    Program memory and status of one emulated board.
+
+    Parameters
+    ----------
+    max_instructions : int, optional
+        Number of instructions the board holds
+    time_scale : float, optional
+        Real time the board runs per time of the program, e.g. 0.001 to
+        play a program of 1 s in 1 ms
+
+    Attributes
+    ----------
+    program : np.ndarray
+        Instructions of the loaded program with `INSTRUCTION_DTYPE`
+    clock : float
+        Core clock in MHz
+    result : dict
+        Result of `run_program` for the running or last program
+    calls : dict
+        Number of calls of every pb_* function
+    """
+
+    def __init__(self, max_instructions: int = MAX_INSTRUCTIONS,
+                 time_scale: float = 1.0) -> None:
+
+        self.max_instructions = max_instructions
+        self.time_scale = time_scale
+        self.board_number = 0
+        self.clock = 500.0
+        self.initialized = False
+        self.programming = False
+        self.program = np.zeros(0, dtype=INSTRUCTION_DTYPE)
+        self.result = None
+        self.calls = {}
+        self.error = ''
+        self._rows = []
+        self._start_time = None
+        self._stopped = True
+
+    def _count(self, name: str) -> None:
+
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _fail(self, message: str) -> int:
+
+        self.error = message
+        return -1
+
+    def init(self) -> int:
+
+        self._count('pb_init')
+        self.initialized = True
+        return 0
+
+    def close(self) -> int:
+
+        self._count('pb_close')
+        self.stop()
+        self.initialized = False
+        return 0
+
+    def reset(self) -> int:
+
+        self._count('pb_reset')
+        self._start_time = None
+        self._stopped = True
+        return 0
+
+    def start_programming(self, target: int) -> int:
+
+        self._count('pb_start_programming')
+        if target != PULSE_PROGRAM:
+            return self._fail(f'Programming target {target} is not emulated')
+        self.programming = True
+        self._rows = []
+        return 0
+
+    def inst_pbonly(self, flags: int, inst: int, inst_data: int, length: float) -> int:
+        """
+        Records one instruction, returns its address.
+        """
+        self._count('pb_inst_pbonly')
+        if not self.programming:
+            return self._fail('pb_inst_pbonly called outside of programming')
+        if len(self._rows) >= self.max_instructions:
+            return self._fail(f'The board holds {self.max_instructions} instructions')
+        self._rows.append((int(flags), int(inst), int(inst_data), float(length)))
+        return len(self._rows) - 1
+
+    def stop_programming(self) -> int:
+
+        self._count('pb_stop_programming')
+        if self.programming:
+            self.program = np.array(self._rows, dtype=INSTRUCTION_DTYPE)
+            self.result = None
+        self.programming = False
+        return 0
+
+    def start(self) -> int:
+        """
+        Executes the program and marks the board as running for its
+        duration.
+        """
+        self._count('pb_start')
+        if self.program.size == 0:
+            return self._fail('No program loaded')
+        self.result = run_program(self.program)
+        self._start_time = time.monotonic()
+        self._stopped = False
+        return 0
+
+    def stop(self) -> int:
+
+        self._count('pb_stop')
+        self._stopped = True
+        return 0
+
+    def read_status(self) -> int:
+
+        self._count('pb_read_status')
+        if self._start_time is None:
+            return STATUS_RESET
+        if self._stopped or not self.running:
+            return STATUS_STOPPED
+        return STATUS_RUNNING
+
+    @property
+    def running(self) -> bool:
+        """
+        True while the started program has not reached its STOP.
+        """
+        if self._stopped or self._start_time is None:
+            return False
+        if not self.result['stopped']:
+            return True
+        elapsed = time.monotonic() - self._start_time
+        return elapsed < self.result['duration'] * 1e-9 * self.time_scale
+
+    def get_outputs(self) -> int:
+        """
+        Returns the outputs that are on right now, as a bit mask.
+        """
+        if self.result is None or self._start_time is None:
+            return 0
+        edges = self.result['edges']
+        if self._stopped or not self.running or self.result['period'] is not None:
+            return int(edges['flags'][-1]) & OUTPUT_MASK
+        elapsed = (time.monotonic() - self._start_time) / (1e-9 * self.time_scale)
+        index = np.searchsorted(edges['time'], elapsed, side='right') - 1
+        return int(edges['flags'][max(index, 0)]) & OUTPUT_MASK
+
+    def get_waveform(self, expand_loops: bool = True, max_edges: int = 10 ** 6,
+                     max_steps: int = 10 ** 7) -> dict:
+        """
+        Executes the loaded program and returns its output waveform.
+
+        Parameters
+        ----------
+        expand_loops : bool, optional
+            Plays every repetition of the loops, otherwise only the first
+            one is in the edges
+        max_edges : int, optional
+            Number of edges returned
+        max_steps : int, optional
+            Number of instructions executed
+
+        Returns
+        -------
+        dict
+            Result of `run_program`, with the short pulse bits removed
+            from the flags of the 'edges'
+        """
+        result = run_program(self.program, expand_loops, max_edges, max_steps)
+        edges = result['edges']
+        flags = edges['flags'] & OUTPUT_MASK
+        change = np.ones(flags.size, dtype=bool)
+        change[1:] = flags[1:] != flags[:-1]
+        result['edges'] = np.zeros(np.count_nonzero(change), dtype=EDGE_DTYPE)
+        result['edges']['time'] = edges['time'][change]
+        result['edges']['flags'] = flags[change]
+        return result
+
+    def check_timing(self) -> list:
+        """
+        Checks the loaded program, see `check_timing`.
+        """
+        return check_timing(self.program, self.clock, self.max_instructions)
+
+
+board = PulseBlasterEmulator()
+
+
+def install() -> None:
+    """
+    Makes `from qudi.hardware import spinapi` import this module. Modules
+    that already imported spinapi keep it.
+    """
+    sys.modules['qudi.hardware.spinapi'] = sys.modules[__name__]
+    package = sys.modules.get('qudi.hardware')
+    if package is not None:
+        package.spinapi = sys.modules[__name__]
+
+
+def pb_get_version():
+    """Return library version as UTF-8 encoded string."""
+    return 'emulator'
+
+
+def pb_get_error():
+    """Return library error as UTF-8 encoded string."""
+    return board.error
+
+
+def pb_count_boards():
+    """Return the number of boards detected in the system."""
+    return 1
+
+
+def pb_init():
+    """Initialize currently selected board."""
+    return board.init()
+
+
+def pb_set_debug(debug):
+    return 0
+
+
+def pb_select_board(board_number):
+    """Select a specific board number"""
+    board.board_number = board_number
+    return 0
+
+
+def pb_set_defaults():
+    """Set board defaults. Must be called before using any other board functions."""
+    return 0
+
+
+def pb_core_clock(clock):
+    board.clock = float(clock)
+    return 0
+
+
+def pb_start_programming(target):
+    return board.start_programming(target)
+
+
+def pb_stop_programming():
+    return board.stop_programming()
+
+
+def pb_inst_pbonly(*args):
+    return board.inst_pbonly(*args)
+
+
+def pb_start():
+    return board.start()
+
+
+def pb_stop():
+    return board.stop()
+
+
+def pb_reset():
+    return board.reset()
+
+
+def pb_close():
+    return board.close()
+
+
+def pb_read_status():
+    return board.read_status()
+
+
+def pb_status_message():
+    """Return library version as UTF-8 encoded string."""
+    status = board.read_status()
+    if status & STATUS_RUNNING:
+        return 'Board is running.'
+    if status & STATUS_STOPPED:
+        return 'Board is stopped.'
+    return 'Board is reset.'
+
+
+def pb_sleep_ms(mlsc):
+    time.sleep(mlsc * 1e-3)
+    return 0
+
+
+if __name__ == '__main__':
+
+    from qudi.logic.pulse_compiler import (
+        ProgramCompiler, PulseProgramCache, PulseTable, block_duration,
+        flatten_pulses, sweep_pulse, variation_loop_block, wait_for_stop
+    )
+
+    # Rabi like sequence: laser, microwave pulse of swept width, readout
+    # gate, 0.5 us steps. The delays shift the pulses sent to the board.
+    sweeps = [
+        (0b001, 0.0, 3.0, '', '', (0.0, 0.0)),
+        (0b010, 3.5, 0.5, 'W * i', '', (0.1, 0.1)),
+        (0b100, 20.0, 1.0, '', '', (0.0, 0.0)),
+    ]
+    n_variations = 20
+    value_loop = 50
+    start = time.perf_counter()
+    table = PulseTable()
+    for channel, start_time, width, function_width, function_start, delay in sweeps:
+        iterations, starts, widths = sweep_pulse(
+            start_time, width, function_width, function_start, (1, n_variations)
+        )
+        table.add(iterations, channel, starts - delay[0], starts + widths - delay[1])
+    variation_states = []
+    for i in range(1, n_variations + 1):
+        pulses = table.get_iteration(i)
+        variation_states.append(flatten_pulses(pulses['start'], pulses['end'], pulses['channel']))
+    block = variation_loop_block(variation_states, value_loop)
+    program = ProgramCompiler(time_unit=us, stop_length=us).compile(block)
+    compile_time = time.perf_counter() - start
+
+    board.time_scale = 0.01
+    module = sys.modules[__name__]
+    cache = PulseProgramCache(module)
+    start = time.perf_counter()
+    pb_select_board(0)
+    pb_init()
+    pb_core_clock(500)
+    cache.load(program)
+    pb_start()
+    stopped = wait_for_stop(module, board.result['duration'] * 1e-9 * board.time_scale)
+    pb_stop()
+    run_time = time.perf_counter() - start
+    print(f'{n_variations} variations x {value_loop}: compiled in {1e3 * compile_time:.1f} ms '
+          f'to {program.size} instructions, uploaded and played at x{1 / board.time_scale:.0f} '
+          f'in {1e3 * run_time:.0f} ms, stopped: {stopped}, '
+          f'{board.calls["pb_read_status"]} status reads')
+    print('Timing problems:', board.check_timing() or 'none')
+
+    # The waveform played by the board has the pulses of the table, in the
+    # order of the variations, each repeated value_loop times
+    waveform = board.get_waveform()
+    print(f'Waveform: {waveform["edges"].size} edges, '
+          f'{waveform["duration"] / 1e3:.1f} us (expected {block_duration(block):.1f} us)')
+    offsets = np.cumsum([0.0] + [
+        value_loop * states['duration'].sum() for states in variation_states
+    ])
+    match = True
+    for channel, *_ in sweeps:
+        starts, ends = channel_pulses(waveform['edges'], channel)
+        expected_starts, expected_ends = [], []
+        for i, states in enumerate(variation_states):
+            pulses = table.get_channel(table.get_iteration(i + 1), channel)
+            period = states['duration'].sum()
+            shift = pulses['start'][0] if pulses['start'][0] < 0 else 0.0
+            repeats = offsets[i] + period * np.arange(value_loop)[:, np.newaxis]
+            expected_starts.append((repeats + pulses['start'] - shift).ravel())
+            expected_ends.append((repeats + pulses['end'] - shift).ravel())
+        expected_starts = 1e3 * np.concatenate(expected_starts)
+        expected_ends = 1e3 * np.concatenate(expected_ends)
+        # Pulses of consecutive repetitions that touch are one pulse
+        touching = np.isclose(expected_starts[1:], expected_ends[:-1])
+        expected_starts = expected_starts[np.append(True, ~touching)]
+        expected_ends = expected_ends[np.append(~touching, True)]
+        match &= (starts.size == expected_starts.size
+                  and np.allclose(starts, expected_starts) and np.allclose(ends, expected_ends))
+    print('Pulses of every channel match the pulse table:', match)
+
+    # Output switched by PulseBlasterHardware.switch_pb_state: a BRANCH to itself
+    pb_start_programming(PULSE_PROGRAM)
+    pb_inst_pbonly(ON | 0b101, Inst.BRANCH, 0, 0)
+    pb_stop_programming()
+    pb_start()
+    print(f'Static outputs: {bin(board.get_outputs())}, running: {board.running}, '
+          f'period {board.result["period"]} ns, timing problems: {board.check_timing()}')
+    pb_stop()
+    pb_close()
@@ -0,0 +1,426 @@
+"""
+Photon counts of the APD gate windows of a pulsed experiment.
+
+The NI counter counts the APD pulses only while the gate output of the
+PulseBlaster is high (pause trigger) and takes one sample at the end of
+every gate window (sample clock on the falling edge of the gate), so the
+n-th sample is the total count at the end of the n-th gate window. The
+gate windows come in the order the program plays the variations, so the
+sample number alone tells the variation and repetition a window belongs
+to.
+
+The counter task runs continuously for the whole program. The driver
+calls back every `samples_per_read` samples, the samples are read into a
+preallocated buffer and the counts of the windows are added to running
+sums per variation and to a bounded (variation x repetition block)
+array, in the thread of the driver, while the logic only has to wait for
+the end of the program.
+
+Contains:
+
+- GatedCountAccumulator: sorts the counts of the windows into variations
+  and repetitions
+- BufferedCounterReader: reads the counter task when the driver calls back
+"""
+import threading
+
+import numpy as np
+
+
+class GatedCountAccumulator:
+    """
+    Adds the counts of the gate windows to running sums per variation and
+    to a (variation x repetition block) array.
+
+    The mean counts per repetition of every variation, e.g. the Rabi
+    curve while it is measured, only need the sums and the number of
+    windows of every variation, which `add` keeps up to date, so reading
+    the curve does not depend on the number of repetitions. The counts of
+    the single repetitions are binned into at most `max_blocks` blocks of
+    `block_size` consecutive repetitions, so the memory used is bounded
+    also for very long averages.
+
+    Parameters
+    ----------
+    gates_per_variation : sequence of int
+        Number of gate windows in one repetition of every variation
+    repetitions : int
+        Repetitions of every variation
+    interleaved : bool, optional
+        False if every variation is repeated before the next one is
+        played (experiment type 0), True if all variations are played one
+        after the other and then repeated (type 1)
+    max_blocks : int, optional
+        Maximum number of repetition blocks kept per variation. With as
+        many repetitions or fewer the blocks are the single repetitions.
+
+    Attributes
+    ----------
+    sums : np.ndarray
+        int64 counts of all windows of every variation
+    windows : np.ndarray
+        Number of windows of every variation added
+    counts : np.ndarray
+        int64 counts of shape (variations, blocks), the counts of all
+        windows of the repetitions of a block are added
+    block_size : int
+        Repetitions per block, the last block can have fewer
+    samples : int
+        Number of gate windows added
+    total_samples : int
+        Number of gate windows of the whole experiment
+    """
+
+    COUNTER_RANGE = 2 ** 32
+
+    def __init__(self, gates_per_variation, repetitions: int,
+                 interleaved: bool = False, max_blocks: int = 1000) -> None:
+
+        self.gates = np.asarray(gates_per_variation, dtype=np.int64)
+        self.repetitions = int(repetitions)
+        self.interleaved = interleaved
+        self.block_size = max(1, -(-self.repetitions // max(1, max_blocks)))
+        blocks = -(-self.repetitions // self.block_size)
+        self.sums = np.zeros(self.gates.size, dtype=np.int64)
+        self.windows = np.zeros(self.gates.size, dtype=np.int64)
+        self.counts = np.zeros((self.gates.size, blocks), dtype=np.int64)
+        if interleaved:
+            # Gate windows from the start of a repetition to the end of every variation
+            self._bounds = np.cumsum(self.gates)
+            self.total_samples = int(self._bounds[-1]) * self.repetitions if self.gates.size else 0
+        else:
+            self._bounds = np.cumsum(self.gates * self.repetitions)
+            self.total_samples = int(self._bounds[-1]) if self.gates.size else 0
+        self._starts = self._bounds - (
+            self.gates if interleaved else self.gates * self.repetitions
+        )
+        self.samples = 0
+        self.overflow = 0
+        self._last_count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, first: int, n: int) -> tuple:
+        """
+        Variation and repetition of the windows `first` to `first + n`.
+        """
+        sample = np.arange(first, first + n, dtype=np.int64)
+        if self.interleaved:
+            period = self._bounds[-1]
+            repetition, position = np.divmod(sample, period)
+            variation = np.searchsorted(self._bounds, position, side='right')
+        else:
+            variation = np.searchsorted(self._bounds, sample, side='right')
+            repetition = (sample - self._starts[variation]) // self.gates[variation]
+        return variation, repetition
+
+    def add(self, counts: np.ndarray) -> None:
+        """
+        Adds the counts of the next gate windows.
+
+        Windows after the end of the experiment are only counted in
+        `overflow`.
+
+        Parameters
+        ----------
+        counts : np.ndarray
+            Counts of consecutive windows
+        """
+        n = min(counts.size, self.total_samples - self.samples)
+        self.overflow += counts.size - n
+        if n <= 0:
+            return
+        variation, repetition = self._positions(self.samples, n)
+        counts = counts[:n]
+        sums = np.bincount(variation, weights=counts, minlength=self.gates.size)
+        windows = np.bincount(variation, minlength=self.gates.size)
+        with self._lock:
+            self.sums += sums.astype(np.int64)
+            self.windows += windows
+            np.add.at(self.counts, (variation, repetition // self.block_size), counts)
+            self.samples += n
+
+    def add_totals(self, totals: np.ndarray) -> None:
+        """
+        Adds the next samples of the counter, the total count at the end
+        of every window. The counter wraps around at 2 ** 32.
+
+        Parameters
+        ----------
+        totals : np.ndarray
+            Samples of the counter
+        """
+        if totals.size == 0:
+            return
+        totals = totals.astype(np.int64)
+        counts = np.diff(totals, prepend=self._last_count) % self.COUNTER_RANGE
+        self._last_count = int(totals[-1])
+        self.add(counts)
+
+    def repetitions_done(self) -> np.ndarray:
+        """
+        Returns the number of repetitions of every variation whose windows
+        have all been added.
+        """
+        gates = np.maximum(self.gates, 1)
+        if self.interleaved:
+            period = self._bounds[-1] if self.gates.size else 1
+            full, position = divmod(self.samples, max(int(period), 1))
+            done = full + (position >= self._bounds)
+        else:
+            done = (self.samples - self._starts) // gates
+        return np.clip(done, 0, self.repetitions)
+
+    def get_counts(self) -> np.ndarray:
+        """
+        Returns a copy of the (variation x repetition block) counts.
+        """
+        with self._lock:
+            return self.counts.copy()
+
+    def get_curve(self) -> np.ndarray:
+        """
+        Mean counts per repetition of every variation, over the windows
+        added so far, e.g. a Rabi curve while it is measured. Variations
+        without windows are NaN.
+        """
+        with self._lock:
+            sums = self.sums.copy()
+            windows = self.windows.copy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(windows > 0, sums * self.gates / windows, np.nan)
+
+
+class BufferedCounterReader:
+    """
+    Reads a buffered counter task whenever the driver has acquired
+    `samples_per_read` samples and adds them to a `GatedCountAccumulator`.
+
+    Parameters
+    ----------
+    task : nidaqmx.Task
+        Continuous counter task sampled at the end of every gate window,
+        not started yet
+    accumulator : GatedCountAccumulator
+        Where the counts are added
+    samples_per_read : int, optional
+        Samples per callback of the driver
+    on_update : callable, optional
+        Called as `on_update(accumulator)` after every read, in the
+        thread of the driver
+    reader : object, optional
+        Object with `read_many_sample_uint32`, default a
+        `nidaqmx.stream_readers.CounterReader` of the task
+
+    Attributes
+    ----------
+    reads : int
+        Number of reads
+    """
+
+    def __init__(self, task, accumulator: GatedCountAccumulator,
+                 samples_per_read: int = 1000, on_update=None, reader=None) -> None:
+
+        if reader is None:
+            # Only needed with a real task
+            from nidaqmx.stream_readers import CounterReader
+            reader = CounterReader(task.in_stream)
+        self.task = task
+        self.accumulator = accumulator
+        self.samples_per_read = max(1, min(samples_per_read, accumulator.total_samples))
+        self.on_update = on_update
+        self.reader = reader
+        self.reads = 0
+        self._buffer = np.zeros(self.samples_per_read, dtype=np.uint32)
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """
+        Registers the callback and starts the task.
+        """
+        self.task.register_every_n_samples_acquired_into_buffer_event(
+            self.samples_per_read, self._callback
+        )
+        self.task.start()
+
+    def _callback(self, task_handle, event_type, number_of_samples, callback_data) -> int:
+
+        self.read(number_of_samples)
+        return 0
+
+    def read(self, number_of_samples: int = None) -> int:
+        """
+        Reads samples from the buffer of the task and adds them.
+
+        Parameters
+        ----------
+        number_of_samples : int, optional
+            Samples to read, default all samples in the buffer
+
+        Returns
+        -------
+        int
+            Number of samples read
+        """
+        with self._lock:
+            if number_of_samples is None:
+                number_of_samples = self.task.in_stream.avail_samp_per_chan
+            total = 0
+            while number_of_samples > 0:
+                n = min(number_of_samples, self._buffer.size)
+                n = self.reader.read_many_sample_uint32(
+                    self._buffer, number_of_samples_per_channel=n
+                )
+                self.accumulator.add_totals(self._buffer[:n])
+                number_of_samples -= n
+                total += n
+            self.reads += 1
+        if self.on_update is not None:
+            self.on_update(self.accumulator)
+        return total
+
+    def finish(self) -> np.ndarray:
+        """
+        Reads the samples left in the buffer, stops and closes the task.
+
+        Returns
+        -------
+        np.ndarray
+            The (variation x repetition block) counts
+        """
+        self.read()
+        self.task.stop()
+        self.task.close()
+        return self.accumulator.get_counts()
+
+
+if __name__ == '__main__':
+
+    import time
+
+    class SimulatedGatedCounter:
+        """
+        Stand-in for a continuous NI counter task and its CounterReader,
+        with Poisson counts of a Rabi oscillation. A thread calls the
+        registered callback every `n` samples like the driver.
+        """
+
+        def __init__(self, rates, repetitions, interleaved, seed=0):
+            rng = np.random.default_rng(seed)
+            if interleaved:
+                expected = np.tile(rates, repetitions)
+            else:
+                expected = np.repeat(rates, repetitions)
+            self.counts = rng.poisson(expected)
+            self.totals = (np.cumsum(self.counts) % 2 ** 32).astype(np.uint32)
+            self.position = 0
+            self.acquired = 0
+            self.in_stream = self
+
+        @property
+        def avail_samp_per_chan(self):
+            return self.acquired - self.position
+
+        def register_every_n_samples_acquired_into_buffer_event(self, n, callback):
+            self.n = n
+            self.callback = callback
+
+        def start(self):
+            self.thread = threading.Thread(target=self._acquire)
+            self.thread.start()
+
+        def _acquire(self):
+            while self.acquired + self.n <= self.totals.size:
+                self.acquired += self.n
+                self.callback(0, 1, self.n, None)
+            self.acquired = self.totals.size
+
+        def read_many_sample_uint32(self, data, number_of_samples_per_channel):
+            n = number_of_samples_per_channel
+            data[:n] = self.totals[self.position:self.position + n]
+            self.position += n
+            return n
+
+        def stop(self):
+            pass
+
+        def close(self):
+            pass
+
+    # Rabi oscillation over 50 variations, 20000 repetitions, one gate each
+    variations = 50
+    repetitions = 20000
+    rates = 0.05 * (1 - 0.3 * np.sin(np.linspace(0, 3 * np.pi, variations)) ** 2)
+    for interleaved in (False, True):
+        task = SimulatedGatedCounter(rates, repetitions, interleaved)
+        accumulator = GatedCountAccumulator(np.ones(variations, dtype=int), repetitions, interleaved)
+        updates = []
+        reader = BufferedCounterReader(
+            task, accumulator, samples_per_read=1000, reader=task,
+            on_update=lambda acc: updates.append(acc.get_curve())
+        )
+        start = time.perf_counter()
+        reader.start()
+        # The program ends and the last samples are in the buffer
+        task.thread.join()
+        counts = reader.finish()
+        elapsed = time.perf_counter() - start
+        if interleaved:
+            expected = task.counts.reshape(repetitions, variations).T
+        else:
+            expected = task.counts.reshape(variations, repetitions)
+        # Blocks of block_size repetitions
+        expected_blocks = expected.reshape(variations, -1, accumulator.block_size).sum(axis=2)
+        print(f'{"Type 1" if interleaved else "Type 0"}: {accumulator.samples} windows in '
+              f'{1e3 * elapsed:.0f} ms ({accumulator.samples / elapsed:.2e} windows/s), '
+              f'{reader.reads} reads, blocks of {accumulator.block_size} repetitions match: '
+              f'{np.array_equal(counts, expected_blocks)}, '
+              f'curve matches: {np.allclose(accumulator.get_curve(), expected.mean(axis=1))}, '
+              f'{np.count_nonzero(np.isfinite(updates[len(updates) // 2]))} variations '
+              f'measured halfway')
+
+    # Several windows per repetition and a counter that wraps around
+    gates = np.array([2, 0, 3, 1])
+    for interleaved in (False, True):
+        accumulator = GatedCountAccumulator(gates, 7, interleaved)
+        accumulator._last_count = 2 ** 32 - 5
+        rng = np.random.default_rng(1)
+        window_counts = rng.integers(0, 10, accumulator.total_samples + 3)
+        totals = (2 ** 32 - 5 + np.cumsum(window_counts)) % 2 ** 32
+        for part in np.array_split(totals, 5):
+            accumulator.add_totals(part.astype(np.uint32))
+        expected = np.zeros((gates.size, 7), dtype=np.int64)
+        k = 0
+        order = (
+            [(r, v) for r in range(7) for v in range(gates.size)] if interleaved
+            else [(r, v) for v in range(gates.size) for r in range(7)]
+        )
+        for r, v in order:
+            for _ in range(gates[v]):
+                expected[v, r] += window_counts[k]
+                k += 1
+        print(f'Gates {gates.tolist()}, interleaved {interleaved}: '
+              f'match {np.array_equal(accumulator.counts, expected)}, '
+              f'sums match {np.array_equal(accumulator.sums, expected.sum(axis=1))}, '
+              f'{accumulator.overflow} windows after the end, '
+              f'repetitions done {accumulator.repetitions_done().tolist()}')
+
+    # Long averages: memory and time per callback do not grow with the
+    # number of repetitions
+    import tracemalloc
+    for repetitions in (10 ** 6, 10 ** 7):
+        tracemalloc.start()
+        accumulator = GatedCountAccumulator(np.ones(50, dtype=int), repetitions)
+        allocated = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        batch = np.random.default_rng(2).poisson(0.05, 1000)
+        start = time.perf_counter()
+        for _ in range(1000):
+            accumulator.add(batch)
+        add_time = (time.perf_counter() - start) / 1000
+        start = time.perf_counter()
+        for _ in range(1000):
+            accumulator.get_curve()
+        curve_time = (time.perf_counter() - start) / 1000
+        print(f'50 variations x {repetitions:.0e} repetitions: {allocated / 2 ** 20:.2f} MiB, '
+              f'blocks of {accumulator.block_size} repetitions, add of 1000 windows '
+              f'{1e6 * add_time:.0f} us, get_curve {1e6 * curve_time:.1f} us')
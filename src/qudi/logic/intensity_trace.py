@@ -0,0 +1,199 @@
+"""
+Fluorescence intensity traces binned from the macro times of TCSPC photons.
+
+Every photon recorded by the TCSPC card carries its macro time, so the
+intensity trace can be computed from the same photon stream as the
+lifetime histogram instead of with a separate counter.
+
+Contains the following:
+
+- IntensityTraceBinner: rolling intensity trace updated with every batch
+  of decoded photons
+- on_off_durations(counts, threshold): durations of the bright and dark
+  periods of a trace, for blinking statistics
+"""
+import numpy as np
+
+
+class IntensityTraceBinner:
+    """
+    Rolling intensity trace of a photon stream.
+
+    The counts are kept in a ring of `window / bin_width` bins indexed by
+    the absolute bin number modulo the ring size. A batch of photons is
+    added with one `np.bincount`, and the bins that fall out of the window
+    when the newest bin moves forward are set back to zero, so an update
+    costs O(new photons) plus the number of bins that were passed.
+
+    Parameters
+    ----------
+    bin_width : float
+        Width of one bin in seconds
+    window : float
+        Length of the trace that is kept, in seconds
+    macrotime_unit : float, optional
+        Macro time clock period in seconds
+    channels : tuple, optional
+        Routing channels that are counted. None counts all photons.
+
+    Attributes
+    ----------
+    photons : int
+        Number of photons counted
+    """
+
+    def __init__(self, bin_width: float, window: float,
+                 macrotime_unit: float = 50e-9, channels: tuple = None) -> None:
+
+        self.macrotime_unit = macrotime_unit
+        self.bin_ticks = max(1, int(round(bin_width / macrotime_unit)))
+        self.bin_width = self.bin_ticks * macrotime_unit
+        self.n_bins = max(1, int(round(window / self.bin_width)))
+        self.channels = channels
+        self.clear()
+
+    def clear(self) -> None:
+
+        self._ring = np.zeros(self.n_bins, dtype=np.int64)
+        self._last_bin = None
+        self.photons = 0
+
+    def _advance(self, new_last_bin: int) -> None:
+        """
+        Moves the newest bin forward and clears the bins that left the
+        window.
+        """
+        if self._last_bin is None:
+            self._last_bin = new_last_bin
+            return
+        passed = new_last_bin - self._last_bin
+        if passed <= 0:
+            return
+        if passed >= self.n_bins:
+            self._ring.fill(0)
+        else:
+            positions = np.arange(self._last_bin + 1, new_last_bin + 1) % self.n_bins
+            self._ring[positions] = 0
+        self._last_bin = new_last_bin
+
+    def update(self, photons: np.ndarray) -> None:
+        """
+        Adds a batch of decoded photons.
+
+        Parameters
+        ----------
+        photons : np.ndarray
+            Photons with `PHOTON_DTYPE`, later than all previous batches
+        """
+        if photons.size == 0:
+            return
+        macrotime = photons['macrotime']
+        if self.channels is not None:
+            macrotime = macrotime[np.isin(photons['channel'], self.channels)]
+            if macrotime.size == 0:
+                return
+        bins = (macrotime // np.uint64(self.bin_ticks)).astype(np.int64)
+        self._advance(int(bins[-1]))
+        first = self._last_bin - self.n_bins + 1
+        if bins[0] < first:
+            bins = bins[np.searchsorted(bins, first):]
+        self._ring += np.bincount(bins % self.n_bins, minlength=self.n_bins)
+        self.photons += bins.size
+
+    def get_trace(self, include_current: bool = False) -> tuple:
+        """
+        Returns the trace from the oldest to the newest bin.
+
+        Parameters
+        ----------
+        include_current : bool, optional
+            Also returns the newest bin, which may still receive photons
+
+        Returns
+        -------
+        tuple
+            (times, counts) with the start time of each bin in seconds and
+            the number of photons per bin
+        """
+        if self._last_bin is None:
+            return np.zeros(0), np.zeros(0, dtype=np.int64)
+        last = self._last_bin + 1 if include_current else self._last_bin
+        first = max(self._last_bin - self.n_bins + 1, 0)
+        bins = np.arange(first, last)
+        return bins * self.bin_width, self._ring[bins % self.n_bins]
+
+    def recent_rate(self, duration: float) -> float:
+        """
+        Mean count rate in counts/s over the last complete bins spanning
+        `duration` seconds.
+        """
+        times, counts = self.get_trace()
+        n = max(1, int(round(duration / self.bin_width)))
+        if counts.size == 0:
+            return 0.0
+        counts = counts[-n:]
+        return counts.sum() / (counts.size * self.bin_width)
+
+
+def on_off_durations(counts: np.ndarray, threshold: float) -> tuple:
+    """
+    Durations of the bright and dark periods of an intensity trace.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        Counts per bin
+    threshold : float
+        Bins with more counts than the threshold are bright
+
+    Returns
+    -------
+    tuple
+        (on, off) arrays with the length of each bright and each dark
+        period in bins. Periods cut by the start or the end of the trace
+        are not included.
+    """
+    bright = np.asarray(counts) > threshold
+    changes = np.flatnonzero(np.diff(bright.astype(np.int8))) + 1
+    if changes.size < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    lengths = np.diff(changes)
+    states = bright[changes[:-1]]
+    return lengths[states], lengths[~states]
+
+
+if __name__ == '__main__':
+
+    import time
+    from qudi.hardware.tcspc.spc_fifo import PHOTON_DTYPE
+
+    # Emitter blinking between 2e5 and 1e4 counts/s every few ms
+    rng = np.random.default_rng(0)
+    macrotime_unit = 50e-9
+    duration = 20.0
+    switches = np.cumsum(rng.exponential(5e-3, int(duration / 5e-3) * 2))
+    switches = switches[switches < duration]
+    rates = np.where(np.arange(switches.size) % 2 == 0, 2e5, 1e4)
+    starts = np.concatenate(([0.0], switches[:-1]))
+    n_photons = rng.poisson(rates * (switches - starts))
+    times = np.sort(np.concatenate([
+        rng.uniform(start, stop, n) for start, stop, n in zip(starts, switches, n_photons)
+    ]))
+    photons = np.zeros(times.size, dtype=PHOTON_DTYPE)
+    photons['macrotime'] = times / macrotime_unit
+
+    binner = IntensityTraceBinner(1e-3, 10.0, macrotime_unit)
+    start = time.perf_counter()
+    for batch in np.array_split(photons, 40):
+        binner.update(batch)
+    elapsed = time.perf_counter() - start
+    trace_times, counts = binner.get_trace()
+    print(f'Binned {photons.size} photons in {1e3 * elapsed:.1f} ms, '
+          f'{photons.size / elapsed:.3e} photons/s')
+    print(f'Trace of {counts.size} bins from {trace_times[0]:.2f} s to '
+          f'{trace_times[-1]:.2f} s, recent rate {binner.recent_rate(0.1):.3e} counts/s')
+    all_bins = photons['macrotime'] // binner.bin_ticks
+    reference = np.bincount(all_bins.astype(np.int64))[-counts.size - 1:-1]
+    print('Trace matches histogram:', np.array_equal(reference, counts))
+    on, off = on_off_durations(counts, 50)
+    print(f'Mean on time {on.mean():.1f} ms, mean off time {off.mean():.1f} ms')
@@ -0,0 +1,259 @@
+"""
+Kinetic series: a sequence of lifetime histograms, one per time slice of a
+continuous FIFO measurement.
+
+The photons are sorted into consecutive slices by their macro time while
+the measurement runs. Only the histogram of the slice that is still being
+filled is kept in memory, every completed slice is appended as one row of
+a 2D (slice x bin) HDF5 dataset, so the memory used does not grow with
+the length of the run.
+
+File layout:
+
+    /                               attrs: timestamp, notes, slices
+    /KineticSeries                  attrs: measurement parameters,
+                                    slice_width, macrotime_unit
+    /KineticSeries/histograms       uint32, (slices, bins)
+    /KineticSeries/time_bins        float, start time of each bin
+
+Contains the following:
+
+- KineticSeriesRecorder: appends the slices of a running measurement
+- load_kinetic_series(filepath, first, last): slices stored in a file
+"""
+import dataclasses
+import datetime
+import os
+import time
+
+import h5py
+import numpy as np
+
+from qudi.logic.photon_rebinning import RebinSettings, histogram_photons
+
+
+KINETIC_GROUP = 'KineticSeries'
+
+
+class KineticSeriesRecorder:
+    """
+    Builds one lifetime histogram per time slice and appends the completed
+    slices to an HDF5 file.
+
+    The rows of the dataset are allocated `growth` slices at a time, and
+    the dataset is cut to the number of slices written when the recorder
+    is closed. The last slice is written when the recorder is closed, even
+    if it is not complete.
+
+    Parameters
+    ----------
+    filepath : str
+        Path of the file to create
+    slice_width : float
+        Length of a slice in seconds
+    settings : RebinSettings, optional
+        Bin width, micro time gate and channels of the histograms. The
+        macro time window and the slice width of the settings are ignored.
+    macrotime_unit : float, optional
+        Macro time clock period in seconds
+    time_bins : np.ndarray, optional
+        Time axis of the histograms stored with the series
+    metadata : dict, optional
+        Measurement parameters stored as attributes of the group
+    growth : int, optional
+        Number of rows added to the dataset when it is full
+    max_slices : int, optional
+        Maximum number of slices histogrammed at once, limits the memory
+        used when a batch of photons spans many slices
+    compression : str, optional
+        HDF5 compression filter
+
+    Attributes
+    ----------
+    slices_written : int
+        Number of slices in the file
+    photons : int
+        Number of photons passed to `update`
+    """
+
+    def __init__(self, filepath: str, slice_width: float,
+                 settings: RebinSettings = None, macrotime_unit: float = 50e-9,
+                 time_bins: np.ndarray = None, metadata: dict = None,
+                 growth: int = 256, max_slices: int = 64,
+                 compression: str = 'lzf') -> None:
+
+        directory = os.path.dirname(filepath)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.filepath = filepath
+        self.macrotime_unit = macrotime_unit
+        self.slice_ticks = max(1, int(round(slice_width / macrotime_unit)))
+        self.slice_width = self.slice_ticks * macrotime_unit
+        settings = RebinSettings() if settings is None else settings
+        self.settings = dataclasses.replace(
+            settings, macrotime_window=(None, None), slice_width=self.slice_ticks
+        )
+        self.n_bins = self.settings.n_bins
+        self.growth = growth
+        self.max_slices = max_slices
+        self.slices_written = 0
+        self.photons = 0
+        self._origin = 0
+        self._current = np.zeros(self.n_bins, dtype=np.int64)
+        self._capacity = 0
+
+        self._file = h5py.File(filepath, 'w')
+        self._file.attrs.update({
+            'timestamp': datetime.datetime.now().isoformat(),
+            'notes': 'Kinetic series of lifetime histograms',
+        })
+        group = self._file.create_group(KINETIC_GROUP)
+        group.attrs.update(metadata if metadata is not None else {})
+        group.attrs['slice_width'] = self.slice_width
+        group.attrs['macrotime_unit'] = macrotime_unit
+        self._dataset = group.create_dataset(
+            'histograms',
+            shape=(0, self.n_bins),
+            maxshape=(None, self.n_bins),
+            dtype=np.uint32,
+            chunks=(min(16, growth), self.n_bins),
+            compression=compression,
+            shuffle=True
+        )
+        if time_bins is not None:
+            group.create_dataset('time_bins', data=time_bins)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def is_open(self) -> bool:
+        return self._file is not None
+
+    def update(self, photons: np.ndarray) -> None:
+        """
+        Adds a batch of photons.
+
+        Parameters
+        ----------
+        photons : np.ndarray
+            Photons with `PHOTON_DTYPE`, later than all previous batches
+        """
+        if photons.size == 0:
+            return
+        self.photons += photons.size
+        macrotime = photons['macrotime']
+        last = int(macrotime[-1])
+        while True:
+            n_slices = min((last - self._origin) // self.slice_ticks + 1, self.max_slices)
+            end = self._origin + n_slices * self.slice_ticks
+            split = np.searchsorted(macrotime, np.uint64(end))
+            histograms = histogram_photons(
+                photons[:split], self.settings, self._origin, n_slices
+            )
+            histograms[0] += self._current
+            self._write(histograms[:-1])
+            self._current = histograms[-1].copy()
+            self._origin += (n_slices - 1) * self.slice_ticks
+            if split == photons.size:
+                break
+            photons = photons[split:]
+            macrotime = photons['macrotime']
+
+    def _write(self, rows: np.ndarray) -> None:
+
+        if rows.shape[0] == 0:
+            return
+        end = self.slices_written + rows.shape[0]
+        if end > self._capacity:
+            self._capacity = end + self.growth
+            self._dataset.resize((self._capacity, self.n_bins))
+        self._dataset[self.slices_written:end] = rows
+        self.slices_written = end
+
+    def get_current_slice(self) -> tuple:
+        """
+        Returns the index and the histogram of the slice being filled.
+        """
+        return self.slices_written, self._current.copy()
+
+    def close(self) -> None:
+        """
+        Writes the last slice and closes the file.
+        """
+        if self._file is None:
+            return
+        self._write(self._current[np.newaxis])
+        self._dataset.resize((self.slices_written, self.n_bins))
+        self._file.attrs['slices'] = self.slices_written
+        self._file.close()
+        self._file = None
+
+
+def load_kinetic_series(filepath: str, first: int = 0, last: int = None) -> dict:
+    """
+    Reads slices of a kinetic series.
+
+    Parameters
+    ----------
+    filepath : str
+        Path of the kinetic series file
+    first : int, optional
+        Index of the first slice
+    last : int, optional
+        Index after the last slice. Default reads to the end.
+
+    Returns
+    -------
+    dict
+        'histograms' of shape (slices, bins), 'slice_times' with the start
+        of each slice in seconds, 'time_bins' if stored, and the metadata
+    """
+    with h5py.File(filepath, 'r') as file:
+        group = file[KINETIC_GROUP]
+        histograms = group['histograms'][first:last]
+        result = dict(group.attrs)
+        result['histograms'] = histograms
+        result['slice_times'] = (first + np.arange(histograms.shape[0])) * result['slice_width']
+        if 'time_bins' in group:
+            result['time_bins'] = group['time_bins'][()]
+    return result
+
+
+if __name__ == '__main__':
+
+    import tempfile
+    import tracemalloc
+    from qudi.hardware.tcspc.spc_fifo import (
+        SPCFifoPhotonDecoder, simulate_fifo_records
+    )
+
+    macrotime_unit = 50e-9
+    records = simulate_fifo_records(2 ** 21, seed=0)
+    decoder = SPCFifoPhotonDecoder()
+    filepath = os.path.join(tempfile.gettempdir(), 'kinetic_series_benchmark.h5')
+
+    for batches in (10, 100):
+        tracemalloc.start()
+        start = time.perf_counter()
+        with KineticSeriesRecorder(filepath, 1e-3, macrotime_unit=macrotime_unit) as recorder:
+            for _ in range(batches):
+                recorder.update(decoder.decode(records))
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        total = records.size * batches
+        print(f'{batches} batches: {recorder.slices_written} slices of 1 ms in '
+              f'{elapsed:.2f} s ({total / elapsed:.3e} records/s), '
+              f'peak memory {peak / 2 ** 20:.1f} MiB, '
+              f'file {os.path.getsize(filepath) / 2 ** 20:.1f} MiB')
+        decoder.clear()
+
+    series = load_kinetic_series(filepath, 10, 20)
+    print(f'Slices 10 to 20 start at {series["slice_times"][0]:.3f} s, '
+          f'{series["histograms"].sum(axis=1)} photons per slice')
+    os.remove(filepath)
@@ -0,0 +1,367 @@
+"""
+Photon correlation (g2) of time tagged photon streams.
+
+The correlation is computed from the photon arrival times directly,
+without binning the photons into a time trace first. For every photon of
+channel A the photons of channel B inside the lag range are found with
+`np.searchsorted` on the sorted arrival times of B, so the cost grows as
+N log N and not as N^2.
+
+Two counting methods are used:
+
+- 'pairs': all photon pairs inside the lag range are enumerated and their
+  lags histogrammed. Fast for short lag ranges, e.g. antibunching with
+  linear bins of ~1 ns.
+- 'searchsorted': the number of photons of B before t_a + edge is counted
+  for every bin edge, and the counts per bin are the differences. The cost
+  does not depend on the number of pairs, which makes it suited for long
+  lag ranges with logarithmic (multi-tau) bins.
+
+Contains the following:
+
+- photon_timestamps(photons, microtime_ratio)
+- linear_lag_edges(max_lag, bin_width)
+- multi_tau_lag_edges(min_lag, max_lag, bins_per_octave)
+- count_pairs(t_a, t_b, edges, method)
+- PhotonCorrelator: g2 updated incrementally with batches of photons
+- correlate_photon_file(filepath, ...): g2 of a recorded photon stream
+"""
+import time
+
+import numpy as np
+
+from qudi.logic.photon_stream import get_photon_metadata, iter_photon_chunks
+
+
+def photon_timestamps(photons: np.ndarray, microtime_ratio: float = 0.0) -> np.ndarray:
+    """
+    Arrival times of decoded photons in macro time units.
+
+    The times are kept in macro time units rather than seconds, so photons
+    without micro time have integer times that are exact in float64 and
+    the comparisons with the lag bin edges do not depend on rounding.
+
+    Parameters
+    ----------
+    photons : np.ndarray
+        Photons with `PHOTON_DTYPE`
+    microtime_ratio : float, optional
+        Width of one ADC bin in macro time units. When the macro time clock
+        is the SYNC signal, adding the micro time gives the arrival time
+        with the resolution of the TAC.
+
+    Returns
+    -------
+    np.ndarray
+        float64 arrival times
+    """
+    timestamps = photons['macrotime'].astype(np.float64)
+    if microtime_ratio:
+        timestamps += photons['microtime'] * microtime_ratio
+    return timestamps
+
+
+def linear_lag_edges(max_lag: float, bin_width: float) -> np.ndarray:
+    """
+    Equally spaced lag bin edges from -max_lag to max_lag, with one bin
+    centred on zero lag.
+    """
+    n = int(np.ceil(max_lag / bin_width - 0.5))
+    return (np.arange(-n, n + 2) - 0.5) * bin_width
+
+
+def multi_tau_lag_edges(min_lag: float, max_lag: float,
+                        bins_per_octave: int = 8) -> np.ndarray:
+    """
+    Positive lag bin edges with a width that doubles every
+    `bins_per_octave` bins, like a multi tau correlator.
+    """
+    edges = [0.0]
+    width = min_lag
+    while edges[-1] < max_lag:
+        for _ in range(bins_per_octave):
+            edges.append(edges[-1] + width)
+        width *= 2
+    return np.array(edges)
+
+
+def _pair_counts(t_a, t_b, edges):
+
+    left = np.searchsorted(t_b, t_a + edges[0], side='left')
+    right = np.searchsorted(t_b, t_a + edges[-1], side='left')
+    n_partners = right - left
+    total = int(n_partners.sum())
+    counts = np.zeros(edges.size - 1, dtype=np.int64)
+    if total == 0:
+        return counts
+    # Index of every partner in t_b and of the photon of t_a it belongs to
+    owner = np.repeat(np.arange(t_a.size), n_partners)
+    offsets = np.arange(total) - np.repeat(np.cumsum(n_partners) - n_partners, n_partners)
+    lags = t_b[left[owner] + offsets] - t_a[owner]
+    bins = np.searchsorted(edges, lags, side='right') - 1
+    return np.bincount(bins[(bins >= 0) & (bins < counts.size)],
+                       minlength=counts.size)
+
+
+def _edge_counts(t_a, t_b, edges):
+
+    cumulative = np.empty(edges.size, dtype=np.int64)
+    for i, edge in enumerate(edges):
+        cumulative[i] = np.searchsorted(t_b, t_a + edge, side='left').sum()
+    return np.diff(cumulative)
+
+
+def count_pairs(t_a: np.ndarray, t_b: np.ndarray, edges: np.ndarray,
+                method: str = 'auto') -> np.ndarray:
+    """
+    Counts the photon pairs per lag bin, with lag = t_b - t_a and bins
+    [edges[k], edges[k + 1]).
+
+    Parameters
+    ----------
+    t_a, t_b : np.ndarray
+        Sorted arrival times of the two channels
+    edges : np.ndarray
+        Increasing lag bin edges
+    method : str, optional
+        'pairs', 'searchsorted' or 'auto', which picks the method with the
+        smaller expected cost
+
+    Returns
+    -------
+    np.ndarray
+        Number of pairs per lag bin
+    """
+    if t_a.size == 0 or t_b.size == 0:
+        return np.zeros(edges.size - 1, dtype=np.int64)
+    if method == 'auto':
+        duration = max(t_b[-1] - t_b[0], edges[-1] - edges[0])
+        expected_pairs = t_a.size * t_b.size * (edges[-1] - edges[0]) / duration
+        method = 'pairs' if expected_pairs < t_a.size * edges.size else 'searchsorted'
+    if method == 'pairs':
+        return _pair_counts(t_a, t_b, edges)
+    return _edge_counts(t_a, t_b, edges)
+
+
+class PhotonCorrelator:
+    """
+    Cross correlation of two routing channels, updated with every batch of
+    decoded photons.
+
+    The photons of a stream arrive in time order, so a pair is counted
+    when its later photon arrives: the new photons of A are correlated
+    with the new photons of B and the kept tail of old ones, and the tail
+    of old photons of A is correlated with the new photons of B. Only the
+    photons within the lag range of the last photon are kept, so the
+    memory does not grow with the measurement time.
+
+    Parameters
+    ----------
+    edges : np.ndarray
+        Lag bin edges in seconds, see `linear_lag_edges` and
+        `multi_tau_lag_edges`
+    channel_a, channel_b : int, optional
+        Routing channels of the start and stop detectors. The same channel
+        gives the autocorrelation, without the zero lag pairs of a photon
+        with itself.
+    macrotime_unit : float, optional
+        Macro time clock period in seconds
+    microtime_unit : float, optional
+        Width of one ADC bin in seconds. 0 uses the macro time only, see
+        `photon_timestamps`.
+    method : str, optional
+        Counting method passed to `count_pairs`
+
+    Attributes
+    ----------
+    counts : np.ndarray
+        Number of pairs per lag bin
+    photons_a, photons_b : int
+        Number of photons in each channel
+    """
+
+    def __init__(self, edges: np.ndarray, channel_a: int = 0, channel_b: int = 1,
+                 macrotime_unit: float = 50e-9, microtime_unit: float = 0.0,
+                 method: str = 'auto') -> None:
+
+        self.edges = np.asarray(edges, dtype=float)
+        self.channel_a = channel_a
+        self.channel_b = channel_b
+        self.macrotime_unit = macrotime_unit
+        self.microtime_unit = microtime_unit
+        self.method = method
+        self._microtime_ratio = microtime_unit / macrotime_unit
+        # All times are handled in macro time units. The edges are rounded
+        # so that edges on a whole number of ticks are exact, otherwise
+        # t_a + edge and t_b - t_a may round to different sides of a tie.
+        self._edges = np.round(self.edges / macrotime_unit, 6)
+        self._max_lag = max(abs(self._edges[0]), abs(self._edges[-1]))
+        self._zero_bin = np.searchsorted(self.edges, 0.0, side='right') - 1
+        self.clear()
+
+    def clear(self) -> None:
+
+        self.counts = np.zeros(self.edges.size - 1, dtype=np.int64)
+        self.photons_a = 0
+        self.photons_b = 0
+        self.first_time = None
+        self.last_time = None
+        self._tail_a = np.zeros(0)
+        self._tail_b = np.zeros(0)
+
+    @property
+    def lags(self) -> np.ndarray:
+        """
+        Centre of each lag bin.
+        """
+        return (self.edges[:-1] + self.edges[1:]) / 2
+
+    def update(self, photons: np.ndarray) -> None:
+        """
+        Adds a batch of decoded photons.
+
+        Parameters
+        ----------
+        photons : np.ndarray
+            Photons with `PHOTON_DTYPE`, later than all previous batches
+        """
+        if photons.size == 0:
+            return
+        timestamps = photon_timestamps(photons, self._microtime_ratio)
+        new_a = timestamps[photons['channel'] == self.channel_a]
+        if self.channel_b == self.channel_a:
+            new_b = new_a
+        else:
+            new_b = timestamps[photons['channel'] == self.channel_b]
+        if self._microtime_ratio:
+            # The micro time can reorder photons within one macro time tick
+            new_a = np.sort(new_a)
+            new_b = new_a if self.channel_b == self.channel_a else np.sort(new_b)
+
+        all_b = np.concatenate((self._tail_b, new_b))
+        self.counts += count_pairs(new_a, all_b, self._edges, self.method)
+        self.counts += count_pairs(self._tail_a, new_b, self._edges, self.method)
+        if self.channel_b == self.channel_a and 0 <= self._zero_bin < self.counts.size:
+            self.counts[self._zero_bin] -= new_a.size
+
+        self.photons_a += new_a.size
+        self.photons_b += new_b.size
+        if self.first_time is None:
+            self.first_time = timestamps.min()
+        self.last_time = timestamps.max()
+        cutoff = self.last_time - self._max_lag
+        tail_a = np.concatenate((self._tail_a, new_a))
+        self._tail_a = tail_a[np.searchsorted(tail_a, cutoff):]
+        self._tail_b = all_b[np.searchsorted(all_b, cutoff):]
+
+    @property
+    def duration(self) -> float:
+        """
+        Time between the first and the last photon in seconds.
+        """
+        if self.first_time is None:
+            return 0.0
+        return (self.last_time - self.first_time) * self.macrotime_unit
+
+    @property
+    def g2(self) -> np.ndarray:
+        """
+        Normalised correlation, 1 for uncorrelated photons.
+        """
+        expected = self.photons_a * self.photons_b * np.diff(self.edges)
+        duration = self.duration
+        if duration <= 0 or not np.all(expected > 0):
+            return np.full(self.counts.size, np.nan)
+        return self.counts * duration / expected
+
+
+def correlate_photon_file(filepath: str, edges: np.ndarray, channel_a: int = 0,
+                          channel_b: int = 1, microtime_unit: float = 0.0,
+                          chunk_size: int = 2 ** 22,
+                          verbose: bool = False) -> PhotonCorrelator:
+    """
+    Computes the g2 of a recorded photon stream.
+
+    The file is read in blocks with the same incremental correlator that
+    is used during the measurement, so files larger than the RAM can be
+    processed.
+
+    Parameters
+    ----------
+    filepath : str
+        Path of the photon stream file
+    edges : np.ndarray
+        Lag bin edges in seconds
+    channel_a, channel_b : int, optional
+        Routing channels to correlate
+    microtime_unit : float, optional
+        Width of one ADC bin in seconds
+    chunk_size : int, optional
+        Number of photons read at once
+    verbose : bool, optional
+        Prints the throughput
+
+    Returns
+    -------
+    PhotonCorrelator
+        Correlator with the counts of the whole file
+    """
+    metadata = get_photon_metadata(filepath)
+    correlator = PhotonCorrelator(
+        edges, channel_a, channel_b,
+        macrotime_unit=metadata.get('macrotime_unit', 50e-9),
+        microtime_unit=microtime_unit
+    )
+    start = time.perf_counter()
+    photons = 0
+    for chunk in iter_photon_chunks(filepath, chunk_size):
+        correlator.update(chunk)
+        photons += chunk.size
+    elapsed = time.perf_counter() - start
+    if verbose:
+        print(f'Correlated {photons} photons in {elapsed:.2f} s: '
+              f'{photons / elapsed:.3e} photons/s')
+    return correlator
+
+
+if __name__ == '__main__':
+
+    from qudi.hardware.tcspc.spc_fifo import PHOTON_DTYPE
+
+    # Poissonian photons of two detectors behind a beam splitter, with a
+    # dead interval after every photon of the source to create a dip
+    rng = np.random.default_rng(0)
+    n = 2 * 10 ** 6
+    rate = 2e5
+    macrotime_unit = 1e-9
+    intervals = rng.exponential(1 / rate, n) + 20e-9
+    photons = np.zeros(n, dtype=PHOTON_DTYPE)
+    photons['macrotime'] = np.cumsum(intervals) / macrotime_unit
+    photons['channel'] = rng.integers(0, 2, n)
+
+    edges = linear_lag_edges(200e-9, 2e-9)
+    correlator = PhotonCorrelator(edges, macrotime_unit=macrotime_unit)
+    start = time.perf_counter()
+    for batch in np.array_split(photons, 50):
+        correlator.update(batch)
+    elapsed = time.perf_counter() - start
+    g2 = correlator.g2
+    print(f'Linear g2 of {n} photons in 50 batches: {elapsed:.2f} s, '
+          f'{n / elapsed:.3e} photons/s')
+    print(f'g2(0) = {g2[correlator._zero_bin]:.3f}, g2(150 ns) = {g2[-10]:.3f}')
+
+    reference = count_pairs(
+        photon_timestamps(photons[photons['channel'] == 0]),
+        photon_timestamps(photons[photons['channel'] == 1]),
+        correlator._edges, 'searchsorted'
+    )
+    print('Incremental counts match single pass:', np.array_equal(reference, correlator.counts))
+
+    edges = multi_tau_lag_edges(10e-9, 1e-2)
+    correlator = PhotonCorrelator(edges, 0, 0, macrotime_unit=macrotime_unit)
+    start = time.perf_counter()
+    for batch in np.array_split(photons, 50):
+        correlator.update(batch)
+    elapsed = time.perf_counter() - start
+    print(f'Multi tau autocorrelation with {edges.size - 1} bins up to 10 ms: '
+          f'{elapsed:.2f} s, {n / elapsed:.3e} photons/s')
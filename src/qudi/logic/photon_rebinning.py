@@ -0,0 +1,291 @@
+"""
+Offline re-histogramming of recorded photon streams.
+
+Builds lifetime histograms from the photon stream files written by
+`PhotonStreamRecorder` with a different bin width, micro time gate,
+macro time window or channel selection than the one used while
+measuring. The file is read in blocks, so files larger than the RAM can
+be processed, and the blocks are distributed over a process pool.
+
+Contains the following:
+
+- RebinSettings: bins and gates of the histogram
+- histogram_photons(photons, settings): histogram of one block of photons
+- rebin_photon_stream(filepath, settings, ...): histogram of a whole file
+- get_time_bins(filepath, settings): time axis of the histogram
+"""
+import dataclasses
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+
+from qudi.hardware.tcspc.spc_fifo import ADC_MASK
+from qudi.logic.photon_stream import (
+    PHOTON_GROUP, get_photon_metadata, iter_photon_chunks
+)
+
+
+@dataclasses.dataclass
+class RebinSettings:
+    """
+    Bins and gates of a re-binned histogram.
+
+    Attributes
+    ----------
+    bin_width : int
+        Number of ADC bins merged into one histogram bin
+    microtime_gate : tuple
+        (first, last) ADC bin included in the histogram, last excluded
+    macrotime_window : tuple
+        (start, stop) macro time window in macro time units. None leaves
+        that side open.
+    channels : tuple
+        Routing channels to include. None includes all channels.
+    slice_width : int
+        If set, the macro time window is split into consecutive slices of
+        this many macro time units and one histogram is built per slice.
+    """
+
+    bin_width: int = 1
+    microtime_gate: tuple = (0, ADC_MASK + 1)
+    macrotime_window: tuple = (None, None)
+    channels: tuple = None
+    slice_width: int = None
+
+    @property
+    def n_bins(self) -> int:
+        first, last = self.microtime_gate
+        return -(-(last - first) // self.bin_width)
+
+
+def histogram_photons(photons: np.ndarray, settings: RebinSettings,
+                      slice_origin: int = 0, n_slices: int = 1) -> np.ndarray:
+    """
+    Histograms one block of photons.
+
+    Rejected photons are not removed from the block, their bin index is
+    set to a sentinel bin after the last one that is dropped at the end,
+    so the gates cost one comparison per photon and no compaction.
+
+    Parameters
+    ----------
+    photons : np.ndarray
+        Photons with `PHOTON_DTYPE`
+    settings : RebinSettings
+        Bins and gates of the histogram
+    slice_origin : int, optional
+        Macro time at which the first slice starts
+    n_slices : int, optional
+        Number of slices, only used when `settings.slice_width` is set
+
+    Returns
+    -------
+    np.ndarray
+        Histogram of shape (n_bins,), or (n_slices, n_bins) when
+        `settings.slice_width` is set
+    """
+    n_bins = settings.n_bins
+    first, last = settings.microtime_gate
+    microtime = photons['microtime'].astype(np.intp)
+    rejected = (microtime < first) | (microtime >= last)
+    bins = microtime
+    bins -= first
+    if settings.bin_width > 1:
+        bins //= settings.bin_width
+
+    if settings.channels is not None:
+        rejected |= ~np.isin(photons['channel'], settings.channels)
+
+    macrotime = photons['macrotime']
+    start, stop = settings.macrotime_window
+    if start is not None:
+        rejected |= macrotime < start
+    if stop is not None:
+        rejected |= macrotime >= stop
+
+    if settings.slice_width is None:
+        n_slices = 1
+    else:
+        slices = ((macrotime - np.uint64(slice_origin))
+                  // np.uint64(settings.slice_width)).astype(np.intp)
+        rejected |= slices >= n_slices
+        bins += slices * n_bins
+
+    total = n_slices * n_bins
+    bins[rejected] = total
+    histogram = np.bincount(bins, minlength=total + 1)[:total]
+    if settings.slice_width is None:
+        return histogram
+    return histogram.reshape(n_slices, n_bins)
+
+
+def _find_photon_index(dataset, value: int) -> int:
+    """
+    Index of the first photon with a macro time >= value, found by a
+    binary search on the sorted macrotime dataset.
+    """
+    low, high = 0, dataset.shape[0]
+    while low < high:
+        middle = (low + high) // 2
+        if dataset[middle] < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _photon_range(filepath: str, settings: RebinSettings) -> tuple:
+    """
+    Index range of the photons inside the macro time window and the
+    origin of the first slice.
+    """
+    with h5py.File(filepath, 'r') as file:
+        macrotime = file[PHOTON_GROUP]['macrotime']
+        total = macrotime.shape[0]
+        start, stop = settings.macrotime_window
+        first = 0 if start is None else _find_photon_index(macrotime, start)
+        last = total if stop is None else _find_photon_index(macrotime, stop)
+        if start is not None:
+            origin = start
+        elif total:
+            origin = int(macrotime[0])
+        else:
+            origin = 0
+        end = stop if stop is not None else (int(macrotime[-1]) + 1 if total else origin)
+    return first, last, origin, end
+
+
+def _rebin_range(filepath: str, settings: RebinSettings, start: int, stop: int,
+                 read_size: int, slice_origin: int, n_slices: int) -> np.ndarray:
+    """
+    Histogram of the photons [start, stop) of a file. Runs in the worker
+    processes, so the file is opened here.
+    """
+    shape = (settings.n_bins,) if settings.slice_width is None else (n_slices, settings.n_bins)
+    histogram = np.zeros(shape, dtype=np.int64)
+    for photons in iter_photon_chunks(filepath, read_size, start, stop):
+        histogram += histogram_photons(photons, settings, slice_origin, n_slices)
+    return histogram
+
+
+def rebin_photon_stream(filepath: str, settings: RebinSettings = None,
+                        read_size: int = 2 ** 22, workers: int = None,
+                        verbose: bool = False) -> tuple:
+    """
+    Builds the histogram of a photon stream file in a single pass.
+
+    Only the photons inside the macro time window are read. They are split
+    into ranges of `read_size` photons, each range is histogrammed by one
+    process of a pool and the partial histograms are summed.
+
+    Parameters
+    ----------
+    filepath : str
+        Path of the photon stream file
+    settings : RebinSettings, optional
+        Bins and gates of the histogram
+    read_size : int, optional
+        Number of photons read from the file at once, per process
+    workers : int, optional
+        Number of processes. 1 processes the file in this process, None
+        uses all cores.
+    verbose : bool, optional
+        Prints the throughput
+
+    Returns
+    -------
+    tuple
+        (histogram, stats) where stats is a dict with the number of
+        photons read, the elapsed time and the throughput in photons/s
+    """
+    settings = RebinSettings() if settings is None else settings
+    start_time = time.perf_counter()
+
+    first, last, origin, end = _photon_range(filepath, settings)
+    n_slices = 1
+    if settings.slice_width is not None:
+        n_slices = max(1, -(-(end - origin) // settings.slice_width))
+
+    ranges = [(start, min(start + read_size, last))
+              for start in range(first, last, read_size)]
+    if workers is None:
+        workers = os.cpu_count()
+    workers = max(1, min(workers, len(ranges)))
+
+    shape = (settings.n_bins,) if settings.slice_width is None else (n_slices, settings.n_bins)
+    histogram = np.zeros(shape, dtype=np.int64)
+    if workers == 1:
+        for start, stop in ranges:
+            histogram += _rebin_range(
+                filepath, settings, start, stop, read_size, origin, n_slices
+            )
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(
+                _rebin_range, filepath, settings, start, stop, read_size,
+                origin, n_slices
+            ) for start, stop in ranges]
+            for future in futures:
+                histogram += future.result()
+
+    elapsed = time.perf_counter() - start_time
+    photons = last - first
+    stats = {
+        'photons': photons,
+        'elapsed': elapsed,
+        'throughput': photons / elapsed if elapsed > 0 else 0.0,
+        'workers': workers,
+        'slice_origin': origin,
+    }
+    if verbose:
+        print(f'Rebinned {photons} photons in {elapsed:.2f} s with {workers} '
+              f'processes: {stats["throughput"]:.3e} photons/s')
+    return histogram, stats
+
+
+def get_time_bins(filepath: str, settings: RebinSettings = None) -> np.ndarray:
+    """
+    Returns the start time of each bin of a re-binned histogram.
+
+    The ADC bin width is computed from the TAC range and gain stored with
+    the photon stream like in `TCSPCLogic`. Without these parameters the
+    time axis is given in ADC bins.
+    """
+    settings = RebinSettings() if settings is None else settings
+    metadata = get_photon_metadata(filepath)
+    if 'tac_range' in metadata and 'tac_gain' in metadata:
+        time_conversion = metadata['tac_range'] / ((ADC_MASK + 1) * metadata['tac_gain'])
+    else:
+        time_conversion = 1
+    first = settings.microtime_gate[0]
+    return (first + np.arange(settings.n_bins) * settings.bin_width) * time_conversion
+
+
+if __name__ == '__main__':
+
+    import tempfile
+    from qudi.hardware.tcspc.spc_fifo import (
+        SPCFifoPhotonDecoder, simulate_fifo_records
+    )
+    from qudi.logic.photon_stream import PhotonStreamRecorder
+
+    filepath = os.path.join(tempfile.gettempdir(), 'photon_rebinning_benchmark.h5')
+    decoder = SPCFifoPhotonDecoder()
+    records = simulate_fifo_records(2 ** 22, seed=0)
+    with PhotonStreamRecorder(filepath, {'tac_range': 50.0, 'tac_gain': 1}) as recorder:
+        for _ in range(8):
+            recorder.append(decoder.decode(records))
+    print(f'{recorder.photons_written} photons in the test file')
+
+    settings = RebinSettings(bin_width=16, microtime_gate=(100, 4000), channels=(0,))
+    serial, _ = rebin_photon_stream(filepath, settings, workers=1, verbose=True)
+    parallel, _ = rebin_photon_stream(filepath, settings, verbose=True)
+    print('Serial and parallel histograms match:', np.array_equal(serial, parallel))
+
+    settings = RebinSettings(bin_width=64, slice_width=decoder.last_macrotime // 100)
+    slices, stats = rebin_photon_stream(filepath, settings, verbose=True)
+    print(f'{slices.shape[0]} time slices of {slices.shape[1]} bins')
+    os.remove(filepath)
@@ -0,0 +1,230 @@
+"""
+Streaming storage of time tagged photons (TTTR) in HDF5 files.
+
+The photons decoded from the SPC FIFO are appended to chunked, compressed
+datasets while the measurement runs. Only one chunk of photons is kept in
+memory, so the length of a recording is limited by the disk and not by
+the RAM.
+
+File layout:
+
+    /                   attrs: timestamp, notes
+    /Photons            attrs: measurement parameters
+    /Photons/macrotime  uint64, absolute macro time in macro time units
+    /Photons/microtime  uint16, micro time in ADC bins
+    /Photons/channel    uint8, routing channel
+
+Contains the following:
+
+- PhotonStreamRecorder: appends photons to a file while measuring
+- get_photon_count(filepath)
+- get_photon_metadata(filepath)
+- iter_photon_chunks(filepath, chunk_size, start, stop)
+"""
+import datetime
+import os
+import time
+
+import h5py
+import numpy as np
+
+from qudi.hardware.tcspc.spc_fifo import PHOTON_DTYPE
+
+
+PHOTON_GROUP = 'Photons'
+
+
+class PhotonStreamRecorder:
+    """
+    Appends time tagged photons to an HDF5 file.
+
+    Incoming photons are copied into a buffer of `chunk_size` photons which
+    is written to the file every time it is full, so every write covers
+    exactly one HDF5 chunk.
+
+    Parameters
+    ----------
+    filepath : str
+        Path of the file to create
+    metadata : dict, optional
+        Measurement parameters stored as attributes of the photon group
+    chunk_size : int, optional
+        Number of photons per HDF5 chunk
+    compression : str, optional
+        HDF5 compression filter. 'lzf' is fast enough to keep up with the
+        FIFO, 'gzip' gives smaller files.
+
+    Attributes
+    ----------
+    photons_written : int
+        Number of photons appended so far
+    """
+
+    def __init__(self, filepath: str, metadata: dict = None,
+                 chunk_size: int = 2 ** 20, compression: str = 'lzf') -> None:
+
+        directory = os.path.dirname(filepath)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.filepath = filepath
+        self.chunk_size = chunk_size
+        self.photons_written = 0
+        self._buffer = np.zeros(chunk_size, dtype=PHOTON_DTYPE)
+        self._buffered = 0
+        self._stored = 0
+
+        self._file = h5py.File(filepath, 'w')
+        self._file.attrs.update({
+            'timestamp': datetime.datetime.now().isoformat(),
+            'notes': 'Time tagged photon stream',
+        })
+        group = self._file.create_group(PHOTON_GROUP)
+        group.attrs.update(metadata if metadata is not None else {})
+        self._datasets = {}
+        for name in PHOTON_DTYPE.names:
+            self._datasets[name] = group.create_dataset(
+                name,
+                shape=(0,),
+                maxshape=(None,),
+                dtype=PHOTON_DTYPE[name],
+                chunks=(chunk_size,),
+                compression=compression,
+                shuffle=True
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def is_open(self) -> bool:
+        return self._file is not None
+
+    def append(self, photons: np.ndarray) -> None:
+        """
+        Appends photons to the file.
+
+        Parameters
+        ----------
+        photons : np.ndarray
+            Photons with `PHOTON_DTYPE`
+        """
+        position = 0
+        total = photons.size
+        while position < total:
+            n = min(self.chunk_size - self._buffered, total - position)
+            self._buffer[self._buffered:self._buffered + n] = photons[position:position + n]
+            self._buffered += n
+            position += n
+            if self._buffered == self.chunk_size:
+                self._write_buffer()
+        self.photons_written += total
+
+    def _write_buffer(self) -> None:
+
+        n = self._buffered
+        if n == 0:
+            return
+        end = self._stored + n
+        for name, dataset in self._datasets.items():
+            dataset.resize((end,))
+            dataset[self._stored:end] = self._buffer[name][:n]
+        self._stored = end
+        self._buffered = 0
+
+    def flush(self) -> None:
+        """
+        Writes the buffered photons and flushes the file to disk.
+        """
+        self._write_buffer()
+        self._file.flush()
+
+    def close(self) -> None:
+        """
+        Writes the remaining photons and closes the file.
+        """
+        if self._file is None:
+            return
+        self._write_buffer()
+        self._file.attrs['photons'] = self._stored
+        self._file.close()
+        self._file = None
+
+
+def get_photon_count(filepath: str) -> int:
+    """
+    Returns the number of photons stored in a photon stream file.
+    """
+    with h5py.File(filepath, 'r') as file:
+        return file[PHOTON_GROUP]['macrotime'].shape[0]
+
+
+def get_photon_metadata(filepath: str) -> dict:
+    """
+    Returns the measurement parameters stored with a photon stream.
+    """
+    with h5py.File(filepath, 'r') as file:
+        return dict(file[PHOTON_GROUP].attrs)
+
+
+def iter_photon_chunks(filepath: str, chunk_size: int = 2 ** 22,
+                       start: int = 0, stop: int = None):
+    """
+    Iterates over the photons of a file in blocks.
+
+    Parameters
+    ----------
+    filepath : str
+        Path of the photon stream file
+    chunk_size : int, optional
+        Number of photons per block
+    start : int, optional
+        Index of the first photon to read
+    stop : int, optional
+        Index after the last photon to read. Default reads to the end.
+
+    Yields
+    ------
+    np.ndarray
+        Photons with `PHOTON_DTYPE`
+    """
+    with h5py.File(filepath, 'r') as file:
+        group = file[PHOTON_GROUP]
+        total = group['macrotime'].shape[0]
+        stop = total if stop is None else min(stop, total)
+        for first in range(start, stop, chunk_size):
+            last = min(first + chunk_size, stop)
+            photons = np.empty(last - first, dtype=PHOTON_DTYPE)
+            for name in PHOTON_DTYPE.names:
+                photons[name] = group[name][first:last]
+            yield photons
+
+
+if __name__ == '__main__':
+
+    import tempfile
+    from qudi.hardware.tcspc.spc_fifo import (
+        SPCFifoPhotonDecoder, simulate_fifo_records
+    )
+
+    batch_size = 2 ** 21
+    batches = 10
+    records = simulate_fifo_records(batch_size, seed=0)
+    decoder = SPCFifoPhotonDecoder()
+    filepath = os.path.join(tempfile.gettempdir(), 'photon_stream_benchmark.h5')
+
+    start = time.perf_counter()
+    with PhotonStreamRecorder(filepath) as recorder:
+        for _ in range(batches):
+            recorder.append(decoder.decode(records))
+    elapsed = time.perf_counter() - start
+
+    total = batch_size * batches
+    print(f'Decoded and recorded {recorder.photons_written} photons from '
+          f'{total} records in {elapsed:.2f} s: {total / elapsed:.3e} records/s')
+    print(f'File size: {os.path.getsize(filepath) / 2 ** 20:.1f} MiB '
+          f'({os.path.getsize(filepath) / recorder.photons_written:.2f} bytes/photon)')
+    os.remove(filepath)
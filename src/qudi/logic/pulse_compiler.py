@@ -0,0 +1,1251 @@
+"""
+Compilation of the pulsed ESR sequences.
+
+Two pulses of a channel that overlap or touch become one pulse spanning
+both. `merge_pulses` merges a whole table of pulses at once.
+
+The width and start time of a pulse can vary with the iteration, given as
+an expression of W (width), S (start time) and i (iteration, starting at
+1). The expression is parsed once, checked to only contain arithmetic and
+a few math functions, and evaluated with NumPy for all iterations at once.
+
+All pulses of an experiment are stored in one structured array with one
+row per pulse, `PULSE_DTYPE`, instead of a Python object per pulse. The
+rows are sorted by iteration, channel and start, so the pulses of one
+iteration (variation) are a contiguous slice, and the overlapping pulses
+of every channel and iteration are merged with a few vectorized passes.
+
+For the PulseBlaster the pulses of all channels of an iteration are
+flattened into states: intervals in which the set of channels that are on
+does not change, with the channels OR-ed into one bit mask. The states
+are compiled into a table of PulseBlaster instructions, and
+`PulseProgramCache` only uploads a program if it differs from the one on
+the board, identified by a hash of the instruction table.
+
+Contains the following:
+
+- PULSE_DTYPE: NumPy dtype of one pulse
+- SweepExpression: parsed width or start time expression
+- sweep_pulse(...): start times and widths of a pulse for all iterations
+- merge_pulses(pulses): sorts pulses and merges overlapping pulses
+- PulseTable: pulses of a whole experiment
+- STATE_DTYPE: NumPy dtype of one output state
+- flatten_pulses(starts, ends, channels): states of the PulseBlaster outputs
+- INSTRUCTION_DTYPE: NumPy dtype of one PulseBlaster instruction
+- PulseProgramCache: uploads programs that are not on the board yet
+- StateBlock, RepeatBlock, SequenceBlock: structure of a whole experiment
+- variation_loop_block(...), experiment_loop_block(...): blocks of the
+  two experiment types
+- factor_repeat(block): nested repeats that fit the loop counters
+- chunked_uploads(...): uploads of an experiment split into chunks
+- ProgramCompiler: compiles a block into one program with nested loops
+  and subroutines
+- run_program(instructions): executes a program like the PulseBlaster
+- wait_for_stop(api, duration): waits for the end of a program
+"""
+import ast
+import collections
+import dataclasses
+import functools
+import hashlib
+import time
+import types
+
+import numpy as np
+
+
+class SweepExpression:
+    """
+    Width or start time expression of a swept pulse, evaluated with NumPy.
+
+    Only numbers, the variables W, S and i, the constants pi and e, the
+    operators + - * / // % ** and the functions in `FUNCTIONS`, also
+    written as np.<function>, are accepted, so the expression cannot run
+    arbitrary code like `eval` could.
+
+    Parameters
+    ----------
+    expression : str
+        Expression, e.g. 'W + 0.5 * i'
+
+    Raises
+    ------
+    ValueError
+        If the expression is not valid or contains anything else
+    """
+
+    VARIABLES = ('W', 'S', 'i')
+    CONSTANTS = {'pi': np.pi, 'e': np.e}
+    FUNCTIONS = {
+        name: getattr(np, name) for name in (
+            'sqrt', 'exp', 'log', 'log2', 'log10', 'sin', 'cos', 'tan',
+            'abs', 'floor', 'ceil', 'round', 'minimum', 'maximum'
+        )
+    }
+    OPERATORS = (
+        ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+        ast.UAdd, ast.USub
+    )
+
+    def __init__(self, expression: str) -> None:
+
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f'Invalid expression {expression!r}: {e.msg}') from None
+        for node in ast.walk(tree):
+            self._check_node(node)
+        self._code = compile(tree, '<sweep expression>', 'eval')
+        self._namespace = {'__builtins__': {}}
+        self._namespace.update(self.CONSTANTS)
+        self._namespace.update(self.FUNCTIONS)
+        self._namespace['np'] = self._namespace['numpy'] = types.SimpleNamespace(**self.FUNCTIONS)
+
+    def _check_node(self, node) -> None:
+
+        if isinstance(node, (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Load) + self.OPERATORS):
+            return
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return
+        if isinstance(node, ast.Name) and (
+                node.id in self.VARIABLES or node.id in self.CONSTANTS
+                or node.id in self.FUNCTIONS or node.id in ('np', 'numpy')):
+            return
+        if isinstance(node, ast.Attribute) and node.attr in self.FUNCTIONS \
+                and isinstance(node.value, ast.Name) and node.value.id in ('np', 'numpy'):
+            return
+        if isinstance(node, ast.Call) and not node.keywords and (
+                isinstance(node.func, ast.Attribute)
+                or isinstance(node.func, ast.Name) and node.func.id in self.FUNCTIONS):
+            return
+        raise ValueError(
+            f'{type(node).__name__} is not allowed in the expression {self.expression!r}'
+        )
+
+    def __call__(self, i: np.ndarray, W=0, S=0) -> np.ndarray:
+        """
+        Evaluates the expression for all iterations.
+
+        Parameters
+        ----------
+        i : np.ndarray
+            Iterations, starting at 1
+        W, S : float, optional
+            Width and start time of the pulse
+
+        Returns
+        -------
+        np.ndarray
+            Value for every iteration, same shape as `i`
+        """
+        namespace = dict(self._namespace, W=W, S=S, i=i)
+        try:
+            with np.errstate(all='raise'):
+                values = eval(self._code, namespace)
+        except (ArithmeticError, TypeError, ValueError) as e:
+            raise ValueError(f'Cannot evaluate {self.expression!r}: {e}') from None
+        values = np.asarray(values)
+        if not np.issubdtype(values.dtype, np.number) or not np.all(np.isfinite(values)):
+            raise ValueError(f'{self.expression!r} does not give finite numbers')
+        return np.broadcast_to(values, np.shape(i))
+
+
+@functools.lru_cache(maxsize=64)
+def parse_sweep_expression(expression: str) -> SweepExpression:
+    """
+    Returns the `SweepExpression` of a string, parsing every expression
+    only once.
+    """
+    return SweepExpression(expression)
+
+
+def sweep_pulse(start_time, width, function_width: str = '', function_start: str = '',
+                iteration_range=(1, 1)) -> tuple:
+    """
+    Start times and widths of a pulse for every iteration of a sweep.
+
+    Parameters
+    ----------
+    start_time, width : float
+        Start time and width of the pulse, S and W in the expressions
+    function_width, function_start : str, optional
+        Expressions of the width and the start time, see
+        `SweepExpression`. An empty string keeps the value constant.
+    iteration_range : sequence, optional
+        First and last iteration, both included. The first iteration has
+        i = 1 in the expressions.
+
+    Returns
+    -------
+    tuple
+        (iterations, start_times, widths) arrays
+
+    Raises
+    ------
+    ValueError
+        If an expression is invalid or cannot be evaluated
+    """
+    iterations = np.arange(iteration_range[0], iteration_range[1] + 1)
+    i = iterations - iteration_range[0] + 1
+    if function_width != '':
+        widths = parse_sweep_expression(function_width)(i, W=width, S=start_time)
+    else:
+        widths = np.full(i.shape, width)
+    if function_start != '':
+        start_times = parse_sweep_expression(function_start)(i, W=width, S=start_time)
+    else:
+        start_times = np.full(i.shape, start_time)
+    return iterations, start_times, widths
+
+
+PULSE_DTYPE = np.dtype([
+    ('iteration', np.int32),
+    ('channel', np.uint32),         # bit of the channel on the PulseBlaster
+    ('start', np.float64),          # with the delays of the channel
+    ('end', np.float64),
+    ('display_start', np.float64),  # without the delays
+    ('display_end', np.float64),
+])
+
+
+def merge_pulses(pulses: np.ndarray) -> np.ndarray:
+    """
+    Sorts pulses by iteration, channel and start and merges the pulses of
+    the same iteration and channel that overlap or touch.
+
+    Gives the same pulses as adding them one by one to a sorted list per
+    channel and iteration and merging each with the pulses it overlaps or
+    touches. The times are replaced by their rank among all times, so that
+    the running maximum of the ends restarts for every channel and
+    iteration by adding an exact integer offset per group.
+
+    Parameters
+    ----------
+    pulses : np.ndarray
+        Pulses with `PULSE_DTYPE`, in any order
+
+    Returns
+    -------
+    np.ndarray
+        Merged pulses with `PULSE_DTYPE`
+    """
+    if pulses.size == 0:
+        return np.zeros(0, dtype=PULSE_DTYPE)
+    pulses = pulses[np.lexsort((pulses['start'], pulses['channel'], pulses['iteration']))]
+
+    new_group = np.empty(pulses.size, dtype=bool)
+    new_group[0] = True
+    new_group[1:] = (np.diff(pulses['iteration']) != 0) | (np.diff(pulses['channel']) != 0)
+    offsets = (np.cumsum(new_group) - 1) * (2 * pulses.size)
+
+    _, ranks = np.unique(np.concatenate((pulses['start'], pulses['end'])), return_inverse=True)
+    ranks = ranks.reshape(2, pulses.size) + offsets
+    reach = np.maximum.accumulate(ranks[1])
+    # A pulse starts a new merged pulse if it starts after all previous
+    # pulses of its group have ended
+    new_pulse = new_group.copy()
+    new_pulse[1:] |= ranks[0][1:] > reach[:-1]
+    first = np.flatnonzero(new_pulse)
+
+    merged = pulses[first]
+    merged['end'] = np.maximum.reduceat(pulses['end'], first)
+    merged['display_start'] = np.minimum.reduceat(pulses['display_start'], first)
+    merged['display_end'] = np.maximum.reduceat(pulses['display_end'], first)
+    return merged
+
+
+class PulseTable:
+    """
+    Pulses of all channels and iterations of an experiment.
+
+    Added pulses are collected and merged with the stored ones the next
+    time the table is read.
+
+    Attributes
+    ----------
+    added : int
+        Number of pulses added
+    revision : int
+        Incremented whenever pulses are added or the table is cleared, so
+        anything computed from the table can tell if it is outdated
+    """
+
+    def __init__(self) -> None:
+
+        self._pulses = np.zeros(0, dtype=PULSE_DTYPE)
+        self._new = []
+        self._iterations = np.zeros(0, dtype=np.int64)
+        self.added = 0
+        self.revision = 0
+
+    def __len__(self) -> int:
+        return self.pulses.size
+
+    def clear(self) -> None:
+
+        self._pulses = np.zeros(0, dtype=PULSE_DTYPE)
+        self._new = []
+        self._iterations = np.zeros(0, dtype=np.int64)
+        self.added = 0
+        self.revision += 1
+
+    def add(self, iterations, channel: int, starts, ends, display_starts=None,
+            display_ends=None) -> None:
+        """
+        Adds pulses of one channel.
+
+        Parameters
+        ----------
+        iterations : np.ndarray
+            Iteration of every pulse
+        channel : int
+            Bit of the channel
+        starts, ends : np.ndarray
+            Pulses sent to the PulseBlaster, with the delays
+        display_starts, display_ends : np.ndarray, optional
+            Pulses without the delays. Default are `starts` and `ends`.
+        """
+        pulses = np.zeros(np.size(iterations), dtype=PULSE_DTYPE)
+        pulses['iteration'] = iterations
+        pulses['channel'] = channel
+        pulses['start'] = starts
+        pulses['end'] = ends
+        pulses['display_start'] = starts if display_starts is None else display_starts
+        pulses['display_end'] = ends if display_ends is None else display_ends
+        self._new.append(pulses)
+        self.added += pulses.size
+        self.revision += 1
+
+    @property
+    def pulses(self) -> np.ndarray:
+        """
+        Merged pulses sorted by iteration, channel and start.
+        """
+        if self._new:
+            self._pulses = merge_pulses(np.concatenate([self._pulses] + self._new))
+            self._new = []
+            # Contiguous int64 copy, searching the strided int32 field
+            # copies and casts it every time
+            self._iterations = self._pulses['iteration'].astype(np.int64)
+        return self._pulses
+
+    def get_iteration(self, iteration: int) -> np.ndarray:
+        """
+        Returns the pulses of one iteration, a view sorted by channel and
+        start.
+        """
+        pulses = self.pulses
+        first, last = np.searchsorted(self._iterations, (iteration, iteration + 1))
+        return pulses[first:last]
+
+    def get_channel(self, pulses: np.ndarray, channel: int) -> np.ndarray:
+        """
+        Returns the pulses of one channel out of the pulses of one
+        iteration.
+        """
+        first, last = np.searchsorted(pulses['channel'], (channel, channel + 1))
+        return pulses[first:last]
+
+    def get_max_end_times(self) -> tuple:
+        """
+        Returns the end of the last pulse of every iteration.
+
+        Returns
+        -------
+        tuple
+            (iterations, max_end_times) arrays, for the iterations that
+            have pulses
+        """
+        pulses = self.pulses
+        if pulses.size == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0)
+        first = np.flatnonzero(np.diff(pulses['iteration'], prepend=pulses['iteration'][0] - 1))
+        return pulses['iteration'][first], np.maximum.reduceat(pulses['end'], first)
+
+
+STATE_DTYPE = np.dtype([
+    ('start', np.float64),
+    ('duration', np.float64),
+    ('channels', np.uint32),        # bit mask of the channels that are on
+])
+
+
+def flatten_pulses(starts, ends, channels) -> np.ndarray:
+    """
+    Flattens the pulses of several channels into consecutive output states.
+
+    The pulses of one channel must not overlap, as after `merge_pulses`.
+    Every start sets the bit of its channel and every end clears it, so
+    the bit mask after each edge is the cumulative sum of +bit and -bit
+    over the edges sorted by time. The state of a time with several edges
+    is the one after its last edge, so no zero length states occur, and
+    adjacent states with the same channels are merged. The first state
+    starts at 0, with no channel on if the first pulse starts later, or
+    at the first pulse if it starts before 0.
+
+    Parameters
+    ----------
+    starts, ends : np.ndarray
+        Start and end of every pulse
+    channels : np.ndarray or int
+        Bit of the channel of every pulse
+
+    Returns
+    -------
+    np.ndarray
+        States with `STATE_DTYPE` in time order, up to the end of the
+        last pulse
+    """
+    starts = np.asarray(starts, dtype=np.float64)
+    if starts.size == 0:
+        return np.zeros(0, dtype=STATE_DTYPE)
+    bits = np.asarray(channels, dtype=np.int64)
+    if bits.ndim == 0:
+        bits = np.full(starts.shape, bits)
+    # An edge without channel at 0 starts the first state there
+    times = np.concatenate(([0.0], starts, np.asarray(ends, dtype=np.float64)))
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    masks = np.cumsum(np.concatenate(([0], bits, -bits))[order])
+
+    # Last edge of every time
+    last = np.empty(times.size, dtype=bool)
+    last[-1] = True
+    np.not_equal(times[1:], times[:-1], out=last[:-1])
+    times = times[last]
+    masks = masks[last]
+
+    # The state after the last edge has no channel on and no end
+    change = np.empty(times.size - 1, dtype=bool)
+    change[0] = True
+    np.not_equal(masks[1:-1], masks[:-2], out=change[1:])
+    change = np.flatnonzero(change)
+    states = np.zeros(change.size, dtype=STATE_DTYPE)
+    states['start'] = times[change]
+    states['duration'][:-1] = np.diff(states['start'])
+    states['duration'][-1] = times[-1] - states['start'][-1]
+    states['channels'] = masks[change]
+    return states
+
+
+# Op codes of the PulseBlaster instructions, same values as spinapi.Inst
+CONTINUE = 0
+STOP = 1
+LOOP = 2
+END_LOOP = 3
+JSR = 4
+RTS = 5
+BRANCH = 6
+LONG_DELAY = 7
+WAIT = 8
+
+# The loop counters have 20 bits, loops and subroutine calls nest 8 deep
+MAX_LOOP_COUNT = 2 ** 20 - 1
+MAX_LOOP_DEPTH = 8
+MAX_INSTRUCTIONS = 4096
+
+INSTRUCTION_DTYPE = np.dtype([
+    ('flags', np.int32),            # output bit mask
+    ('inst', np.int32),             # op code
+    ('inst_data', np.int32),        # loop count or address
+    ('length', np.float64),         # in ns
+])
+
+
+class PulseProgramCache:
+    """
+    Uploads PulseBlaster programs, skipping the upload if the program is
+    already on the board.
+
+    Programs are identified by a hash of their instruction table. The
+    instruction lists of the last `max_programs` programs are kept, so a
+    program that comes back is uploaded without converting it again, in
+    one loop over `pb_inst_pbonly`.
+
+    Parameters
+    ----------
+    api : module
+        `qudi.hardware.spinapi` or an object with the same functions
+    max_programs : int, optional
+        Number of instruction lists kept
+
+    Attributes
+    ----------
+    loaded_key : str
+        Hash of the program on the board, None if unknown
+    """
+
+    def __init__(self, api, max_programs: int = 256) -> None:
+
+        self.api = api
+        self.max_programs = max_programs
+        self.loaded_key = None
+        self._programs = collections.OrderedDict()
+        self._program_stats = {}
+        self.uploads = 0
+        self.cache_hits = 0
+        self.instructions_uploaded = 0
+        self.upload_time = 0.0
+
+    @staticmethod
+    def program_key(instructions: np.ndarray) -> str:
+        """
+        Returns the hash of an instruction table.
+        """
+        instructions = np.ascontiguousarray(instructions, dtype=INSTRUCTION_DTYPE)
+        return hashlib.blake2b(instructions.tobytes(), digest_size=16).hexdigest()
+
+    def invalidate(self) -> None:
+        """
+        Forgets the program on the board, e.g. after `pb_init` or
+        `pb_reset`.
+        """
+        self.loaded_key = None
+
+    def load(self, instructions: np.ndarray) -> bool:
+        """
+        Uploads a program unless it is already on the board.
+
+        Parameters
+        ----------
+        instructions : np.ndarray
+            Instructions with `INSTRUCTION_DTYPE`
+
+        Returns
+        -------
+        bool
+            True if the program was uploaded
+        """
+        key = self.program_key(instructions)
+        if key == self.loaded_key:
+            self.cache_hits += 1
+            return False
+        rows = self._programs.get(key)
+        if rows is None:
+            rows = instructions.tolist()
+            self._programs[key] = rows
+            if len(self._programs) > self.max_programs:
+                self._programs.popitem(last=False)
+        else:
+            self._programs.move_to_end(key)
+
+        api = self.api
+        pb_inst_pbonly = api.pb_inst_pbonly
+        start = time.perf_counter()
+        api.pb_start_programming(api.PULSE_PROGRAM)
+        for flags, inst, inst_data, length in rows:
+            pb_inst_pbonly(flags, inst, inst_data, length)
+        api.pb_stop_programming()
+        elapsed = time.perf_counter() - start
+
+        self.loaded_key = key
+        self.uploads += 1
+        self.instructions_uploaded += len(rows)
+        self.upload_time += elapsed
+        stats = self._program_stats.setdefault(
+            key, {'instructions': len(rows), 'uploads': 0, 'upload_time': 0.0}
+        )
+        stats['uploads'] += 1
+        stats['upload_time'] += elapsed
+        stats['last_upload_time'] = elapsed
+        return True
+
+    def get_stats(self) -> dict:
+        """
+        Returns the upload counters and the upload times per program.
+        """
+        return {
+            'uploads': self.uploads,
+            'cache_hits': self.cache_hits,
+            'instructions_uploaded': self.instructions_uploaded,
+            'upload_time': self.upload_time,
+            'mean_upload_time': self.upload_time / self.uploads if self.uploads else 0.0,
+            'programs': {key: dict(stats) for key, stats in self._program_stats.items()},
+        }
+
+
+@dataclasses.dataclass
+class StateBlock:
+    """
+    States played once, with `STATE_DTYPE`.
+    """
+    states: np.ndarray
+
+
+@dataclasses.dataclass
+class RepeatBlock:
+    """
+    A block played `count` times.
+    """
+    block: object
+    count: int
+
+
+@dataclasses.dataclass
+class SequenceBlock:
+    """
+    Blocks played one after the other.
+    """
+    blocks: list
+
+
+def variation_loop_block(variation_states, value_loop: int, chunk: int = None):
+    """
+    Block repeating every variation `value_loop` times before the next one
+    (experiment type 0).
+
+    With `chunk` the repetitions are done in chunks: every variation is
+    repeated `chunk` times, then the next, and all variations again until
+    `value_loop` repetitions are done.
+
+    Parameters
+    ----------
+    variation_states : list of np.ndarray
+        States of every variation
+    value_loop : int
+        Repetitions of every variation
+    chunk : int, optional
+        Repetitions of a variation before the next one is played, default
+        all of them
+
+    Returns
+    -------
+    SequenceBlock
+    """
+    if chunk is None:
+        return SequenceBlock(
+            [RepeatBlock(StateBlock(states), value_loop) for states in variation_states]
+        )
+    full_chunks, rest = divmod(value_loop, chunk)
+    blocks = []
+    for loops, count in ((chunk, full_chunks), (rest, 1)):
+        if loops > 0 and count > 0:
+            variations = SequenceBlock(
+                [RepeatBlock(StateBlock(states), loops) for states in variation_states]
+            )
+            blocks.append(RepeatBlock(variations, count))
+    return SequenceBlock(blocks)
+
+
+def experiment_loop_block(variation_states, value_loop: int):
+    """
+    Block playing all variations one after the other, `value_loop` times
+    (experiment type 1).
+
+    Parameters
+    ----------
+    variation_states : list of np.ndarray
+        States of every variation
+    value_loop : int
+        Repetitions of the whole experiment
+
+    Returns
+    -------
+    RepeatBlock
+    """
+    experiment = SequenceBlock([StateBlock(states) for states in variation_states])
+    return RepeatBlock(experiment, value_loop)
+
+
+def factor_repeat(block: RepeatBlock, max_count: int = MAX_LOOP_COUNT):
+    """
+    Splits a repeat into nested repeats that the loop counters can count.
+
+    The count is written as `inner * outer + rest`, with `outer` as small
+    as possible and `rest < outer`, and `outer` is factored again if it is
+    still too large. A count of 10 ** 9 with 20 bit counters becomes 954
+    repetitions of a loop of 1048218 plus 28 single repetitions, i.e.
+    `RepeatBlock(RepeatBlock(block, 1048218), 954)` followed by
+    `RepeatBlock(block, 28)`.
+
+    Parameters
+    ----------
+    block : RepeatBlock
+        Repeat to split
+    max_count : int, optional
+        Largest count of a loop
+
+    Returns
+    -------
+    RepeatBlock or SequenceBlock
+        The same repetitions with no count larger than `max_count`
+    """
+    if block.count <= max_count:
+        return block
+    outer = -(-block.count // max_count)
+    inner, rest = divmod(block.count, outer)
+    nested = factor_repeat(RepeatBlock(RepeatBlock(block.block, inner), outer), max_count)
+    if rest == 0:
+        return nested
+    return SequenceBlock([nested, RepeatBlock(block.block, rest)])
+
+
+def chunked_uploads(variation_sizes, value_loop: int, each_variation: bool = True,
+                    chunk: int = 10000) -> tuple:
+    """
+    Programs and instructions uploaded when the repetitions are split into
+    chunks and every chunk is a program of its own, the way experiments
+    were sent before they were compiled into one program. Gives the
+    restarts of the board, and the dead time, that one program saves.
+
+    Parameters
+    ----------
+    variation_sizes : list of int
+        Number of states of every variation
+    value_loop : int
+        Repetitions
+    each_variation : bool, optional
+        True if every variation is a program of its own (experiment type
+        0), False if the variations are played one after the other in one
+        program (type 1)
+    chunk : int, optional
+        Repetitions per program
+
+    Returns
+    -------
+    tuple
+        (programs, instructions)
+    """
+    chunks = -(-value_loop // chunk)
+    # Every program ends with a STOP, a single state is split in two
+    sizes = [max(size, 2) + 1 for size in variation_sizes]
+    if each_variation:
+        return chunks * len(sizes), chunks * sum(sizes)
+    return chunks, chunks * (sum(sizes) - len(sizes) + 1)
+
+
+def _normalize_block(block):
+    """
+    Drops empty states, sequences and repeats of zero times. Returns None
+    if nothing is left.
+    """
+    if isinstance(block, StateBlock):
+        return block if block.states.size > 0 else None
+    if isinstance(block, RepeatBlock):
+        inner = _normalize_block(block.block) if block.count > 0 else None
+        if inner is None:
+            return None
+        return inner if block.count == 1 else RepeatBlock(inner, int(block.count))
+    blocks = [_normalize_block(inner) for inner in block.blocks]
+    blocks = [inner for inner in blocks if inner is not None]
+    if not blocks:
+        return None
+    return blocks[0] if len(blocks) == 1 else SequenceBlock(blocks)
+
+
+def _peel_block(block, first: bool):
+    """
+    Returns a block playing the same states, whose first (or last) part is
+    a `StateBlock` instead of a loop, by playing one repetition of a loop
+    outside of it.
+    """
+    if isinstance(block, StateBlock):
+        return block
+    if isinstance(block, SequenceBlock):
+        blocks = list(block.blocks)
+        index = 0 if first else -1
+        blocks[index] = _peel_block(blocks[index], first)
+        return SequenceBlock(blocks)
+    once = _peel_block(block.block, first)
+    if block.count == 1:
+        return once
+    rest = RepeatBlock(block.block, block.count - 1)
+    return SequenceBlock([once, rest] if first else [rest, once])
+
+
+def expand_block(block) -> np.ndarray:
+    """
+    Returns all states played by a block one after the other, without
+    loops, e.g. to check a compiled program.
+    """
+    if isinstance(block, StateBlock):
+        return block.states
+    if isinstance(block, RepeatBlock):
+        return np.tile(expand_block(block.block), block.count)
+    if not block.blocks:
+        return np.zeros(0, dtype=STATE_DTYPE)
+    return np.concatenate([expand_block(inner) for inner in block.blocks])
+
+
+def block_duration(block) -> float:
+    """
+    Returns the time a block plays, in the time unit of the states.
+    """
+    if isinstance(block, StateBlock):
+        return float(block.states['duration'].sum())
+    if isinstance(block, RepeatBlock):
+        return block.count * block_duration(block.block)
+    return sum(block_duration(inner) for inner in block.blocks)
+
+
+class ProgramCompiler:
+    """
+    Compiles the blocks of a whole experiment into one PulseBlaster program.
+
+    A repeated block becomes a loop: its first state is the LOOP and its
+    last state the END_LOOP instruction, so the loop instructions add no
+    time. If a loop starts or ends with another loop, one repetition of
+    the inner loop is played outside of it. States of a `StateBlock` that
+    has at least `subroutine_states` states are put into a subroutine, so
+    a variation used in several loops is stored once: the block is played
+    as its first state, a JSR on its second state, and its last state, the
+    subroutine holds the states in between and returns on the last of them.
+    Identical blocks share their subroutine. Repeats with more repetitions
+    than the loop counter are split into nested loops, see `factor_repeat`.
+    The program ends with a STOP, followed by the subroutines.
+
+    Parameters
+    ----------
+    time_unit : float, optional
+        Length of one time unit of the states in ns, default µs
+    stop_length : float, optional
+        Length of the STOP instruction in ns
+    max_instructions : int, optional
+        Number of instructions the board holds
+    max_loop_count : int, optional
+        Largest count of the loop counters
+    max_loop_depth : int, optional
+        Number of loops that can be nested
+    subroutine_states : int, optional
+        Smallest number of states put into a subroutine
+    """
+
+    def __init__(self, time_unit: float = 1000.0, stop_length: float = 1000.0,
+                 max_instructions: int = MAX_INSTRUCTIONS,
+                 max_loop_count: int = MAX_LOOP_COUNT,
+                 max_loop_depth: int = MAX_LOOP_DEPTH,
+                 subroutine_states: int = 6) -> None:
+
+        self.time_unit = time_unit
+        self.stop_length = stop_length
+        self.max_instructions = max_instructions
+        self.max_loop_count = max_loop_count
+        self.max_loop_depth = max_loop_depth
+        self.subroutine_states = max(4, subroutine_states)
+        self._rows = []
+        self._subroutines = {}
+        self._calls = []
+
+    def compile(self, block) -> np.ndarray:
+        """
+        Compiles a block.
+
+        Parameters
+        ----------
+        block : StateBlock, RepeatBlock or SequenceBlock
+            What the program plays
+
+        Returns
+        -------
+        np.ndarray
+            Instructions with `INSTRUCTION_DTYPE`, starting at address 0
+
+        Raises
+        ------
+        ValueError
+            If there are no states, the loops are nested too deep or the
+            program does not fit on the board
+        """
+        block = _normalize_block(block)
+        if block is None:
+            raise ValueError('A program needs at least one state')
+        self._rows = []
+        self._subroutines = {}
+        self._calls = []
+        self._emit(block, 0)
+        rows = self._rows
+        rows.append([0, STOP, 0, self.stop_length])
+        addresses = {}
+        for key, states in self._subroutines.items():
+            addresses[key] = len(rows)
+            self._emit_states(states)
+            rows[-1][1] = RTS
+        for index, key in self._calls:
+            rows[index][2] = addresses[key]
+        if len(rows) > self.max_instructions:
+            raise ValueError(
+                f'The program needs {len(rows)} instructions, '
+                f'the board holds {self.max_instructions}'
+            )
+        program = np.array([tuple(row) for row in rows], dtype=INSTRUCTION_DTYPE)
+        self._rows = []
+        return program
+
+    def _emit_states(self, states: np.ndarray) -> None:
+
+        lengths = (states['duration'] * self.time_unit).tolist()
+        self._rows.extend(
+            [flags, CONTINUE, 0, length]
+            for flags, length in zip(states['channels'].tolist(), lengths)
+        )
+
+    def _emit(self, block, depth: int) -> None:
+
+        rows = self._rows
+        if isinstance(block, SequenceBlock):
+            for inner in block.blocks:
+                self._emit(inner, depth)
+        elif isinstance(block, StateBlock):
+            states = block.states
+            if states.size < self.subroutine_states:
+                self._emit_states(states)
+                return
+            inner = states[2:-1]
+            key = hashlib.blake2b(inner.tobytes(), digest_size=16).hexdigest()
+            self._subroutines.setdefault(key, inner)
+            self._emit_states(states[:2])
+            rows[-1][1] = JSR
+            self._calls.append((len(rows) - 1, key))
+            self._emit_states(states[-1:])
+        elif block.count == 1:
+            self._emit(block.block, depth)
+        elif block.count > self.max_loop_count:
+            self._emit(factor_repeat(block, self.max_loop_count), depth)
+        else:
+            if depth >= self.max_loop_depth:
+                raise ValueError(f'Loops are nested deeper than {self.max_loop_depth}')
+            start = len(rows)
+            self._emit(_peel_block(_peel_block(block.block, True), False), depth + 1)
+            if len(rows) - start == 1:
+                # A loop needs two instructions
+                rows[start][3] /= 2
+                rows.append(list(rows[start]))
+            rows[start][1] = LOOP
+            rows[start][2] = block.count
+            rows[-1][1] = END_LOOP
+            rows[-1][2] = start
+
+
+EDGE_DTYPE = np.dtype([
+    ('time', np.float64),           # in ns
+    ('flags', np.int32),            # outputs from this time on
+])
+
+
+def run_program(instructions: np.ndarray, expand_loops: bool = False,
+                max_edges: int = 100000, max_steps: int = 10 ** 7) -> dict:
+    """
+    Executes a program like the PulseBlaster, without hardware.
+
+    Every instruction sets the outputs to its flags for its length. LOOP
+    starts a loop with `inst_data` repetitions when it is not already
+    running, END_LOOP jumps back to the LOOP at `inst_data` until the
+    repetitions are done, JSR calls the subroutine at `inst_data`, RTS
+    returns behind the JSR, BRANCH jumps to `inst_data`, LONG_DELAY lasts
+    `inst_data` times its length, WAIT continues as if triggered, and STOP
+    ends the program. A program that branches back to a point it already
+    passed with the same loops and subroutines running repeats forever,
+    it is executed until then and its period is returned.
+
+    All repetitions of a loop take as long as the first one, so unless
+    `expand_loops` is True the remaining repetitions are skipped and only
+    their time is added, which takes the same time for any loop count.
+
+    Parameters
+    ----------
+    instructions : np.ndarray
+        Instructions with `INSTRUCTION_DTYPE`
+    expand_loops : bool, optional
+        Plays every repetition of the loops
+    max_edges : int, optional
+        Number of output changes recorded
+    max_steps : int, optional
+        Number of instructions executed before giving up, e.g. for a
+        program that never stops
+
+    Returns
+    -------
+    dict
+        'duration' until the STOP in ns, 'edges' of the outputs with
+        `EDGE_DTYPE`, 'complete' if the edges cover the whole program,
+        'stopped' if a STOP was reached, 'period' in ns of a program that
+        repeats forever, else None, and 'steps' the number of
+        instructions executed
+
+    Raises
+    ------
+    ValueError
+        If the program jumps outside of itself, or returns or ends a loop
+        that was not started
+    """
+    rows = np.asarray(instructions, dtype=INSTRUCTION_DTYPE).tolist()
+    n = len(rows)
+    loops = []          # [address of the LOOP, repetitions left, start time]
+    calls = []          # return addresses
+    branches = {}       # time of every branch, to find programs that repeat forever
+    period = None
+    edge_times = []
+    edge_flags = []
+    last_flags = None
+    complete = True
+    stopped = False
+    t = 0.0
+    address = 0
+    steps = 0
+    while steps < max_steps:
+        if not 0 <= address < n:
+            raise ValueError(f'The program jumps to address {address} outside of it')
+        flags, inst, inst_data, length = rows[address]
+        steps += 1
+        if flags != last_flags:
+            if len(edge_times) < max_edges:
+                edge_times.append(t)
+                edge_flags.append(flags)
+            else:
+                complete = False
+            last_flags = flags
+        if inst == STOP:
+            stopped = True
+            break
+        t += length * inst_data if inst == LONG_DELAY else length
+        address += 1
+        if inst == LOOP:
+            if not loops or loops[-1][0] != address - 1:
+                loops.append([address - 1, inst_data, t - length])
+        elif inst == END_LOOP:
+            if not loops or loops[-1][0] != inst_data:
+                raise ValueError(f'END_LOOP at {address - 1} without its LOOP')
+            loop = loops[-1]
+            loop[1] -= 1
+            if loop[1] <= 0:
+                loops.pop()
+            elif expand_loops:
+                address = inst_data
+            else:
+                t += loop[1] * (t - loop[2])
+                loops.pop()
+                complete = False
+        elif inst == JSR:
+            calls.append(address)
+            address = inst_data
+        elif inst == RTS:
+            if not calls:
+                raise ValueError(f'RTS at {address - 1} outside of a subroutine')
+            address = calls.pop()
+        elif inst == BRANCH:
+            address = inst_data
+            key = (address, tuple(tuple(loop[:2]) for loop in loops), tuple(calls))
+            if key in branches:
+                period = t - branches[key]
+                break
+            branches[key] = t
+    edges = np.zeros(len(edge_times), dtype=EDGE_DTYPE)
+    edges['time'] = edge_times
+    edges['flags'] = edge_flags
+    return {
+        'duration': t,
+        'edges': edges,
+        'complete': complete and stopped,
+        'stopped': stopped,
+        'period': period,
+        'steps': steps,
+    }
+
+
+def wait_for_stop(api, duration: float, timeout: float = None,
+                  poll_interval: float = 1e-3) -> bool:
+    """
+    Waits for a program to end, sleeping instead of busy waiting.
+
+    Sleeps for the expected duration and then polls `pb_read_status`
+    every `poll_interval` until the board reports that it stopped.
+
+    Parameters
+    ----------
+    api : module
+        `qudi.hardware.spinapi` or an object with `pb_read_status` and
+        `STATUS_STOPPED`
+    duration : float
+        Expected duration of the program in s
+    timeout : float, optional
+        Time to wait after the expected duration, default 20 % of the
+        duration plus 1 s
+    poll_interval : float, optional
+        Time between two reads of the status in s
+
+    Returns
+    -------
+    bool
+        True if the board stopped, False on timeout
+    """
+    timeout = 0.2 * duration + 1.0 if timeout is None else timeout
+    deadline = time.monotonic() + duration + timeout
+    if duration > poll_interval:
+        time.sleep(duration - poll_interval)
+    while True:
+        if api.pb_read_status() & api.STATUS_STOPPED:
+            return True
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+
+    import tracemalloc
+
+    # The comparisons with the implementations replaced by the functions in
+    # here are in tests/test_pulse_compiler.py
+
+    # Sweep of three pulses over 10000 iterations
+    pulses = [
+        (0.0, 2.0, '', ''),
+        (5.0, 1.0, 'W + 0.01 * i', ''),
+        (10.0, 1.0, '', 'S + np.sqrt(i) / 10'),
+    ]
+    iteration_range = (1, 10000)
+    start = time.perf_counter()
+    table = PulseTable()
+    for start_time, width, function_width, function_start in pulses:
+        iterations, start_times, widths = sweep_pulse(
+            start_time, width, function_width, function_start, iteration_range
+        )
+        table.add(iterations, 1, start_times - 1, start_times + widths,
+                  start_times, start_times + widths)
+    table.pulses
+    new_time = time.perf_counter() - start
+    print(f'Sweep of {len(pulses)} pulses over {iteration_range[1]} iterations: '
+          f'{1e3 * new_time:.1f} ms')
+
+    # Memory of the table compared with one object per pulse, like the
+    # Pulse class the logic used before
+    class PulseObject:
+
+        def __init__(self, start_tail, end_tail, channel_binary):
+            self.start_tail = start_tail
+            self.end_tail = end_tail
+            self.channel_binary = [channel_binary]
+
+    rows = table.pulses[['start', 'end', 'display_start', 'display_end']].tolist()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [
+        (PulseObject(start, end, 1), PulseObject(display_start, display_end, 1))
+        for start, end, display_start, display_end in rows
+    ]
+    object_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f'{len(table)} pulses: {table.pulses.itemsize} bytes per pulse in the table, '
+          f'{object_bytes / len(objects):.0f} bytes per pulse as Pulse objects')
+
+    # Flattening of one variation with 16 channels
+    for n_edges in (200, 2000, 20000):
+        table = PulseTable()
+        times_rng = np.random.default_rng(n_edges)
+        for bit in range(16):
+            n = n_edges // 32
+            starts = np.sort(times_rng.choice(100 * n_edges, n, replace=False)).astype(float)
+            widths = times_rng.integers(1, 50, n)
+            table.add(np.ones(n, dtype=int), 1 << bit, starts, starts + widths)
+        pulses = table.get_iteration(1)
+        args = pulses['start'], pulses['end'], pulses['channel']
+        repeats = 100
+        start = time.perf_counter()
+        for _ in range(repeats):
+            states = flatten_pulses(*args)
+        new_time = (time.perf_counter() - start) / repeats
+        print(f'{2 * pulses.size} edges: flatten_pulses {1e6 * new_time:.0f} us, '
+              f'{states.size} states')
+
+    class CountingApi:
+        """
+        Stand-in for spinapi that counts the instructions, every call takes
+        about 5 us like a call into the DLL.
+        """
+        PULSE_PROGRAM = 0
+
+        def __init__(self):
+            self.instructions = 0
+
+        def pb_start_programming(self, target):
+            return 0
+
+        def pb_inst_pbonly(self, flags, inst, inst_data, length):
+            end = time.perf_counter() + 5e-6
+            while time.perf_counter() < end:
+                pass
+            self.instructions += 1
+            return self.instructions - 1
+
+        def pb_stop_programming(self):
+            return 0
+
+    class StatusApi(CountingApi):
+        """
+        Stand-in for spinapi that is stopped `duration` seconds after
+        `pb_start`.
+        """
+        STATUS_STOPPED = 1
+        STATUS_RUNNING = 4
+
+        def __init__(self, duration):
+            super().__init__()
+            self.duration = duration
+            self.end = None
+            self.status_reads = 0
+
+        def pb_start(self):
+            self.end = time.perf_counter() + self.duration
+
+        def pb_read_status(self):
+            self.status_reads += 1
+            if time.perf_counter() < self.end:
+                return self.STATUS_RUNNING
+            return self.STATUS_STOPPED
+
+    def busy_wait(seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    # 25 pulses on each of 4 channels, shifted by 0.5 us from one variation to the next
+    table = PulseTable()
+    iterations = np.repeat(np.arange(1, 21), 25)
+    for bit in range(4):
+        starts = np.tile(np.arange(25) * 40.0, 20) + 5 * bit + 0.5 * iterations
+        table.add(iterations, 1 << bit, starts, starts + 10)
+    variation_states = [
+        flatten_pulses(*(table.get_iteration(i)[field] for field in ('start', 'end', 'channel')))
+        for i in range(1, 21)
+    ]
+
+    # 20 variations of about 150 states, repeated in one program compared
+    # with one upload per variation and chunk of 10000 repetitions, at the
+    # upload time per instruction measured with the stand-in
+    sizes = [states.size for states in variation_states]
+    for value_loop in (50000, 10 ** 6, 10 ** 9):
+        block = variation_loop_block(variation_states, value_loop)
+        start = time.perf_counter()
+        program = ProgramCompiler().compile(block)
+        compile_time = time.perf_counter() - start
+        start = time.perf_counter()
+        result = run_program(program)
+        run_time = time.perf_counter() - start
+        cache = PulseProgramCache(CountingApi())
+        cache.load(program)
+        stats = cache.get_stats()
+        upload_time = stats['upload_time'] / stats['instructions_uploaded']
+        depth = np.max(np.cumsum((program['inst'] == LOOP).astype(int)
+                                 - (program['inst'] == END_LOOP)))
+        programs, instructions = chunked_uploads(sizes, value_loop)
+        print(f'20 variations x {value_loop} repetitions: {program.size} instructions, '
+              f'loops nested {depth} deep, compiled in {1e3 * compile_time:.1f} ms, '
+              f'uploaded in {1e3 * stats["upload_time"]:.1f} ms, '
+              f'{result["duration"] * 1e-9:.4g} s of pulses (as expected: '
+              f'{np.isclose(result["duration"], 1000.0 * block_duration(block))}), '
+              f'executed in {1e3 * run_time:.1f} ms; 1 start instead of {programs}, '
+              f'{instructions * upload_time:.4g} s of uploads eliminated')
+
+    duration = 0.5
+    api = StatusApi(duration)
+    api.pb_start()
+    start_cpu, start = time.process_time(), time.perf_counter()
+    stopped = wait_for_stop(api, duration * 0.9, poll_interval=1e-3)
+    wait_cpu, wait_time = time.process_time() - start_cpu, time.perf_counter() - start
+    start_cpu = time.process_time()
+    busy_wait(duration)
+    busy_cpu = time.process_time() - start_cpu
+    print(f'Waiting {wait_time:.3f} s for a {duration} s program: wait_for_stop used '
+          f'{1e3 * wait_cpu:.1f} ms of CPU time ({api.status_reads} status reads, '
+          f'stopped: {stopped}), busy waiting {1e3 * busy_cpu:.0f} ms')
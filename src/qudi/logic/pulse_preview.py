@@ -0,0 +1,271 @@
+"""
+Step plots of the pulse sequence preview.
+
+The preview shows the pulses of one iteration as stacked square waves,
+one per channel, drawn by pyqtgraph in step mode: `x` are the times of
+the edges and `y[k]` is the level between `x[k]` and `x[k + 1]`. The
+arrays of a channel are built from the display intervals of its pulses in
+the `PulseTable` with a few NumPy operations, and the arrays of the last
+iterations shown are kept, so scrubbing back and forth through the
+iterations or replaying the simulation does not build them again.
+
+Pulses closer than `resolution` are drawn as one pulse. The resolution is
+a fraction of the plot length, about the width of a pixel, so a channel
+with many short pulses needs at most a few thousand points whatever the
+number of pulses.
+
+Contains:
+
+- step_plot_arrays(starts, ends, end_time): step plot of one channel
+- StepPlotCache: step plots of the channels of the last iterations shown
+"""
+import collections
+
+import numpy as np
+
+from qudi.logic.pulse_compiler import PulseTable
+
+
+def step_plot_arrays(starts, ends, end_time: float, resolution: float = 0.0,
+                     offset: float = 0.0) -> tuple:
+    """
+    Builds the step plot of the pulses of one channel.
+
+    The plot starts at 0, or at the first pulse if it starts earlier, and
+    ends at `end_time`, or at the last pulse if it ends later.
+
+    Parameters
+    ----------
+    starts, ends : np.ndarray
+        Pulses sorted by their start
+    end_time : float
+        End of the plot, e.g. the end of the longest iteration, so that all
+        iterations are drawn to the same length
+    resolution : float, optional
+        Pulses separated by less are drawn as one pulse
+    offset : float, optional
+        Low level of the square wave, the high level is `offset + 1`
+
+    Returns
+    -------
+    tuple
+        (x, y) for `pg.PlotDataItem(x, y, stepMode=True)`, `x` has one
+        element more than `y`
+    """
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    if starts.size:
+        # A pulse is joined to the previous ones if it starts before they
+        # end plus the resolution, this also merges overlapping pulses
+        reach = np.maximum.accumulate(ends)
+        new_pulse = np.ones(starts.size, dtype=bool)
+        new_pulse[1:] = starts[1:] > reach[:-1] + resolution
+        first = np.flatnonzero(new_pulse)
+        starts = starts[first]
+        ends = np.maximum.reduceat(ends, first)
+
+    n = starts.size
+    x = np.empty(2 * n + 2)
+    x[0] = min(0.0, starts[0]) if n else 0.0
+    x[1:-1:2] = starts
+    x[2:-1:2] = ends
+    x[-1] = max(end_time, ends[-1]) if n else end_time
+    y = np.full(2 * n + 1, float(offset))
+    y[1::2] += 1
+    return x, y
+
+
+class StepPlotCache:
+    """
+    Step plots of the channels of the last iterations shown.
+
+    The plots of an iteration are stacked in the order of the channels
+    passed to `get`, two units apart, leaving out the channels without
+    pulses in that iteration. The plots of at most `max_iterations`
+    iterations are kept, the one used least recently is dropped first.
+    All plots are dropped when pulses are added to the table or the table
+    is cleared.
+
+    Parameters
+    ----------
+    pulse_table : PulseTable
+        Pulses of the experiment
+    max_iterations : int, optional
+        Number of iterations whose plots are kept
+    points : int, optional
+        Resolution of the plots, the plot length divided by `points` is
+        the shortest gap between two pulses that is drawn
+
+    Attributes
+    ----------
+    hits, misses : int
+        Number of plots found in the cache and built
+    """
+
+    def __init__(self, pulse_table: PulseTable, max_iterations: int = 1024,
+                 points: int = 4000) -> None:
+
+        self.pulse_table = pulse_table
+        self.max_iterations = max_iterations
+        self.points = points
+        self.hits = 0
+        self.misses = 0
+        self._plots = collections.OrderedDict()
+        self._revision = pulse_table.revision
+
+    def __len__(self) -> int:
+        return len(self._plots)
+
+    def clear(self) -> None:
+
+        self._plots.clear()
+        self._revision = self.pulse_table.revision
+
+    def get(self, iteration: int, channels, end_time: float) -> list:
+        """
+        Returns the step plots of one iteration.
+
+        Parameters
+        ----------
+        iteration : int
+            Iteration to plot
+        channels : sequence of int
+            Bits of the channels, from the bottom to the top of the plot
+        end_time : float
+            End of the plots
+
+        Returns
+        -------
+        list
+            (index, x, y) of the channels with pulses, `index` is the
+            position of the channel in `channels`. The arrays are shared
+            with the cache and must not be modified.
+        """
+        if self._revision != self.pulse_table.revision:
+            self.clear()
+        key = (iteration, tuple(channels), end_time)
+        plots = self._plots.get(key)
+        if plots is not None:
+            self._plots.move_to_end(key)
+            self.hits += 1
+            return plots
+
+        self.misses += 1
+        pulses = self.pulse_table.get_iteration(iteration)
+        resolution = end_time / self.points if self.points else 0.0
+        plots = []
+        for index, channel in enumerate(channels):
+            pulses_channel = self.pulse_table.get_channel(pulses, channel)
+            if pulses_channel.size == 0:
+                continue
+            x, y = step_plot_arrays(
+                pulses_channel['display_start'], pulses_channel['display_end'],
+                end_time, resolution, offset=2 * len(plots)
+            )
+            x.flags.writeable = False
+            y.flags.writeable = False
+            plots.append((index, x, y))
+        self._plots[key] = plots
+        if len(self._plots) > self.max_iterations:
+            self._plots.popitem(last=False)
+        return plots
+
+
+if __name__ == '__main__':
+
+    import time
+
+    def legacy_step_plot(pulses, global_end, offset):
+        """
+        Step plot as built by `Frame.display_frame` before, from one Pulse
+        like (start_tail, end_tail) pair per pulse.
+        """
+        x = []
+        y = []
+        last_end = 0
+        for start_tail, end_tail in sorted(pulses):
+            if start_tail > last_end:
+                x.extend([last_end, start_tail])
+                y.extend([offset, offset])
+            x.extend([start_tail, start_tail, end_tail, end_tail])
+            y.extend([offset, offset + 1, offset + 1, offset])
+            last_end = end_tail
+        if last_end < global_end:
+            x.extend([last_end, global_end])
+            y.extend([offset, offset])
+        x.append(global_end)
+        return np.array(x, dtype=float), np.array(y, dtype=float)
+
+    def levels(x, y, times):
+        # Level of a step plot at the given times
+        return y[np.clip(np.searchsorted(x, times, side='right') - 1, 0, y.size - 1)]
+
+    # Rabi like sequence: laser, microwave sweep and a train of apd gates
+    iterations = 2000
+    channels = (1, 2, 4)
+    table = PulseTable()
+    i = np.arange(iterations)
+    table.add(i, 1, np.zeros(iterations), np.full(iterations, 3000.0))
+    table.add(i, 2, np.full(iterations, 3100.0), 3100.0 + 10 * i)
+    gates = 200
+    train_i = np.repeat(i, gates)
+    train_starts = 3200.0 + 10 * train_i + np.tile(100.0 * np.arange(gates), iterations)
+    table.add(train_i, 4, train_starts, train_starts + 50)
+    end_time = float(table.get_max_end_times()[1].max())
+
+    # Same curves as the legacy loops wherever the level is defined
+    rng = np.random.default_rng(0)
+    times = rng.uniform(0, end_time, 100000)
+    exact = StepPlotCache(table, points=0)
+    mismatches = 0
+    for iteration in rng.integers(0, iterations, 50):
+        for index, x, y in exact.get(iteration, channels, end_time):
+            pulses = table.get_channel(table.get_iteration(iteration), channels[index])
+            legacy_x, legacy_y = legacy_step_plot(
+                pulses[['display_start', 'display_end']].tolist(), end_time, y[0]
+            )
+            mismatches += not np.array_equal(levels(x, y, times), levels(legacy_x, legacy_y, times))
+    print(f'Step plots different from the legacy loops: {mismatches}')
+
+    # Scrubbing through all iterations, then back over the last 1000 of them
+    order = np.concatenate((i, i[::-1][:1000]))
+    start = time.perf_counter()
+    for iteration in order:
+        pulses = table.get_iteration(iteration)
+        for k, channel in enumerate(channels):
+            pulses_channel = table.get_channel(pulses, channel)
+            legacy_step_plot(
+                pulses_channel[['display_start', 'display_end']].tolist(), end_time, 2 * k
+            )
+    legacy_time = (time.perf_counter() - start) / order.size
+
+    cache = StepPlotCache(table)
+    times = []
+    for iteration in order:
+        start = time.perf_counter()
+        plots = cache.get(iteration, channels, end_time)
+        times.append(time.perf_counter() - start)
+    built_time = np.mean(times[:iterations])
+    cached_time = np.mean(times[iterations:])
+    points = sum(x.size for _, x, _ in plots)
+    print(f'{iterations} iterations of {gates + 2} pulses, per frame: '
+          f'legacy {1e6 * legacy_time:.0f} us, built {1e6 * built_time:.0f} us '
+          f'({legacy_time / built_time:.1f}x), cached {1e6 * cached_time:.1f} us '
+          f'({legacy_time / cached_time:.0f}x), {cache.hits} hits, {cache.misses} misses, '
+          f'{points} points per frame')
+
+    # Pulses much shorter than the plot are drawn with a bounded number of points
+    dense = PulseTable()
+    dense_starts = np.arange(10 ** 6) * 10.0
+    dense.add(np.zeros(dense_starts.size, dtype=int), 1, dense_starts, dense_starts + 5)
+    dense_end = float(dense_starts[-1] + 5)
+    dense.pulses
+    start = time.perf_counter()
+    (_, x, y), = StepPlotCache(dense).get(0, (1,), dense_end)
+    elapsed = time.perf_counter() - start
+    print(f'{dense_starts.size} pulses drawn with {x.size} points in {1e3 * elapsed:.0f} ms')
+
+    misses = cache.misses
+    table.add([0], 8, [0.0], [100.0])
+    cache.get(0, channels + (8,), end_time)
+    print('Cache dropped after adding pulses:', len(cache) == 1 and cache.misses == misses + 1)
@@ -9,6 +9,13 @@ from qudi.core.configoption import ConfigOption
 from qudi.util.mutex import Mutex
 from qudi.util.datastorage import TextDataStorage, ImageFormat
 from qudi.logic.filemanager import FileManager
+from qudi.logic.gated_counts import BufferedCounterReader, GatedCountAccumulator
+from qudi.logic.pulse_compiler import (
+    MAX_INSTRUCTIONS, ProgramCompiler, PulseProgramCache, PulseTable, RepeatBlock,
+    STATE_DTYPE, StateBlock, chunked_uploads, experiment_loop_block, flatten_pulses,
+    run_program, sweep_pulse, variation_loop_block
+)
+from qudi.logic.pulse_preview import StepPlotCache
 import pyqtgraph as pg
 import datetime
 from qudi.hardware import spinapi
@@ -39,9 +46,15 @@ class PulsedESRLogic(LogicBase):
     add_iteration_txt = Signal(str)
     added_pulse_signal = Signal()
     error_str_signal = Signal(str)
+    apd_counts_signal = Signal(
+        object
+    )  # mean apd counts per repetition of every variation, sent while the experiment runs
 
     # Declare static parameters that can/must be declared in the qudi configuration
     # _increment_interval = ConfigOption(name='increment_interval', default=1, missing='warn')
+    _pb_max_instructions = ConfigOption(
+        name="pb_max_instructions", default=MAX_INSTRUCTIONS
+    )  # instructions the pulse blaster holds, bigger experiments are sent one variation at a time
 
     # Declare status variables that are saved in the AppStatus upon deactivation of the module and
     # are initialized to the saved value again upon activation.
@@ -73,11 +86,32 @@ class PulsedESRLogic(LogicBase):
         self.channel_labels = []  # Find a way to get rid of these extra variables
         self.Delays_channel = []  # Find a way to get rid of these extra variables
         self.Experiment_Hub = []  # list of objects were each object is a
+        self.pulse_table = PulseTable()  # all the pulses of all channels and iterations, one row per pulse
+        self.step_plots = StepPlotCache(
+            self.pulse_table
+        )  # step plot arrays of the last frames shown, dropped when the pulses change
+        self.program_cache = PulseProgramCache(
+            spinapi
+        )  # keeps track of the program on the pulse blaster, so it is only uploaded when it changes
+        self.program_compiler = ProgramCompiler(
+            time_unit=spinapi.us,
+            stop_length=1 * spinapi.us,
+            max_instructions=self._pb_max_instructions,
+        )  # compiles all variations of an experiment into one program
         self.Max_end_time = 0  # It gives you the max end time of all iterations
         self.dev = "Dev1"  # el device con su number
         self.counter_pin = "ctr0"  # ctr= counter basicamente una parte de la nih que cuenta o emite cuentas. El gate le dice en que intervalo contar
         self.gate_pin = "PFI9"
         self.max_variations = 0
+        self.dead_time_report = {}  # restarts and uploads saved by the last experiment, see report_dead_time
+        self.count_reader = None  # reads the apd counts of the running experiment
+        self.apd_counts = None  # (variation x repetition block) apd counts of the last experiment
+        self.apd_counts_interval = 0.2  # s, the live apd curve is sent to the gui at most this often
+        self._last_apd_counts_emit = 0
+        self.run_timer = None  # polls the pulse blaster until the program has stopped
+        self.poll_interval_ms = 20
+        self._pending_programs = []  # programs still to be played after the running one
+        self._run_deadline = 0
 
     def on_activate(self):
         pass
@@ -116,8 +150,12 @@ class PulsedESRLogic(LogicBase):
                 )  # channel count is the amount of ports in the ni
                 self.added_channel_tags.append(flag[0])  # add channel to the set
                 channel = Channel(
-                    channel_tag, channel_binary, channel_label, channel_delay
+                    channel_tag, channel_binary, channel_label, channel_delay,
+                    self.pulse_table
                 )
+                channel.error_adding_pulse_channel.connect(
+                    self.error_str_signal.emit
+                )  # connected once, so the errors of every pulse added to the channel reach the GUI
                 self.channels.append(channel)
                 self.channels = sorted(
                     self.channels, key=lambda ch: ch.tag
@@ -191,10 +229,9 @@ class PulsedESRLogic(LogicBase):
                         function_start,
                         iteration_range,
                     )
-                    channel.error_adding_pulse_channel.connect(
-                        self.error_str_signal.emit
-                    )
                     break
+            if max_end_time_added_sequence is None:
+                return  # the pulse was not added, the channel already emitted the error
             if max_end_time_added_sequence > self.Max_end_time:
                 self.Max_end_time = max_end_time_added_sequence
         print(f"self.Max_end_time:{self.Max_end_time}")
@@ -205,6 +242,10 @@ class PulsedESRLogic(LogicBase):
         then we order the pulses form the channels that have pulses in this iteration. Then we create an object from the
         class experiment. which we then add to our list Experiment_Hub
         """
+        if self.run_timer is not None and self.run_timer.isActive():
+            # a second run would reset the board in the middle of the program and start a second counter task
+            self.error_str_signal.emit("An experiment is already running, stop it first")
+            return
 
         print(f"len(self.Experiment_Hub):{len(self.Experiment_Hub)}")
         # maybe we shouldnt flat them but instead send self.Experiment
@@ -212,17 +253,11 @@ class PulsedESRLogic(LogicBase):
         max_end_times_vars = []  # max end times per variation
         for i in range(1, self.max_variations + 1):
             print(f"Creating exp:{i}")
-            Exp_i_pb = []
+            # the pulses of all the channels in this variation, a slice of the pulse table
+            Exp_i_pb = self.pulse_table.get_iteration(i)
             max_end = 0
-            for channel in self.channels:
-                print("Inside the channel loop")
-                print(f'i= {i}')
-                result = channel.a_experiment(i) # Returns [pulse, end_time]
-                list_channel_sequence = result[0]
-                if list_channel_sequence != None:
-                    Exp_i_pb.append(list_channel_sequence)
-                    if max_end < result[1]:
-                        max_end = result[1] # max end time of the variation
+            if Exp_i_pb.size > 0:
+                max_end = max(max_end, Exp_i_pb["end"].max().item()) # max end time of the variation
             max_end_times_vars.append(max_end)
             # Now we see that each variation is one experiment,
             # so a variation is a variation of the experiment
@@ -231,299 +266,245 @@ class PulsedESRLogic(LogicBase):
             # in the instace of the variation of the experiment 
             exp.Prepare_Exp()  
 
-            self.Experiment_Hub.append(exp)  # for the type 1
-            list_type_cero.append(exp.pb_sequence)  # for the type 0
+            self.Experiment_Hub.append(exp)
+            list_type_cero.append(exp.states)  # for the type 0 and 1
         #print(f"max_end_time_vars{max_end_times_vars}")
+        for j, states in enumerate(list_type_cero):
+            if states.size == 0:
+                self.error_str_signal.emit(f"Variation {j + 1} has no pulses")
+                return
 
-        divide_exp = self.divide_iter_experiment(value_loop)
         if Type == 0:
             """here we must iterate each variation a number of value_loop times. we do this for all variations so
             we need to flatten the pulses for each variation."""
-            timeout = 0
-            for m in range(0, len(max_end_times_vars)):
-                timeout = timeout + (
-                    value_loop * max_end_times_vars[m] * 1.2
-                )  # el el timepo total de cada variaicon por la cantidad de repeticciones por 1.2.
-            print(f"timeout:{timeout}")
-            #print(f'Experiment: {list_type_cero}')
-            #counter = self.create_counter_task()  # cretes the coutning conditions
-            #counter.start()  # starts the task of counting
-            self.a_Send_to_pulse_blaster(
-                list_type_cero, value_loop, max_end_times_vars, divide_exp
-            )
+            # all the variations in one program if it fits on the pulse blaster, otherwise one program per variation
+            program = self.compile_looped_program(variation_loop_block(list_type_cero, value_loop))
+            if program is not None:
+                programs = [program]
+            else:
+                programs = self.compile_variation_programs(list_type_cero, value_loop)
 
         elif Type == 1:
             """lets say we have 3 variations the experiment then becomes (1,2,3)*value_loop times"""
-            timeout = 0
-            max_end_1 = 0
-            for m in range(0, len(max_end_times_vars)):
-                max_end_1 = max_end + max_end_times_vars[m]
-                timeout = timeout + max_end_times_vars[m]
-            timeout = (
-                timeout * value_loop * 1.2
-            )  # el tiempo total de una serie de variaicones * total de repeticiones*1,2
-            print(f"timeout:{timeout}")
-            #counter = self.create_counter_task()  # cretes the coutning conditions
-            #counter.start()  # starts the task of counting
-            # Flatten all the pulses into one list
-            Flat_exp = [
-                pulse for exp in self.Experiment_Hub for pulse in exp.pb_sequence
-            ]
-            self.b_Send_to_Pulse_Blaster(
-                Flat_exp, value_loop, max_end_1, divide_exp
+            # the variations one after the other can only be played as one program
+            program = self.compile_looped_program(experiment_loop_block(list_type_cero, value_loop))
+            programs = None
+            if program is not None:
+                programs = [program]
+            else:
+                self.error_str_signal.emit(
+                    "The experiment does not fit on the pulse blaster, use less variations"
+                )
+        else:
+            programs = None
+
+        if programs is None or not self.init_pulse_blaster():
+            return
+        # the counter is only started once the programs are ready to be sent, it runs during the whole
+        # experiment, the counts are sorted into the variations and repetitions while the pulse blaster plays
+        self.start_gated_counting(value_loop, interleaved=Type == 1)
+        self.start_programs(programs)
+        if len(programs) == 1:
+            self.report_dead_time(list_type_cero, value_loop, each_variation=Type == 0)
+
+    def start_gated_counting(self, value_loop, interleaved):
+        """
+        Starts the NI counter before the pulse blaster, if there is an apd channel. The counter takes one
+        sample at the end of every pulse of the apd channel (the gate), and the samples are sorted into a
+        (variation x repetition) array in the thread of the NI driver while the experiment runs, see
+        GatedCountAccumulator. Gate pulses that touch the gate of the next repetition are one gate for the
+        counter, so they must not.
+        """
+        self.finish_gated_counting()  # a counter left running would keep its NI task and its name
+        apd = next((channel for channel in self.channels if channel.label == "apd"), None)
+        if apd is None:
+            return
+        gates = [
+            self.pulse_table.get_channel(self.pulse_table.get_iteration(i), apd.binary).size
+            for i in range(1, self.max_variations + 1)
+        ]  # gate pulses in one repetition of every variation
+        accumulator = GatedCountAccumulator(gates, value_loop, interleaved)
+        if accumulator.total_samples == 0:
+            return
+        self.count_reader = BufferedCounterReader(
+            self.create_counter_task(), accumulator, on_update=self._emit_apd_counts
+        )
+        self.count_reader.start()
+
+    def _emit_apd_counts(self, accumulator):
+        # called by the NI driver after every read, the signal is queued to the gui.
+        # The driver calls back every 1000 gates, the gui does not need the curve that often
+        now = time.monotonic()
+        if now - self._last_apd_counts_emit < self.apd_counts_interval:
+            return
+        self._last_apd_counts_emit = now
+        self.apd_counts_signal.emit(accumulator.get_curve())
+
+    def finish_gated_counting(self):
+        """
+        Reads the last samples of the counter and stops it. The counts are kept in apd_counts.
+        """
+        if self.count_reader is None:
+            return
+        self.apd_counts = self.count_reader.finish()
+        accumulator = self.count_reader.accumulator
+        self.apd_counts_signal.emit(accumulator.get_curve())
+        if accumulator.samples != accumulator.total_samples or accumulator.overflow:
+            self.error_str_signal.emit(
+                f"The apd counter took {accumulator.samples + accumulator.overflow} samples, "
+                f"the experiment has {accumulator.total_samples} gates"
             )
+        self.count_reader = None
+
+    def compile_looped_program(self, block):
         """
-        Calculate the max end time of the experiment: value_loop*1*duration_of_variation[k]*1.2 + value_loop*1*duration_of_variation[k+1]*1.2 + ......
+        Compiles the whole experiment into one program: the repetitions are loops on the pulse blaster
+        and every variation is a subroutine, so the board is programmed and started once.
+
+        Returns None if the program does not fit on the pulse blaster, then the variations have to be
+        sent one at a time (compile_variation_programs).
         """
-        """ THIS IS  FOR THE APD """
-        for channel in self.channels:
-            if channel.label == "apd":
-                counts = counter.read(value_loop, timeout=timeout)
-                count_0 = counts[0]
-                counts = np.diff(
-                    counts
-                )  # instead of accumulating values ex (5,11,21) it gives (5,6,10)
-                print(counts)
-            pass
+        try:
+            program = self.program_compiler.compile(block)
+        except ValueError as e:
+            print(f"{e}, sending the variations one at a time")
+            return None
+        print(f"one program of {program.size} instructions")
+        return program
 
-    def a_Send_to_pulse_blaster(
-        self, Flat_exp, value_loop, max_end_times_vars, divided_value
-    ):
-        """here we must iterate each variation a number of value_loop times. we do this for all variations so.
-        However to the pulse blaster can only have about 40k instructions and the loop can only iterate a
-         maximum of 1 million times. so to get around this  we divide the value_loop by 10k iterations of the experiment
+    def compile_variation_programs(self, Flat_exp, value_loop):
+        """here we must iterate each variation a number of value_loop times, when all the variations
+        together do not fit on the pulse blaster. Each variation is a program of its own,
+        repeated value_loop times. The loop of the pulse blaster only counts up to about 1 million,
+        larger value_loop are nested loops (see factor_repeat), so each variation is started once.
+
+        Flat_exp is the list with the states (see flatten_pulses) of every variation.
+        Returns None, after emitting the error, if a variation can not be compiled.
         """
-        print("sending to pulse blaster")
+        print("sending to pulse blaster one variation at a time")
         print(f"len(Flat_exp):{len(Flat_exp)}")
-        print(f"divided_value:{divided_value}")
-        print(f"max_end_times_vars:{max_end_times_vars}")
-        print(f"flat_exp:{Flat_exp}")
         print(f"value_loop:{value_loop}")
-        #print(f"counter:{counter}")
+        programs = []
+        for j, states in enumerate(Flat_exp):
+            try:
+                programs.append(
+                    self.program_compiler.compile(RepeatBlock(StateBlock(states), value_loop))
+                )
+            except ValueError as e:
+                self.error_str_signal.emit(f"Variation {j + 1}: {e}")
+                return None
+        return programs
 
+    def init_pulse_blaster(self):
+        """
+        Opens and resets the pulse blaster. Returns False, after emitting the error, if the board
+        can not be initialized.
+        """
         spinapi.pb_close()
         spinapi.pb_select_board(0)
         if spinapi.pb_init() != 0:
-            exit(-1)
+            self.error_str_signal.emit(
+                f"The pulse blaster could not be initialized: {spinapi.pb_get_error()}"
+            )
+            return False
         spinapi.pb_reset()
         spinapi.pb_core_clock(500)
-        spinapi.pb_start_programming(spinapi.PULSE_PROGRAM)
-        ### muc add another for, to diviude the value_loop
-        for d in range(0, len(divided_value)):
-            # In case the x amount of loops is greater than 10k
-            # the x is divided in steps of 10k
-            print(f'Starting loop x={d}')
-            value_loop = divided_value[d]
-            print(f'value_loop={value_loop}')
-            for j in range(0, self.max_variations):
-                """
-                For each iteration j (a variation) , we will send one set of isntrutions to the pulse blaster
-                However
-                """
-                print(f"Starting the {j}th variation")
-                spinapi.pb_start_programming(spinapi.PULSE_PROGRAM)
-
-                # generates a loop of instruction here only one iteration
-                # Exp has structure [[pulse1, pulse2, ...], [pulse1, pulse2, ...]]
-                # where [[variation1], [variation2], ...]
-                start = spinapi.pb_inst_pbonly(
-                    int(sum(Flat_exp[j][0].channel_binary[0])),
-                    spinapi.Inst.LOOP,
-                    value_loop,
-                    (Flat_exp[j][0].end_tail - Flat_exp[j][0].start_tail) * spinapi.us,
-                )
+        self.program_cache.invalidate()  # the board was reset, there is no program on it
+        return True
 
-                print(
-                    f"spinapi.pb_inst_pbonly({sum(Flat_exp[j][0].channel_binary[0])},spinapi.Inst.LOOP,{value_loop},({Flat_exp[j][0].end_tail-Flat_exp[j][0].start_tail})*spinapi.us)"
-                )
-                for i in range(1, len(Flat_exp[j])):  
-                    # we start from one because we already did the 0 index
-                    print(f'i = {i}')
-                    if i != len(Flat_exp[j]) - 1:
-                        print(
-                            f"spinapi.pb_inst_pbonly({sum(list(Flat_exp[j][i].channel_binary[0]))},spinapi.Inst.CONTINUE,0,({Flat_exp[j][i].end_tail-Flat_exp[j][i].start_tail})*spinapi.us)"
-                        )
-                        spinapi.pb_inst_pbonly(
-                            int(sum(Flat_exp[j][i].channel_binary[0])),
-                            spinapi.Inst.CONTINUE,
-                            0,
-                            (Flat_exp[j][i].end_tail - Flat_exp[j][i].start_tail)
-                            * spinapi.us,
-                        )
-                    else:
-                        print(
-                            f"spinapi.pb_inst_pbonly({sum(list(Flat_exp[j][i].channel_binary[0]))},spinapi.Inst.CONTINUE,0,({Flat_exp[j][i].end_tail-Flat_exp[j][i].start_tail})*spinapi.us)"
-                        )
-                        spinapi.pb_inst_pbonly(
-                            int(sum(Flat_exp[j][i].channel_binary[0])),
-                            spinapi.Inst.CONTINUE,
-                            0,
-                            (Flat_exp[j][i].end_tail - Flat_exp[j][i].start_tail)
-                            * spinapi.us,
-                        )
-                        print(
-                            f"spinapi.pb_inst_pbonly({sum(list(Flat_exp[j][i].channel_binary[0]))},spinapi.Inst.END_LOOP,start,{Flat_exp[j][i].end_tail-Flat_exp[j][i].start_tail}"
-                        )
-                        spinapi.pb_inst_pbonly(
-                            int(sum(Flat_exp[j][i].channel_binary[0])),
-                            spinapi.Inst.END_LOOP,
-                            start,
-                            Flat_exp[j][i].end_tail - Flat_exp[j][i].start_tail,
-                        )
-
-                    # This instruction stops the pulse sequence.
-                    # The duration is set to a very small value
-                    # to ensure the stop instruction is executed
-                    # almost immediately.
-                    spinapi.pb_inst_pbonly(
-                        int(0), spinapi.Inst.STOP, 0, 1 * spinapi.us
-                    )  
-                    print(
-                        f"spinapi.pb_inst_pbonly(int(0),spinapi.Inst.STOP,0,0.01*spinapi.us)"
-                    )
-                    spinapi.pb_stop_programming()  # This function call signals the end of programming the pulse sequence. It tells the SpinAPI library that the sequence definition is complete and the pulse program can be finalized
-                    print(f"spinapi.pb_stop_programming()")
-
-                spinapi.pb_start()  # here we start the spinapi
-                start = time.perf_counter()
-                time_wait = max_end_times_vars[j] * value_loop
-                #print(f"time_wait:{time_wait}")
-                self.busy_wait_us(
-                    time_wait
-                )  # Intended wait: minimum wait time until the next variation
-                end = time.perf_counter()
-                #print(
-                #    f"Actual wait: {(end - start)*1e6:.2f} µs"
-                #)  # to get a glimpse of the error in wait time
-                # el el timepo total que espera el counter para seguir a la siguient variacion. Durante ese tiempo se toman todo los datos de una variacion. Aqui se debe calcular el maximo tiempo de cada variacion y multiplicar por value _loop
-                #print(f"value_loop:{value_loop}")
-                spinapi.pb_stop()
-                #spinapi.pb_close
-            pass
-        #counter.close()
+    def start_programs(self, programs):
+        """
+        Plays the programs one after the other on the initialized pulse blaster. Instead of waiting here,
+        a timer polls the status of the pulse blaster until a program has stopped and then starts the
+        next one (see _poll_pulse_blaster), so the logic thread stays free and Stop_Experiment works
+        while the experiment runs.
+        """
+        self._pending_programs = list(programs)
+        self._start_next_program()
 
-    def b_Send_to_Pulse_Blaster(self, Flat_exp, max_end_1, divided_value, counter):
+    def _start_next_program(self):
+
+        program = self._pending_programs.pop(0)
+        self.program_cache.load(program)  # only uploaded if it changed
+        spinapi.pb_start()
+        # the same program executed without the board gives its duration
+        duration = run_program(program)["duration"] * 1e-9  # in s
+        print(f"program of {program.size} instructions started, {duration:.3f} s")
+        self.wait_for_program_end(duration)
+
+    def wait_for_program_end(self, duration):
         """
-        The objective of this fucntion is to
-        Here we recieve the flat list with all the pulses, which we then sent to the PB
-        Even if there nos laser device for example apd, it will not through an error and,
-        just continue to the next instruction after the give time.
+        Polls the status of the pulse blaster every poll_interval_ms until the program has stopped,
+        or 20 % plus 1 s after its duration, then ends the experiment.
         """
-        print(f"len(Flat_exp):{len(Flat_exp)}")
-        spinapi.pb_close()
-        spinapi.pb_select_board(0)
-        if spinapi.pb_init() != 0:
-            input("Please press a key to continue.")
-            exit(-1)
-        spinapi.pb_reset()
-        spinapi.pb_core_clock(500)
-        spinapi.pb_start_programming(spinapi.PULSE_PROGRAM)
-        ### muc add another for, to diviude the value_loop
-        for d in range(0, len(divided_value)):
-            value_loop = divided_value[d]
-
-            spinapi.pb_start_programming(
-                spinapi.PULSE_PROGRAM
-            )  # the pulse blaster stats writting th einstructiuons we send it
-            start = spinapi.pb_inst_pbonly(
-                int(sum(Flat_exp[0].channel_binary[0])),
-                spinapi.Inst.LOOP,
-                value_loop,
-                (Flat_exp[0].end_tail - Flat_exp[0].start_tail) * spinapi.us,
-            )  # generates a loop of instruction here only one iteration
-            print(f"Flat_exp[0].channel_binary:{Flat_exp[0].channel_binary[0]}")
-            print(
-                f"spinapi.pb_inst_pbonly({sum(Flat_exp[0].channel_binary[0])},spinapi.Inst.LOOP,{value_loop},({Flat_exp[0].end_tail-Flat_exp[0].start_tail})*spinapi.us)"
-            )
-            for i in range(
-                1, len(Flat_exp)
-            ):  # we start from one because we already did the 0 index
-                if i != len(Flat_exp) - 1:  # maybe we need to take the -1
-                    print(
-                        f"spinapi.pb_inst_pbonly({sum(list(Flat_exp[i].channel_binary[0]))},spinapi.Inst.CONTINUE,0,({Flat_exp[i].end_tail-Flat_exp[i].start_tail})*spinapi.us)"
-                    )
-                    spinapi.pb_inst_pbonly(
-                        int(sum(Flat_exp[i].channel_binary[0])),
-                        spinapi.Inst.CONTINUE,
-                        0,
-                        (Flat_exp[i].end_tail - Flat_exp[i].start_tail) * spinapi.us,
-                    )
-                else:
-                    print(
-                        f"spinapi.pb_inst_pbonly({sum(list(Flat_exp[i].channel_binary[0]))},spinapi.Inst.CONTINUE,0,({Flat_exp[i].end_tail-Flat_exp[i].start_tail})*spinapi.us)"
-                    )
-                    spinapi.pb_inst_pbonly(
-                        int(sum(Flat_exp[i].channel_binary[0])),
-                        spinapi.Inst.CONTINUE,
-                        0,
-                        (Flat_exp[i].end_tail - Flat_exp[i].start_tail) * spinapi.us,
-                    )
-                    print(
-                        f"spinapi.pb_inst_pbonly({sum(list(Flat_exp[i].channel_binary[0]))},spinapi.Inst.END_LOOP,start,{Flat_exp[i].end_tail-Flat_exp[i].start_tail}"
-                    )
-                    spinapi.pb_inst_pbonly(
-                        int(sum(Flat_exp[i].channel_binary[0])),
-                        spinapi.Inst.END_LOOP,
-                        start,
-                        Flat_exp[i].end_tail - Flat_exp[i].start_tail,
-                    )
-                spinapi.pb_inst_pbonly(
-                    int(0), spinapi.Inst.STOP, 0, 1 * spinapi.us
-                )  # This instruction stops the pulse sequence. The duration is set to a very small value to ensure the stop instruction is executed almost immediately.
-                print(
-                    f"spinapi.pb_inst_pbonly(int(0),spinapi.Inst.STOP,0,0.01*spinapi.us)"
-                )
-                spinapi.pb_stop_programming()  # This function call signals the end of programming the pulse sequence. It tells the SpinAPI library that the sequence definition is complete and the pulse program can be finalized
-                print(f"spinapi.pb_stop_programming()")
-
-            spinapi.pb_start()  # here we start the spinapi
-            start = time.perf_counter()
-            self.busy_wait_us(
-                max_end_1 * value_loop
-            )  # Intended wait: minimum wait time until the next variation
-            end = time.perf_counter()
-            print(
-                f"Actual wait: {(end - start)*1e6:.2f} µs"
-            )  # to get a glimpse of the error in wait time
-            # el el timepo total que espera el counter para seguir a la siguient variacion. Durante ese tiempo se toman todo los datos de una variacion. Aqui se debe calcular el maximo tiempo de cada variacion y multiplicar por value _loop
-            print(f"value_loop:{value_loop}")
-            spinapi.pb_stop()
-            spinapi.pb_close
-        counter.close()
-        pass
+        self._run_deadline = time.monotonic() + 1.2 * duration + 1.0
+        if self.run_timer is None:
+            self.run_timer = QTimer()
+            self.run_timer.timeout.connect(self._poll_pulse_blaster)
+        self.run_timer.start(self.poll_interval_ms)
 
-    def busy_wait_us(self, us):
-        # Convert microseconds to seconds and add it to the current time
-        # This gives us the target end time
-        end = time.perf_counter() + us / 1_000_000
+    def _poll_pulse_blaster(self):
 
-        # Loop until the current time reaches the end time
-        while time.perf_counter() < end:
-            pass  # This is a "busy wait" — doing nothing but checking the time
+        stopped = spinapi.pb_read_status() & spinapi.STATUS_STOPPED
+        if not stopped and time.monotonic() < self._run_deadline:
+            return
+        if not stopped:
+            self.error_str_signal.emit("The pulse blaster did not stop at the end of the program")
+        elif self._pending_programs:
+            # the next variation, when they are sent one at a time
+            spinapi.pb_stop()
+            self._start_next_program()
+            return
+        self.end_experiment()
 
-    def divide_iter_experiment(self, value_loop):
+    def end_experiment(self):
+        """
+        Stops the pulse blaster and the apd counter.
         """
-        here we divide the iterations of th
+        if self.run_timer is not None:
+            self.run_timer.stop()
+        self._pending_programs = []  # a stopped experiment does not start the variations left
+        spinapi.pb_stop()
+        self.finish_gated_counting()
+        self.print_program_upload_stats()
+
+    def report_dead_time(self, variation_states, value_loop, each_variation):
         """
-        #### here we divide the iterations of each varaitions by parts of 10k
-        divided_value = []
-        if value_loop <= 10000:
-            divided_value = [value_loop]  # we only repeat the big loop once
-        elif value_loop > 10000:
-            difference = 0
-            dv = value_loop // 10000  # this gives us the integer result of the fraction
-            difference = value_loop - dv * 10000
-            if difference > 0:
-                length_list = dv + 1
-            for h in range(0, length_list):
-                if h < length_list - 1:
-                    divided_value.append(10000)
-                else:
-                    divided_value.append(difference)
-        print(f"divided_value={divided_value}")
-        return divided_value
-
-        # To recieve the counts from the apd
+        Prints the restarts of the pulse blaster that one program saves, compared with sending every
+        chunk of 10k repetitions (and for type 0 every variation) as a program of its own, like it
+        was done before. The upload time saved is estimated with the measured time per instruction.
+        """
+        programs, instructions = chunked_uploads(
+            [states.size for states in variation_states], value_loop, each_variation
+        )
+        stats = self.program_cache.get_stats()
+        time_per_instruction = stats["upload_time"] / max(stats["instructions_uploaded"], 1)
+        program = stats["programs"][self.program_cache.loaded_key]  # the one program just sent
+        self.dead_time_report = {
+            "restarts_eliminated": programs - 1,
+            "instructions_eliminated": instructions - program["instructions"],
+            "upload_time_eliminated": instructions * time_per_instruction - program["last_upload_time"],
+        }
+        print(
+            f"one start instead of {programs}: {self.dead_time_report['restarts_eliminated']} restarts and "
+            f"{self.dead_time_report['upload_time_eliminated']:.3f} s of uploads eliminated"
+        )
+
+    def get_program_upload_stats(self):
+        """
+        Returns the number of uploads, the cache hits and the upload time of every program
+        sent to the pulse blaster, see PulseProgramCache.get_stats
+        """
+        return self.program_cache.get_stats()
+
+    def print_program_upload_stats(self):
+
+        stats = self.program_cache.get_stats()
+        print(
+            f"pulse blaster programs: {stats['uploads']} uploads, {stats['cache_hits']} cache hits, "
+            f"{stats['instructions_uploaded']} instructions, "
+            f"{stats['mean_upload_time'] * 1e3:.2f} ms per upload"
+        )
 
     def create_counter_task(self):
         """
@@ -568,28 +549,25 @@ class PulsedESRLogic(LogicBase):
         """spinapi.pb_stop() #stop de program
         spinapi.pb_close() # close the pusle blaster, becasue when you want to open it again it must be close for this
         """
-        pass
+        if self.run_timer is not None and self.run_timer.isActive():
+            self.end_experiment()
 
     def prepare_frame(self, frame_i):
         """Each time we change the value of the frame, it shows the corresponding frame in the graph
-        for this we need to first identify and obtain the pulses of channes who have a sequence
-        for that iterations"""
-        sequences_all_channels = []
-        tags_colors = []
-        for channel in self.channels:
-            pulses_channel = channel.a_display(
-                frame_i
-            )  # checks in the respective channel instance if it has a sequence for this frame, if it has a a sequence active_check will hold the pb_pulses
-            if (
-                pulses_channel != None
-            ):  # meaning there is a sequence in this channel per the iteration i
-                sequences_all_channels.append(pulses_channel)
-                tags_colors.append([channel.tag, channel.label])
-                pass
+        for this we send the step plot arrays of the channels who have a sequence for that iteration.
+        The arrays come from the step_plots cache, so going back to a frame or replaying the
+        simulation does not build them again"""
+        step_plots = self.step_plots.get(
+            frame_i, [channel.binary for channel in self.channels], self.Max_end_time
+        )  # (index of the channel, x, y) of the channels with pulses in this frame
+        tags_colors = [
+            [self.channels[index].tag, self.channels[index].label]
+            for index, _, _ in step_plots
+        ]
         self.frame_data_signal.emit(
-            tags_colors, sequences_all_channels, frame_i, self.Max_end_time
+            tags_colors, [(x, y) for _, x, y in step_plots], frame_i, self.Max_end_time
         )
- 
+
     def Run_Simulation(self, initial_frame, value_loop, ms_value):
         """
         Starts or stops the simulation when the button is clicked.
@@ -644,6 +622,7 @@ class PulsedESRLogic(LogicBase):
         self.channel_labels = []
         self.Delays_channel = []
         self.Experiment_Hub = []
+        self.pulse_table.clear()
         self.Max_end_time = 0
         self.dev = "Dev1"
         self.counter_pin = "ctr0"
@@ -673,13 +652,13 @@ class PulsedESRLogic(LogicBase):
 
 class Channel(QObject):
 
-    def __init__(self, tag, binary, label, delay):
+    def __init__(self, tag, binary, label, delay, pulse_table):
         super().__init__()  # Call the base class's __init__ method
         # for each channel
         self.tag = tag  # the channel tag (ex: PB0, PB1, etc)
         self.label = label
         self.delay = delay
-        self.Sequence_hub = []  # in this list we keep all the sequences creates
+        self.pulse_table = pulse_table  # the pulses of the channel are added to the table of the experiment
         self.error_flag = False  # Flag to track if an error occurred
         self.binary = binary
 
@@ -690,9 +669,9 @@ class Channel(QObject):
     ):
         max_end_time = 0
         """
-        First we check if the pulse can exist, then we need to check if the user wants to add or edit a pulse, 
-        then we add the pulses to the sequences and fuse pulses if needed. Finally we sort the whole self.Sequence_hub
-        by order of iteration. 
+        First we check if the pulse can exist, then we calculate the pulse for every iteration
+        and add them to the pulse table, where they are fused with the overlapping pulses
+        of the same channel and iteration.
         """
         #### Checking for errors####
         if self.delay[1] >= width:
@@ -711,332 +690,30 @@ class Channel(QObject):
             return None
         ############################
 
-        """ here we need to make for example if iter 
-            range [50,55] --> [1,2,3,4,5,6] to plug it into 
-            the function for the new width
+        """ the width and start time functions are evaluated for the whole iteration range at once,
+            for example iter range [50,55] --> i=[1,2,3,4,5,6] to plug it into the function
         """
-
-        for k in range(
-            iteration_range[0], iteration_range[1] + 1
-        ):  # we iterate through the iteration range, +1 for it to include the [50,55] last bracket term
-            print(f"iteration_channel_class: {k}")
-
-            """ now we need to calculate the width of the pulse, by plugging the initial width and the current 
-            iteration on the function."""
-
-            # parameter to be replaced in the function
-            """generator expression: enumerate provides both the index and the element while iteratinf throught the list. next() efficiently 
-                finds the first match without iterating through the entire list"""
-            index = next(
-                (
-                    j
-                    for j, sequence in enumerate(self.Sequence_hub)
-                    if sequence.iteration == k
-                ),
-                None,
+        try:
+            iterations, start_times, widths = sweep_pulse(
+                start_time, width, function_width, function_start, iteration_range
             )
-            print(f"index:{index}")
-
-            new_width = width
-            new_start_time = start_time
-            if function_width != "":  # the pulse added varies in width (duration)
-                # vthe variables on the funct_str must be W and i
-                W = width
-                i = (
-                    k - iteration_range[0] + 1
-                )  # here we need to make for example if iter range [50,55] and i=50 we need x=1, the +1 is for it to start in 1 and not 0
-                new_width = eval(function_width)  # varied width
-                print(f"function width:{function_width}, new_width:{new_width}")
-
-                # print(f"varied_width: {new_width}")
-            if function_start != "":  # the pulse added varies in start_time
-                S = start_time
-                i = k - iteration_range[0] + 1
-                new_start_time = eval(function_start)  # varied width
-                print(
-                    f"function start_time:{function_start}, new_start_time:{new_start_time}"
-                )
-
-            new_end_time = new_start_time + new_width
-            if new_end_time > max_end_time:
-                max_end_time = new_end_time  # we do this to keep track of the biggest end time of the added pulse to then compare to the biggest end time of every iteration, this is gonna be eventually used for display
-
-            if index == None:  # no sequences created
-                sequence_inst = Sequence(k, self.tag, self.binary)
-                print(f"first sequence on{k} created")
-                sequence_inst.add_pulse(
-                    new_start_time, new_width, self.delay[0], self.delay[1]
-                )
-                self.Sequence_hub.append(sequence_inst)
-                # sequence_inst.error_adding_pulse.connect(self.error_adding_pulse_channel.emit)
-
-                # error: because when i=1 after i=0 a Sequence is created but it's on sequence_hub[0] thus sequence_hub[1] will be out of range
-            elif (
-                self.Sequence_hub[index].iteration == k
-            ):  # this means there is already a sequence for this iteration
-                print(f"sequence edited in {k}")
-                self.Sequence_hub[index].add_pulse(
-                    new_start_time, new_width, self.delay[0], self.delay[1]
-                )  # we add the pulse to the sequence)
-
-        self.Sequence_hub = sorted(
-            self.Sequence_hub, key=lambda sequence: sequence.iteration
-        )  # Sort (order) the  self.Sequence_hub list by the `iteration` attribute
+        except ValueError as e:
+            self.error_adding_pulse_channel.emit(str(e))
+            return None
+        # we keep track of the biggest end time of the added pulse to then compare to the biggest end time of every iteration, this is gonna be eventually used for display
+        if iterations.size > 0:
+            max_end_time = max(max_end_time, (start_times + widths).max().item())
+
+        self.pulse_table.add(
+            iterations,
+            self.binary,
+            start_times - self.delay[0],
+            start_times + widths - self.delay[1],  # with delays
+            start_times,
+            start_times + widths,  # without delays
+        )
         return max_end_time
 
-    def a_experiment(self, i):
-        """if we find a sequence for the iteration i we return the values if not we return None.
-        This method is mainly to fetch data for the experiment"""
-        for seq in self.Sequence_hub:
-            if seq.iteration == i:
-                return [
-                    seq.pb_pulses,
-                    seq.max_end_time_pb,
-                ]  # since its for the experiment we only need to do pb_  for this
-        return None
-
-    def a_display(self, i):
-        """if we find a sequence for the iteration i we return the values if not we return None.
-        This method is mainly to fetch data for the display"""
-        for seq in self.Sequence_hub:
-            if seq.iteration == i:
-                return (
-                    seq.pulses
-                )  # since its for the experiment we only need to do pb_  for this
-        return None
-
-
-class Sequence(
-    QObject
-):  # A sequence per iteration ( 1 frame), QObject allows signasl to work
-    def __init__(self, iteration, tag, binary):
-        super().__init__()  # Call the base class's __init__ method
-        self.tag = tag  # the channel tag (ex: PB0, PB1, etc)
-        self.binary = binary
-        self.iteration = iteration  # iteration of the sequence, meaning ex: the sequence appears in the 50th iteration of the experiment
-        self.pb_pulses = (
-            []
-        )  # this is the list of the instances of pulses of this particular sequence that will be sent to the pulse blaster (accounting for delays)
-        self.pulses = (
-            []
-        )  # this is the list of the instances of pulses shown in the simulation.
-        # elf.Channel_Pulse_iter=[] # this is the list of the pulses in the channel, it will be used to check for overlapping, WE MIGHT NOT NEED THIS
-        self.max_end_time_pb = 0  # this is the end time of the sequence, it will be used to check if the pulse blaster is ready to send the next sequence
-        self.max_end_time = 0
-
-    ######   ••••••ADDING A PULSE •••••••
-    def add_pulse(self, start_time, width, delay_on, delay_off):
-        end_tail = start_time + width
-        start_tail = start_time
-        pulse = Pulse(start_tail, end_tail, self.binary)  # without delays
-
-        end_tail = start_time + width - delay_off
-        start_tail = start_time - delay_on
-        pulse_pb = Pulse(start_tail, end_tail, self.binary)  # with delays
-        if (
-            end_tail > self.max_end_time_pb
-        ):  # we upddate the max end time fo the sequence if necessary
-            self.max_end_time_pb = end_tail
-        status = self.check_pulse_fusion(
-            pulse_pb, pulse
-        )  # check if the pulse doensnt overlap
-        print(f"Fusion?: {status[2]}, new pulse:{status[0]}")
-        if status[2] == True:  # if there is no overlap with the fixed pulses
-            new_pulse_pb = Pulse(
-                status[0][0], status[0][1], self.binary
-            )  # we create a new pulse with the fused intervals
-            new_pulse = Pulse(status[1][0], status[1][1], self.binary)
-            self.pb_pulses.append(new_pulse_pb)
-            self.pulses.append(new_pulse)
-            print(
-                f"pb_pulses added: {new_pulse_pb.start_tail}, {new_pulse_pb.end_tail}"
-            )
-        else:
-            self.pb_pulses.append(pulse_pb)
-            self.pulses.append(pulse)
-            print(f"pb_pulses added: {pulse_pb.start_tail} {pulse_pb.end_tail}")
-        # now we need to sort the pb_pulses by the start tail
-        self.pb_pulses = sorted(
-            self.pb_pulses, key=lambda pb: pb.start_tail
-        )  # Sort (order) the  self.pb_pulses list by the `start_tail` attribute
-        self.pulses = sorted(self.pulses, key=lambda pulse: pulse.start_tail)
-        for i in range(len(self.pb_pulses)):
-            print(
-                f"pb_pulses{i}: [{self.pb_pulses[i].start_tail}, {self.pb_pulses[i].end_tail}]"
-            )
-
-    def check_pulse_fusion(self, pulse_pb, pulse):
-        """
-        Here we must aim o see if the corresponding pulse overlaps with any of the the pb_pulses
-        """
-        # the value of the channel
-        # we need to adjust the intervals to account for the delays
-        # including the delays
-        start_tail_pb = pulse_pb.start_tail
-        end_tail_pb = pulse_pb.end_tail
-        start_tail = pulse.start_tail
-        end_tail = pulse.end_tail
-
-        overlap_fixed_pulses = False  # we define this variable to let the system know when there is an overlap with the fixed pulses
-        # we define this variable to let the system know when there is an overlap with the fixed pulses
-
-        if (
-            len(self.pb_pulses) > 0
-        ):  # if there are other puslse on the same channel we need to check for overlapping, and we also check if the list on the index has a sublist
-            global_fusion_pb = (
-                []
-            )  # we create a list to store the fused pulses, and then check which one is the biggest
-            global_fusion = []
-
-            indexes_delete = []  # indexes we will delete later
-            for j in range(
-                len(self.pb_pulses)
-            ):  # we iterate over the pb_pulses in the respective channel, to check for overlapping
-                Partially_Left = False
-                Partially_Right = False
-                Completely_Inside = False
-                Completely_Ontop = False
-                # print(f"pb_pulses per iteration{j}: {self.pb_pulses[j].start_tail}, {self.pb_pulses[j].end_tail}")
-                Partially_Left = (
-                    self.pb_pulses[j].start_tail <= end_tail_pb
-                    and self.pb_pulses[j].start_tail > start_tail_pb
-                    and self.pb_pulses[j].end_tail >= end_tail_pb
-                )  # if the the new pulse finishes after the start of the previous pulse and starts before the start of the previous pulse
-                Partially_Right = (
-                    self.pb_pulses[j].end_tail >= start_tail_pb
-                    and self.pb_pulses[j].start_tail < start_tail_pb
-                    and self.pb_pulses[j].end_tail <= end_tail_pb
-                )  # if the new pulse finishes after the end of the previous pulse and starts before the end of the previous pulse
-                Completely_Inside = (
-                    self.pb_pulses[j].start_tail <= start_tail_pb
-                    and self.pb_pulses[j].end_tail >= end_tail_pb
-                )  # if the new pulse starts after the start of the previous pulse and finishes before the end of the previous pulse
-                Completely_Ontop = (
-                    self.pb_pulses[j].start_tail >= start_tail_pb
-                    and self.pb_pulses[j].end_tail <= end_tail_pb
-                )
-                """ Our objetvies it to fuse the overlapping pulses, into one pulse"""
-                if Partially_Left == True:
-                    "we fuse the pulses together"
-                    fused_pulse_pb = [start_tail_pb, self.pb_pulses[j].end_tail]
-                    fused_pulse = [start_tail, self.pulses[j].end_tail]
-                    global_fusion_pb.append(fused_pulse_pb)
-                    global_fusion.append(fused_pulse)
-                    overlap_fixed_pulses = True
-                    print(f"Partially Left")
-
-                elif Partially_Right == True:
-                    fused_pulse_pb = [self.pb_pulses[j].start_tail, end_tail_pb]
-                    fused_pulse = [self.pulses[j].start_tail, end_tail]
-                    global_fusion_pb.append(fused_pulse_pb)
-                    global_fusion.append(fused_pulse)
-                    overlap_fixed_pulses = True
-                    print(f"Partially Right")
-
-                elif Completely_Inside == True:
-                    fused_pulse_pb = [
-                        self.pb_pulses[j].start_tail,
-                        self.pb_pulses[j].end_tail,
-                    ]
-                    fused_pulse = [self.pulses[j].start_tail, self.pulses[j].end_tail]
-                    global_fusion_pb.append(fused_pulse_pb)
-                    global_fusion.append(fused_pulse)
-                    overlap_fixed_pulses = True
-                    print(f"Completely Inside")
-
-                elif Completely_Ontop == True:
-                    fused_pulse_pb = [start_tail_pb, end_tail_pb]
-                    fused_pulse = [start_tail, end_tail]
-                    global_fusion_pb.append(fused_pulse_pb)
-                    global_fusion.append(fused_pulse)
-                    overlap_fixed_pulses = True
-                    print(f"Completely Ontop")
-                    # now we delete the pulses that we fused, so they dont overlap with the new pulse
-                if (
-                    Partially_Left == True
-                    or Partially_Right
-                    or Completely_Inside == True
-                    or Completely_Ontop
-                ):
-                    indexes_delete.append(j)
-                    # print(f"index to delete{j}")
-
-            if len(global_fusion_pb) > 0:  # we fuse everything that was fused
-                fused_pulse_pb = self.fuse_pulses(
-                    global_fusion_pb
-                )  # we find the biggest pulse t
-                # print(f"GLobal_fused_pulse:{global_fusion_pb} and fuse pulses:{fused_pulse_pb}")
-                fused_pulse = self.fuse_pulses(global_fusion)
-                for index in sorted(indexes_delete, reverse=True):
-                    """
-                    we delete the pulses that were already fused from the list
-                    is used in the sorted() function to sort the indices in
-                    descending order (from largest to smallest). This ensures that
-                      when you delete elements from the list using their indices, you start
-                      with the largest index first.
-                      here we run with a typical
-                    """
-                    # print(f"pulse to be deleted:{self.pb_pulses[index].start_tail,self.pb_pulses[index].end_tail}")
-                    del self.pb_pulses[index]
-                    del self.pulses[index]
-
-                return [fused_pulse_pb, fused_pulse, overlap_fixed_pulses]
-
-            else:
-                return [
-                    [start_tail_pb, end_tail_pb],
-                    [start_tail, end_tail],
-                    overlap_fixed_pulses,
-                ]
-
-        else:
-            return [
-                [start_tail_pb, end_tail_pb],
-                [start_tail, end_tail],
-                overlap_fixed_pulses,
-            ]
-
-    def fuse_pulses(self, pulse_list):
-        """
-        When 2 or more pulses overlap, we need to fuse them into one pulse, this is done by taking the start and end time
-          of the pulses and creating a new pulse with the start and end time of the overlapping pulses
-          however there might be multiple overlapping pulses, so we neeed to fuse them all together
-        """
-        min_value = min(pulse_list, key=lambda x: x[0])[0]
-        max_value = max(pulse_list, key=lambda x: x[1])[1]
-        return [min_value, max_value]
-
-    def clear(self):
-        self.pulse_list = []
-
-    def get_display_list(self):
-        """
-        Returns a list with the pulse information for display.
-
-        # Probably need some adjustments
-        """
-        display_list = []
-        """for pulse in self.pulse_list:
-            display_list.append((pulse.pulse_delay, pulse.pulse_width, pulse.pulse_channel_tag))"""
-        return display_list
-
-    ##### •••••• EXPERIMENT
-    def experiment(self):
-        pass
-
-
-class Pulse:
-
-    def __init__(
-        self, start_tail, end_tail, channel_binary
-    ):  # we dont need the delay, right??
-        self.start_tail = start_tail
-        self.end_tail = end_tail
-        # self.channel_tag=[channel_tag] #we make it a list because later when creating the experiment, we might have 2 pulses from different channels that start at the same time.
-        self.channel_binary = [
-            channel_binary
-        ]  # might be better to recieve the value fo the channel in binary, because later the convertion will take a lot of time
-
 
 class Experiment(QObject):
     """
@@ -1046,7 +723,7 @@ class Experiment(QObject):
     def __init__(self, Exp_i_pb, iteration):
         super().__init__()
         self.Exp_i_pb = Exp_i_pb
-        self.pb_sequence = []
+        self.states = np.zeros(0, dtype=STATE_DTYPE)
         self.iteration = iteration
         self.max_end_time_pb = 0
 
@@ -1056,59 +733,18 @@ class Experiment(QObject):
         else:  # send error message
             pass
 
-        print(f"len(self.pb_sequence):{len(self.pb_sequence)}")
-        for pulse in self.pb_sequence:  
-            # this is just to show that it0s working it should be taken away later
-            print(
-                f"Pulse start:{pulse.start_tail}, end:{pulse.end_tail}, channel:{pulse.channel_binary}"
-            )
-
     def Order_Exp_i_pb(self):
-        """To order the list Exp_pb.
-        Exp_pb=[pb,pb,pb...] were each pb is a list of objetcs for example
-        for one pb=[pulse1, pulse2,..] were each pulse has 3 atributes,
-        one is the start time another other is the end time, and the last
-        atribute is the channel tag, which is a list with the channels of this pulse."""
-
-        # Step 1: Flatten all the pulse sequences into one list
-        all_pulses = [
-            pulse for pb_pulse_list in self.Exp_i_pb for pulse in pb_pulse_list
-        ]
-        events = []
-        # Step 2: Create events from every pulse's start and end times, per channel
-        for pulse in all_pulses:
-            for ch in pulse.channel_binary:
-                events.append((pulse.start_tail, 0, ch))  # 0 = Start event
-                events.append((pulse.end_tail, 1, ch))  # 1 = end event
-        # Step 3: Sort events chronologically; starts before ends if times equal
-        events.sort()
-
-        self.pb_sequence = []
-        active_channels = set()
-        last_time = 0  # Start from 0 even if first pulse starts later
-
-        # Step 4: Sweep through time and build new Pulse objects for each interval
-        for time, event_type, channel in events:
-            # Fill in idle gap if needed
-            sorted_channels = sorted(
-                active_channels.copy()
-            )  ######### to transform them into a list
-            # If the time has moved forward and some channels are active, record a Pulse
-            if (
-                last_time < time
-            ):  # Fill in idle gap if needed with an empty pulse channel 0
-                if active_channels:
-                    self.pb_sequence.append(Pulse(last_time, time, sorted_channels))
-                else:
-                    self.pb_sequence.append(Pulse(last_time, time, [0]))  # idle pulse
-            # Update active channel set
-            if event_type == 0:
-                active_channels.add(channel)  # Pulse started
-            else:
-                active_channels.discard(channel)  # Pulse ended
-
-            # Update the time marker
-            last_time = time
+        """To order the pulses of the variation.
+        Exp_i_pb is the slice of the pulse table with the pulses of all channels in this
+        variation, each row has the start time, the end time and the channel (binary) of a pulse.
+        The pulses of every channel are already fused, so they don't overlap, and
+        flatten_pulses turns them into the consecutive states of the outputs."""
+
+        # The states of the outputs: (start, duration, channels) where channels is the
+        # OR of the binary of all channels that are on, idle states have channels 0
+        self.states = flatten_pulses(
+            self.Exp_i_pb["start"], self.Exp_i_pb["end"], self.Exp_i_pb["channel"]
+        )
 
         return
 
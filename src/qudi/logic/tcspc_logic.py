@@ -12,6 +12,14 @@ from qudi.core.configoption import ConfigOption
 from qudi.util.mutex import Mutex
 from qudi.util.datastorage import TextDataStorage, ImageFormat
 from qudi.logic.filemanager import FileManager
+from qudi.hardware.tcspc.spc_fifo import (
+    SPCFifoDecoder, SPCFifoPhotonDecoder, PhotonStreamMerger, ROUT_MASK, MT_BITS
+)
+from qudi.logic.photon_stream import PhotonStreamRecorder
+from qudi.logic.fit_lifetime import PhasorAccumulator
+from qudi.logic.photon_correlation import PhotonCorrelator, linear_lag_edges
+from qudi.logic.intensity_trace import IntensityTraceBinner
+from qudi.logic.kinetic_series import KineticSeriesRecorder
 import numpy as np
 import bh_spc
 from bh_spc import spcm
@@ -35,6 +43,7 @@ class TCSPCData:
     parameters: TCSPCParameterData = TCSPCParameterData()
     time_bins: np.ndarray = np.array([])
     histogram: np.ndarray = np.array([])
+    channel_histograms: np.ndarray = np.array([])
 
 
 # qudi logic measurement modules must inherit qudi.core.module.LogicBase or other logic modules.
@@ -57,9 +66,54 @@ class TCSPCLogic(LogicBase):
     file_changed_signal = Signal(str)
     track_point_signal = Signal()
     progress_signal = Signal(int)
+    fifo_stats_signal = Signal(dict)
+    photon_file_signal = Signal(str)
+    kinetic_series_file_signal = Signal(str)
+    lifetime_estimate_signal = Signal(dict)
+    g2_signal = Signal(np.ndarray, np.ndarray)
+    intensity_trace_signal = Signal(np.ndarray, np.ndarray)
+    rate_history_signal = Signal(np.ndarray, np.ndarray)
 
     # Declare static parameters that can/must be declared in the qudi configuration
     #_increment_interval = ConfigOption(name='increment_interval', default=1, missing='warn')
+    # Macro time clock period of the module in seconds, stored with the
+    # photon streams so the macro times can be converted to seconds.
+    _macrotime_unit = ConfigOption(name='macrotime_unit', default=50e-9)
+    # Laser repetition rate in MHz and bins without fluorescence, used for
+    # the live phasor lifetime estimate
+    _laser_frequency = ConfigOption(name='laser_frequency', default=20)
+    _phasor_background_bins = ConfigOption(name='phasor_background_bins', default=None)
+    # Phasor [g, s] of the IRF (or of a sample with zero lifetime) at the
+    # laser frequency, the measured phasor is divided by it to remove the
+    # instrument delay. It can also be measured with
+    # calibrate_phasor_reference. Without it the phase of the phasor includes
+    # the delay of the instrument, so only tau_modulation of the estimate is
+    # meaningful and tau_phase is not.
+    _phasor_reference_config = ConfigOption(name='phasor_reference', default=None)
+    # Live g2 between two routing channels. The micro time can only be
+    # added to the macro time when the macro time clock is the SYNC. With
+    # several modules the channel of routing channel r of the i-th module
+    # is i * 16 + r.
+    _g2_channels = ConfigOption(name='g2_channels', default=[0, 1])
+    _g2_max_lag = ConfigOption(name='g2_max_lag', default=5e-6)
+    _g2_bin_width = ConfigOption(name='g2_bin_width', default=50e-9)
+    _g2_use_microtime = ConfigOption(name='g2_use_microtime', default=False)
+    # Intensity trace binned from the macro times, in seconds
+    _trace_bin_width = ConfigOption(name='trace_bin_width', default=10e-3)
+    _trace_window = ConfigOption(name='trace_window', default=10.0)
+    # Length of the time slices of the kinetic series, in seconds
+    _kinetic_slice_width = ConfigOption(name='kinetic_slice_width', default=1.0)
+    # A module without photons has no records, so the time its photon
+    # stream has reached is taken from the measurement time, less this
+    # margin in seconds for records still on the way to the reader
+    _fifo_idle_margin = ConfigOption(name='fifo_idle_margin', default=0.1)
+    # 'fifo' streams the photons, 'memory' builds the histograms in the
+    # memory of the modules and reads them after every display time
+    _acquisition_mode = ConfigOption(name='acquisition_mode', default='fifo')
+    # Seconds between two checks for a finished memory bank
+    _memory_poll_interval = ConfigOption(name='memory_poll_interval', default=0.05)
+    # Seconds between two readings of the rate counters
+    _rate_interval = ConfigOption(name='rate_interval', default=1.0)
 
     # Declare status variables that are saved in the AppStatus upon deactivation of the module and
     # are initialized to the saved value again upon activation.
@@ -92,9 +146,31 @@ class TCSPCLogic(LogicBase):
         self.track_intensity = False
         self.measurement_paused = False
         self.skip_next_rate = False
+        self._last_rate_time = None
+        self.record_photons = False
+        self.compute_g2 = False
+        self.compute_intensity_trace = False
+        self.record_kinetic_series = False
+        self._kinetic_series = None
+        self._modules = [0]
+        self._memory_mode = False
+        self._fifo_decoders = []
+        self._photon_decoders = []
+        self._photon_merger = None
+        self._correlator = None
+        self._intensity_trace = None
+        self._segment_origin = 0
+        self._photon_recorder = None
+        self._phasor = None
+        self._phasor_reference = None  # complex phasor of the IRF, see calibrate_phasor_reference
 
     def on_activate(self) -> None:
 
+        self.acquisition_mode = self._acquisition_mode
+        if self._phasor_reference_config is not None:
+            g, s = self._phasor_reference_config
+            self._phasor_reference = complex(g, s)
+
         # Set up a Qt timer to send periodic signals according to _increment_interval
         self.__timer = QTimer(parent=self)
         self.__timer.setInterval(1000 / 2)  # Interval in milliseconds
@@ -119,13 +195,21 @@ class TCSPCLogic(LogicBase):
         self.__rates_timer.timeout.disconnect()
         self.__rates_timer = None
 
+        self._tcspc_hardware().stop_rate_poller()
+        self.close_photon_recorder()
+        self.close_kinetic_series()
+
     def init_spc(self):
 
         with self._mutex:
             status = self._tcspc_hardware().initialise_tcspc(simulation=False)
             self.log.info(f'Initialisation status: {status}')
-            self._tcspc_hardware().clear_rates(0)
-            self._tcspc_hardware().get_SPC_params_from_module(0)
+            self._modules = self._tcspc_hardware().get_modules()
+            for module_no in self._modules:
+                self._tcspc_hardware().clear_rates(module_no)
+            # The parameters and the rates are those of the first module
+            self._tcspc_hardware().get_SPC_params_from_module(self._modules[0])
+            self._tcspc_hardware().start_rate_poller(self._modules[0], self._rate_interval)
             self.__rates_timer.start()
             self.get_all_parameters()
 
@@ -142,43 +226,73 @@ class TCSPCLogic(LogicBase):
             self.__rates_timer.start()
 
     def get_rates(self):
+        """
+        Emits the newest reading of the rate poller and the rate history.
 
-        keep_reading = True
-        with self._mutex:
-            while keep_reading:
-                try:
-                    rates = self._tcspc_hardware().read_rate_counter(0)
-                    keep_reading = False
-                except Exception as e:
-                    pass
-                    
-            self.rate_values = (
-                rates.sync_rate,
-                rates.cfd_rate,
-                rates.tac_rate,
-                rates.adc_rate
-            )
-            self.sig_rate_values.emit(self.rate_values)
-            self.log.debug(f'Rates: {self.rate_values}')
-            if self.skip_next_rate:
-                self.skip_next_rate = False
-                return
-            if self.track_intensity:
-                if self.rate_values[1] < self.reference_intensity * self.intensity_percent / 100:
-                    self.log.info('Intensity dropped below threshold')
-                    if self.continue_acquisition:
-                        self.log.info('Pausing measurement')
-                        self.pause_measurement()
-                        self.track_intensity = False
-                        self.track_point_signal.emit()
+        The rates are read from the module by the rate poller thread of
+        the hardware, so this never waits for the module and does not take
+        the mutex used while reading the FIFO.
+        """
+        latest = self._tcspc_hardware().get_latest_rates()
+        if latest is None or latest[0] == self._last_rate_time:
+            return
+        self._last_rate_time, self.rate_values = latest
+        self.sig_rate_values.emit(self.rate_values)
+        self.rate_history_signal.emit(*self._tcspc_hardware().get_rate_history())
+        self.log.debug(f'Rates: {self.rate_values}')
+        if self.skip_next_rate:
+            self.skip_next_rate = False
+            return
+        if self.track_intensity and self._intensity_trace is None:
+            self.check_intensity(self.rate_values[1])
+
+    def check_intensity(self, rate: float):
+        """
+        Pauses the measurement and requests tracking when the count rate
+        dropped below the intensity threshold.
+        """
+        if rate < self.reference_intensity * self.intensity_percent / 100:
+            self.log.info('Intensity dropped below threshold')
+            if self.continue_acquisition:
+                self.log.info('Pausing measurement')
+                self.pause_measurement()
+                self.track_intensity = False
+                self.track_point_signal.emit()
 
-    def start_fifo_measurement(self):
+    @Slot(str)
+    def set_acquisition_mode(self, mode: str):
+        """
+        Selects the mode of the next measurement, 'fifo' or 'memory'.
+        """
+        if mode not in ('fifo', 'memory'):
+            self.log.error(f'Unknown acquisition mode {mode}')
+            return
+        self.acquisition_mode = mode
+        self.log.info(f'Acquisition mode set to {mode}')
 
-        self.log.info('Measurement started')
+    @Slot()
+    def start_measurement(self):
+        """
+        Starts a measurement in the selected acquisition mode.
+        """
+        if self.acquisition_mode == 'memory':
+            self.start_memory_measurement()
+        else:
+            self.start_fifo_measurement()
 
-        #self._laser_controller_logic()._bh_laser_hardware().frequency = 20
-        self.time_bins = np.arange(4096)
-        self.data.histogram = np.zeros(4096 - 1, dtype=np.uint32)
+    def _init_histograms(self, n_bins: int):
+        """
+        Allocates the histograms of all modules and the phasor and reads
+        the time axis from the TAC settings.
+
+        Returns
+        -------
+        tuple
+            (display_time, collect_time) in s
+        """
+        self._modules = self._tcspc_hardware().get_modules()
+        self.data.channel_histograms = np.zeros((len(self._modules), n_bins), dtype=np.int64)
+        self.data.histogram = self.data.channel_histograms.sum(axis=0)
         tac_range = self._tcspc_hardware().get_SPC_param('tac_range')
         tac_gain = self._tcspc_hardware().get_SPC_param('tac_gain')
         display_time = self._tcspc_hardware().get_SPC_param('display_time')
@@ -189,13 +303,42 @@ class TCSPCLogic(LogicBase):
         self.data.parameters.tac_range = tac_range
         self.data.parameters.tac_gain = tac_gain
 
-        self.time_conversion = tac_range / (4096 * tac_gain)
-
-        self.__timer.setInterval(1000 * display_time)
-        self._tcspc_hardware().init_fifo_measurement(0)
-        self._tcspc_hardware().start_measurement(0)
+        self.time_conversion = tac_range / (n_bins * tac_gain)
+        self.data.time_bins = np.arange(n_bins) * self.time_conversion
+        # The time bins are in ns, so the frequency is given in GHz
+        self._phasor = PhasorAccumulator(
+            self.data.time_bins, self._laser_frequency * 1e-3,
+            background_bins=self._phasor_background_bins,
+            reference=self._phasor_reference
+        )
+        return display_time, collect_time
 
-        self.buf_size = 32768
+    @Slot()
+    def calibrate_phasor_reference(self):
+        """
+        Takes the phasor of the histogram last measured or loaded as the
+        reference of the live lifetime estimate. The histogram must be that of
+        the IRF, e.g. measured on a scattering sample, with the same TAC
+        settings and laser frequency as the following measurements.
+        """
+        if not self.data.histogram.any():
+            self.log.warning('Measure the IRF histogram before calibrating the phasor reference')
+            return
+        irf = PhasorAccumulator(
+            self.data.time_bins, self._laser_frequency * 1e-3,
+            background_bins=self._phasor_background_bins
+        )
+        irf.update(self.data.histogram)
+        reference = irf.phasor
+        if not np.isfinite(reference.real) or reference == 0:
+            self.log.warning('The IRF histogram has no counts above the background')
+            return
+        self._phasor_reference = reference
+        if self._phasor is not None:
+            self._phasor.reference = reference
+        self.log.info(f'Phasor reference g = {reference.real:.4f}, s = {reference.imag:.4f}')
+
+    def _start_progress(self, collect_time, display_time):
 
         self.progress = 0
         self.time_left = collect_time
@@ -207,6 +350,79 @@ class TCSPCLogic(LogicBase):
         self.max_counter = int(collect_time / display_time)
         self.start_time = time.monotonic()
         self.__timer.start()
+
+    def start_memory_measurement(self):
+        """
+        Starts a measurement in the histogram (memory) mode.
+
+        The modules stop after every display time and are restarted in
+        their other memory bank, while the histograms of the finished
+        period are read and added, see `consume_memory_pages`. The
+        measurement ends after the collection time.
+        """
+        self.log.info('Memory measurement started')
+        n_bins = self._tcspc_hardware().init_memory_measurement()
+        display_time, collect_time = self._init_histograms(n_bins)
+        self._memory_mode = True
+        self._fifo_decoders = []
+        self._photon_decoders = []
+        self._photon_merger = None
+        self._correlator = None
+        self._intensity_trace = None
+        # The modules stop after every display time, the collection time of
+        # the measurement is counted here
+        self._tcspc_hardware().set_SPC_param('collect_time', display_time)
+        for module_no in self._modules:
+            self._tcspc_hardware().start_memory_measurement(module_no)
+
+        self.__timer.setInterval(1000 * min(display_time, self._memory_poll_interval))
+        self._start_progress(collect_time, display_time)
+
+    def start_fifo_measurement(self):
+
+        self.log.info('Measurement started')
+
+        #self._laser_controller_logic()._bh_laser_hardware().frequency = 20
+        display_time, collect_time = self._init_histograms(4096)
+        self._memory_mode = False
+        # One decoder per module, each accumulating into its row of the
+        # channel histograms
+        self._fifo_decoders = [SPCFifoDecoder(n_bins=4096) for _ in self._modules]
+        for decoder, histogram in zip(self._fifo_decoders, self.data.channel_histograms):
+            decoder.histogram = histogram
+
+        self.__timer.setInterval(1000 * display_time)
+        self._tcspc_hardware().init_fifo_measurement(self._modules[0])
+        for module_no in self._modules:
+            self._tcspc_hardware().start_measurement(module_no)
+
+        self.buf_size = 32768
+        self._lost_records = 0
+        self._fifo_overflows = 0
+        self._photon_decoders = [SPCFifoPhotonDecoder() for _ in self._modules]
+        self._photon_merger = PhotonStreamMerger(len(self._modules))
+        self._segment_origin = 0  # macro time of the start of the running segment
+        self.open_photon_recorder()
+        self.open_kinetic_series()
+        self._correlator = None
+        if self.compute_g2:
+            microtime_unit = self.time_conversion * 1e-9 if self._g2_use_microtime else 0.0
+            self._correlator = PhotonCorrelator(
+                linear_lag_edges(self._g2_max_lag, self._g2_bin_width),
+                *self._g2_channels,
+                macrotime_unit=self._macrotime_unit,
+                microtime_unit=microtime_unit
+            )
+        self._intensity_trace = None
+        if self.compute_intensity_trace:
+            self._intensity_trace = IntensityTraceBinner(
+                self._trace_bin_width, self._trace_window,
+                macrotime_unit=self._macrotime_unit
+            )
+        for module_no in self._modules:
+            self._tcspc_hardware().start_fifo_reader(module_no, self.buf_size)
+
+        self._start_progress(collect_time, display_time)
     
     @Slot()
     def track_interval_triggered(self):
@@ -221,7 +437,13 @@ class TCSPCLogic(LogicBase):
         self.measurement_paused = False
         self.__timer.stop()
         self.log.info('Stopping measurement')
-        self._tcspc_hardware().stop_measurement(0)
+        self._stop_acquisition()
+        if self._memory_mode:
+            self._tcspc_hardware().set_SPC_param(
+                'collect_time', self.data.parameters.collect_time
+            )
+        self.close_photon_recorder()
+        self.close_kinetic_series()
 
     @Slot()
     def pause_measurement(self):
@@ -229,50 +451,211 @@ class TCSPCLogic(LogicBase):
         self.measurement_paused = True
         self.__timer.stop()
         self.log.info('Measurement paused')
-        self._tcspc_hardware().stop_measurement(0)
+        self._stop_acquisition()
+
+    def _stop_acquisition(self):
+        """
+        Stops the modules and processes the data measured until then.
+        """
+        if self._memory_mode:
+            self.consume_memory_pages(final=True)
+            return
+        for module_no in self._modules:
+            self._tcspc_hardware().stop_measurement(module_no)
+        self._tcspc_hardware().stop_fifo_reader()
+        self.consume_fifo_records(final=True)
 
     @Slot()
     def restart_measurement(self):
 
-        self.time_left = self._tcspc_hardware().get_SPC_param('collect_time') - self.elapsed_time
+        self.time_left = self.data.parameters.collect_time - self.time_from_start - self.elapsed_time
         self.time_from_start += self.elapsed_time
-        self._tcspc_hardware().set_SPC_param('collect_time', self.time_left)
-        setted_time_left = self._tcspc_hardware().get_SPC_param('collect_time')
 
         self._laser_controller_logic()._bh_laser_hardware().frequency = 20
-        self._tcspc_hardware().start_measurement(0)
+        if self._memory_mode:
+            for module_no in self._modules:
+                self._tcspc_hardware().start_memory_measurement(module_no)
+            self.start_time = time.monotonic()
+            self.__timer.start()
+            self.continue_acquisition = True
+            self.measurement_paused = False
+            self.log.info('Measurement restarted')
+            return
+        setted_time_left = self._tcspc_hardware().set_SPC_param('collect_time', self.time_left)
+        # All modules continue from the same macro time, after the last
+        # photon of any module
+        if self._photon_decoders:
+            overflows = max(
+                (decoder.last_macrotime >> MT_BITS) + 1 for decoder in self._photon_decoders
+            )
+            # and after the time idle modules were advanced to
+            overflows = max(overflows, (self._photon_merger.time_reached >> MT_BITS) + 1)
+            for decoder in self._photon_decoders:
+                decoder.overflows = overflows
+            self._segment_origin = overflows << MT_BITS
+        for module_no in self._modules:
+            self._tcspc_hardware().start_measurement(module_no)
+        for module_no in self._modules:
+            self._tcspc_hardware().start_fifo_reader(module_no, self.buf_size)
         self.start_time = time.monotonic()
         self.__timer.start()
         self.continue_acquisition = True
         self.measurement_paused = False
         self.log.info('Measurement restarted')
         
+    @Slot(bool)
+    def set_photon_recording(self, enabled: bool):
+        """
+        Enables or disables the recording of the time tagged photons of the
+        next FIFO measurement.
+        """
+        self.record_photons = enabled
+        self.log.info(f'Photon stream recording {"on" if enabled else "off"}')
+
+    @Slot(bool)
+    def set_g2_enabled(self, enabled: bool):
+        """
+        Enables or disables the live g2 of the next FIFO measurement.
+        """
+        self.compute_g2 = enabled
+        self.log.info(f'Live g2 {"on" if enabled else "off"}')
+
+    @Slot(bool)
+    def set_intensity_trace_enabled(self, enabled: bool):
+        """
+        Enables or disables the intensity trace of the next FIFO
+        measurement. While it is on, the intensity tracking uses the trace
+        instead of the rate counter.
+        """
+        self.compute_intensity_trace = enabled
+        self.log.info(f'Intensity trace {"on" if enabled else "off"}')
+
+    @Slot(bool)
+    def set_kinetic_series_enabled(self, enabled: bool):
+        """
+        Enables or disables the kinetic series of the next FIFO
+        measurement, one lifetime histogram per time slice.
+        """
+        self.record_kinetic_series = enabled
+        self.log.info(f'Kinetic series {"on" if enabled else "off"}')
+
+    @Slot(float)
+    def set_kinetic_slice_width(self, slice_width: float):
+        """
+        Sets the length of the time slices of the kinetic series in s.
+        """
+        self._kinetic_slice_width = slice_width
+
+    def open_kinetic_series(self):
+        """
+        Creates the file the kinetic series of the measurement is written
+        to, if the kinetic series is enabled.
+
+        The files are saved to a `kinetic_series` folder next to the
+        histograms.
+        """
+        self.close_kinetic_series()
+        if not self.record_kinetic_series:
+            return
+        timestamp = datetime.now().strftime('%Y%m%d-%H%M-%S')
+        filepath = os.path.join(
+            self.filemanager.save_dir, 'kinetic_series',
+            f'{timestamp}_{self.filemanager.exp_str}_kinetic.h5'
+        )
+        metadata = dataclasses.asdict(self.data.parameters)
+        metadata['modules'] = list(self._modules)
+        self._kinetic_series = KineticSeriesRecorder(
+            filepath, self._kinetic_slice_width,
+            macrotime_unit=self._macrotime_unit,
+            time_bins=self.data.time_bins,
+            metadata=metadata
+        )
+        self.log.info(
+            f'Recording kinetic series with {self._kinetic_series.slice_width} s '
+            f'slices to {filepath}'
+        )
+
+    def close_kinetic_series(self):
+        """
+        Writes the last slice and closes the kinetic series file.
+        """
+        if self._kinetic_series is None:
+            return
+        with self._mutex:
+            self._kinetic_series.close()
+        filepath = self._kinetic_series.filepath
+        self.log.info(
+            f'Recorded {self._kinetic_series.slices_written} slices to {filepath}'
+        )
+        self._kinetic_series = None
+        self.kinetic_series_file_signal.emit(filepath)
+
+    def open_photon_recorder(self):
+        """
+        Creates the file the photon stream of the measurement is written
+        to, if recording is enabled.
+
+        The photon streams are saved to a `photon_streams` folder next to
+        the histograms, so they are not picked up when browsing the
+        lifetime files.
+        """
+        self.close_photon_recorder()
+        if not self.record_photons:
+            return
+        timestamp = datetime.now().strftime('%Y%m%d-%H%M-%S')
+        filepath = os.path.join(
+            self.filemanager.save_dir, 'photon_streams',
+            f'{timestamp}_{self.filemanager.exp_str}_photons.h5'
+        )
+        metadata = dataclasses.asdict(self.data.parameters)
+        metadata['macrotime_unit'] = self._macrotime_unit
+        metadata['modules'] = list(self._modules)
+        metadata['channels_per_module'] = ROUT_MASK + 1
+        self._photon_recorder = PhotonStreamRecorder(filepath, metadata)
+        self.log.info(f'Recording photon stream to {filepath}')
+
+    def close_photon_recorder(self):
+        """
+        Writes the remaining photons and closes the photon stream file.
+        """
+        if self._photon_recorder is None:
+            return
+        with self._mutex:
+            self._photon_recorder.close()
+        filepath = self._photon_recorder.filepath
+        self.log.info(
+            f'Recorded {self._photon_recorder.photons_written} photons to {filepath}'
+        )
+        self._photon_recorder = None
+        self.photon_file_signal.emit(filepath)
+
     @Slot(dict)
     def set_parameters(self, params: dict):
         """
         Set the parameters to the TCSPC module.
 
-        Iterates over the `params` dictionary and sets the
-        parameters individually to the TCSPC Hardware data
-        structure. Then, it sets all the parameters to the
-        TCSPC module. Finally, it gets the parameters 
-        actually set from the TCSPC module.
+        The parameters are changed in the parameter cache of the TCSPC
+        Hardware and written to the TCSPC module at once. Then, the
+        parameters actually set are emitted, the ones the module
+        can change are read back by the hardware module.
         
         Args:
         params: dict
             The parameters to set
         """
         self.log.info(f'Setting parameters to {params}')
-        for key, value in params.items():
-            if key != 'mode':
-                self.set_parameter(key.upper(), value)
+        self._tcspc_hardware().set_SPC_params(
+            {key.upper(): value for key, value in params.items() if key != 'mode'}
+        )
         self.get_parameters(params)
+        self.log.debug(
+            f'Parameter cache: {self._tcspc_hardware().get_param_call_stats()}'
+        )
 
     @Slot(str, int or float or str or bool)
     def set_parameter(self, param: str, value):
         self.log.info(f'Setting parameter {param} to {value}')
-        self._tcspc_hardware().set_SPC_param(param.upper(), value)
-        setted_value = self._tcspc_hardware().get_SPC_param(param.upper())
+        setted_value = self._tcspc_hardware().set_SPC_param(param.upper(), value)
         self.sig_parameter.emit(param, setted_value)
 
     @Slot(dict)
@@ -286,7 +669,7 @@ class TCSPCLogic(LogicBase):
 
     def get_all_parameters(self):
 
-        for param, val in self._tcspc_hardware().get_SPC_params_from_module(0).items():
+        for param, val in self._tcspc_hardware().get_SPC_params_from_module(self._modules[0]).items():
             self.sig_parameter.emit(param, val)
 
     @Slot()
@@ -295,54 +678,190 @@ class TCSPCLogic(LogicBase):
             #with self._mutex:
             if self.continue_acquisition:
 
-                status_code = self._tcspc_hardware().test_state(0)
+                status_codes = [
+                    self._tcspc_hardware().test_state(module_no) for module_no in self._modules
+                ]
+                status_code = status_codes[0]
                 self.status_sig.emit(status_code)
+
+                if self._memory_mode:
+                    # The modules stop after every period, so the end of the
+                    # measurement is given by the time measured
+                    self.consume_memory_pages()
+                    finished = (time.monotonic() - self.start_time + self.time_from_start
+                                >= self.data.parameters.collect_time)
+                else:
+                    # The FIFO is drained by the reader thread of the
+                    # hardware, here only the records collected since the
+                    # last tick are decoded.
+                    self.consume_fifo_records()
+                    self.check_fifo_stats()
+                    finished = all(
+                        spcm.MeasurementState.STOPPED_ON_COLLECT_TIME in state
+                        for state in status_codes
+                    )
+                self.lifetime_estimate_signal.emit(self._phasor.get_estimate())
+                if self._correlator is not None:
+                    self.g2_signal.emit(self._correlator.lags, self._correlator.g2)
+                if self._intensity_trace is not None:
+                    self.intensity_trace_signal.emit(*self._intensity_trace.get_trace())
+                    if self.track_intensity and not self.skip_next_rate:
+                        self.check_intensity(
+                            self._intensity_trace.recent_rate(self.data.parameters.display_time)
+                        )
                 
-                with self._mutex:
-                    data = self._tcspc_hardware().read_data_from_tcspc(0, self.buf_size)
-                    if len(data):
-                        self.convert_data(data)
-                
-                if spcm.MeasurementState.STOPPED_ON_COLLECT_TIME in status_code:
+                if finished:
                     self.log.info('Collection time over')
                     self.measurement_finished_signal.emit()
                     self.stop_measurement()
-                    with self._mutex:
-                        data = self._tcspc_hardware().read_data_from_tcspc(0, self.buf_size)
-                        if len(data):
-                            self.convert_data(data)
-
-                #if self.counter >= 6:
-                #    self.log.info(f'Counter equal {self.counter}')
-                #    self.stop_measurement()
-                #    with self._mutex:
-                #        data = self._tcspc_hardware().read_data_from_tcspc(0, self.buf_size)
-                #        if len(data):
-                #            self.convert_data(data)
                 
                 self.elapsed_time = time.monotonic() - self.start_time
                 self.progress = (self.elapsed_time + self.time_from_start)  / self.data.parameters.collect_time * 100
                 self.progress_signal.emit(min(self.progress, 100))
 
+    def consume_fifo_records(self, final: bool = False):
+        """
+        Decodes the records collected by the FIFO readers of all modules
+        since the last call.
 
-    def convert_data(self, data):
+        Parameters
+        ----------
+        final : bool, optional
+            Also passes on the photons held back to merge the streams of
+            the modules, once the measurement is stopped
+        """
+        with self._mutex:
+            for index, module_no in enumerate(self._modules):
+                data = self._tcspc_hardware().read_fifo_records(module_no)
+                if len(data):
+                    self.convert_data(data, index)
+                elif self._photon_merger is not None:
+                    # An idle module must not hold back the photons of
+                    # the other modules
+                    self._photon_merger.advance(index, self._idle_time_reached())
+            self.process_photons(final)
+            np.sum(self.data.channel_histograms, axis=0, out=self.data.histogram)
+            self.data_signal.emit(self.data.time_bins, copy.copy(self.data.histogram))
+
+    def consume_memory_pages(self, final: bool = False):
+        """
+        Adds the histograms of the modules whose collection period ended.
+
+        The finished memory bank of a module is read while the module
+        already measures into its other bank.
+
+        Parameters
+        ----------
+        final : bool, optional
+            Stops the modules and adds the histograms of the running
+            period
+        """
+        with self._mutex:
+            updated = False
+            for index, module_no in enumerate(self._modules):
+                if final:
+                    counts = self._tcspc_hardware().stop_memory_measurement(module_no)
+                elif self._tcspc_hardware().memory_period_finished(module_no):
+                    counts = self._tcspc_hardware().swap_memory_bank(module_no)
+                else:
+                    continue
+                # The blocks of the routing channels are added. The module
+                # stores the ADC value, which is measured from the photon to
+                # the SYNC, so the bins are reversed like in the FIFO mode.
+                period = counts.sum(axis=0, dtype=np.int64)[::-1]
+                self.data.channel_histograms[index] += period
+                self._phasor.update(period)
+                updated = True
+            if updated:
+                np.sum(self.data.channel_histograms, axis=0, out=self.data.histogram)
+                self.data_signal.emit(self.data.time_bins, copy.copy(self.data.histogram))
+
+    def check_fifo_stats(self):
+        """
+        Emits the FIFO reader counters and warns when records were lost.
+        """
+        stats = self._tcspc_hardware().get_fifo_reader_stats()
+        if not stats:
+            return
+        if stats['lost_records'] > self._lost_records:
+            self.log.warning(
+                f'{stats["lost_records"] - self._lost_records} records lost, '
+                'the ring buffer was full'
+            )
+            self._lost_records = stats['lost_records']
+        if stats['fifo_overflows'] > self._fifo_overflows:
+            self.log.warning('FIFO overflow, records lost in the module')
+            self._fifo_overflows = stats['fifo_overflows']
+        self.fifo_stats_signal.emit(stats)
+
+    def convert_data(self, data, index: int = 0):
+        """
+        Adds the photons of a FIFO buffer of one module to its histogram.
 
-        records = np.array(data).view(np.uint32)
-        photons = np.extract(np.bitwise_and(records, 0b1001 << 28) == 0, records)
-        max_12bit = (1 << 12) - 1  # 4095
-        microtimes = np.bitwise_and(np.right_shift(photons, 16), max_12bit)
-        # Reverse the microtimes by subtracting from the max value, because the raw
-        # microtime is measured from photon to SYNC, not SYNC to photon.
-        microtimes = max_12bit - microtimes
+        The records are decoded in place by the `SPCFifoDecoder` of the
+        module, which accumulates the micro times into its row of
+        `self.data.channel_histograms`. The counts of the batch are added
+        to the running phasor, which gives the live lifetime estimate.
+        When photon recording, the live g2, the intensity trace or the
+        kinetic series is on, the records are also decoded into time
+        tagged photons and passed to the `PhotonStreamMerger`, see
+        `process_photons`.
 
-        # Create the histogram
-        histogram, bin_edges = np.histogram(microtimes, bins=self.time_bins)
-        bin_edges = bin_edges[:-1]
-        self.data.histogram = self.data.histogram + histogram
+        Parameters
+        ----------
+        data : np.ndarray
+            Buffer as returned by `read_data_from_tcspc`
+        index : int, optional
+            Index of the module in the list of modules
+        """
+        decoder = self._fifo_decoders[index]
+        decoder.accumulate(data)
+        self._phasor.update(decoder.last_counts)
+        if self._photons_needed():
+            photon_decoder = self._photon_decoders[index]
+            photons = photon_decoder.decode(data)
+            self._photon_merger.push(index, photons, photon_decoder.time_reached)
+
+    def _idle_time_reached(self) -> int:
+        """
+        Macro time up to which a module with an empty FIFO is complete.
 
-        time_bins = self.time_bins * self.time_conversion
-        self.data.time_bins = time_bins[:-1]
-        self.data_signal.emit(time_bins[:-1], copy.copy(self.data.histogram))
+        The macro time counter starts with the measurement of the segment,
+        before `start_time` is taken, so the module has measured at least
+        the time since then. The margin covers the records the reader
+        thread has not passed on yet.
+        """
+        measured = time.monotonic() - self.start_time - self._fifo_idle_margin
+        return self._segment_origin + int(max(0.0, measured) / self._macrotime_unit)
+
+    def _photons_needed(self):
+
+        return any(
+            consumer is not None
+            for consumer in (self._photon_recorder, self._correlator,
+                             self._intensity_trace, self._kinetic_series)
+        )
+
+    def process_photons(self, final: bool = False):
+        """
+        Passes the merged photons of all modules to the photon consumers.
+
+        The photons are appended to the photon stream file and added to
+        the correlator, the intensity trace and the kinetic series.
+
+        Parameters
+        ----------
+        final : bool, optional
+            Also passes on the photons held back by the merger
+        """
+        if self._photon_merger is None or not self._photons_needed():
+            return
+        photons = self._photon_merger.pop(final)
+        if self._photon_recorder is not None:
+            self._photon_recorder.append(photons)
+        for consumer in (self._correlator, self._intensity_trace, self._kinetic_series):
+            if consumer is not None:
+                consumer.update(photons)
 
     def save_data(self, filepath: str = '') -> None:
         """
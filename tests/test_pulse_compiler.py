@@ -0,0 +1,475 @@
+"""
+Tests of `qudi.logic.pulse_compiler`.
+
+The vectorized merging, sweeping and flattening of the pulses are compared
+with the implementations they replaced on random pulses, and the programs
+of `ProgramCompiler` are checked by executing them with `run_program`.
+The previous implementations are kept in here as the references.
+"""
+import bisect
+import random
+
+import numpy as np
+import pytest
+
+from qudi.logic.pulse_compiler import (
+    END_LOOP, INSTRUCTION_DTYPE, LOOP, STATE_DTYPE, STOP, ProgramCompiler, PulseProgramCache,
+    PulseTable, RepeatBlock, SequenceBlock, StateBlock, _normalize_block, block_duration,
+    expand_block, flatten_pulses, run_program, sweep_pulse
+)
+
+
+class PulseIntervalSet:
+    """
+    Disjoint pulses of one channel, sorted by their start and merged on
+    insertion. Replaced by `merge_pulses`, kept as the reference of the
+    merging.
+
+    Every pulse has the interval sent to the PulseBlaster, shifted by the
+    delays of the channel, and the interval that is displayed. Whether two
+    pulses overlap is decided with the PulseBlaster intervals, both
+    intervals of the merged pulse span the merged pulses.
+
+    The stored pulses never overlap, so their ends are sorted like their
+    starts, and the pulses overlapping [start, end] are the ones between
+    the first pulse ending at or after `start` and the last pulse starting
+    at or before `end`. Both are found with `bisect`.
+
+    Attributes
+    ----------
+    merges : int
+        Number of added pulses that were merged with stored pulses
+    """
+
+    def __init__(self) -> None:
+
+        self._starts = []
+        self._ends = []
+        self._display_starts = []
+        self._display_ends = []
+        self.merges = 0
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __iter__(self):
+        return zip(self._starts, self._ends, self._display_starts, self._display_ends)
+
+    def add(self, start: float, end: float, display_start: float = None,
+            display_end: float = None) -> bool:
+        """
+        Adds a pulse and merges it with the pulses it overlaps or touches.
+
+        Parameters
+        ----------
+        start, end : float
+            Interval of the pulse sent to the PulseBlaster, start <= end
+        display_start, display_end : float, optional
+            Displayed interval of the pulse. Default is the PulseBlaster
+            interval.
+
+        Returns
+        -------
+        bool
+            True if the pulse was merged with stored pulses
+        """
+        display_start = start if display_start is None else display_start
+        display_end = end if display_end is None else display_end
+
+        first = bisect.bisect_left(self._ends, start)
+        last = bisect.bisect_right(self._starts, end, first)
+        merged = last > first
+        if merged:
+            start = min(start, self._starts[first])
+            end = max(end, self._ends[last - 1])
+            display_start = min(display_start, *self._display_starts[first:last])
+            display_end = max(display_end, *self._display_ends[first:last])
+            self.merges += 1
+        self._starts[first:last] = [start]
+        self._ends[first:last] = [end]
+        self._display_starts[first:last] = [display_start]
+        self._display_ends[first:last] = [display_end]
+        return merged
+
+    def clear(self) -> None:
+
+        self._starts.clear()
+        self._ends.clear()
+        self._display_starts.clear()
+        self._display_ends.clear()
+        self.merges = 0
+
+    def get_intervals(self) -> tuple:
+        """
+        Returns the pulses in start order.
+
+        Returns
+        -------
+        tuple
+            (pb_intervals, display_intervals), lists of (start, end)
+        """
+        return (
+            list(zip(self._starts, self._ends)),
+            list(zip(self._display_starts, self._display_ends)),
+        )
+
+
+def compile_loop_program(states: np.ndarray, loops: int, time_unit: float = 1000.0,
+                          stop_length: float = 1000.0) -> np.ndarray:
+    """
+    Compiles states into a program that repeats them `loops` times and
+    stops. Replaced by `ProgramCompiler`, kept as the reference of the
+    uploads of one program per variation.
+
+    The first state is the LOOP instruction and the last state the
+    END_LOOP instruction, both with their duration, followed by a STOP.
+    A single state is split into two halves, since a loop needs two
+    instructions.
+
+    Parameters
+    ----------
+    states : np.ndarray
+        States with `STATE_DTYPE`
+    loops : int
+        Number of repetitions
+    time_unit : float, optional
+        Length of one time unit of the states in ns, default µs
+    stop_length : float, optional
+        Length of the STOP instruction in ns
+
+    Returns
+    -------
+    np.ndarray
+        Instructions with `INSTRUCTION_DTYPE`, starting at address 0
+    """
+    if states.size == 0:
+        raise ValueError('A program needs at least one state')
+    flags = states['channels'].astype(np.int32)
+    lengths = states['duration'] * time_unit
+    if states.size == 1:
+        flags = np.repeat(flags, 2)
+        lengths = np.repeat(lengths / 2, 2)
+    n = flags.size
+    program = np.zeros(n + 1, dtype=INSTRUCTION_DTYPE)
+    program['flags'][:n] = flags
+    program['length'][:n] = lengths
+    program['inst'][0] = LOOP
+    program['inst_data'][0] = loops
+    program['inst'][n - 1] = END_LOOP
+    program['inst_data'][n - 1] = 0
+    program['inst'][n] = STOP
+    program['length'][n] = stop_length
+    return program
+
+
+def legacy_add_pulse(pb_pulses, pulses, pulse_pb, pulse):
+    """
+    Previous `Sequence.add_pulse` and `check_pulse_fusion` on lists of
+    [start, end], kept as the reference.
+    """
+    start_tail_pb, end_tail_pb = pulse_pb
+    start_tail, end_tail = pulse
+    global_fusion_pb = []
+    global_fusion = []
+    indexes_delete = []
+    for j in range(len(pb_pulses)):
+        partially_left = (
+            pb_pulses[j][0] <= end_tail_pb
+            and pb_pulses[j][0] > start_tail_pb
+            and pb_pulses[j][1] >= end_tail_pb
+        )
+        partially_right = (
+            pb_pulses[j][1] >= start_tail_pb
+            and pb_pulses[j][0] < start_tail_pb
+            and pb_pulses[j][1] <= end_tail_pb
+        )
+        completely_inside = (
+            pb_pulses[j][0] <= start_tail_pb and pb_pulses[j][1] >= end_tail_pb
+        )
+        completely_ontop = (
+            pb_pulses[j][0] >= start_tail_pb and pb_pulses[j][1] <= end_tail_pb
+        )
+        if partially_left:
+            global_fusion_pb.append([start_tail_pb, pb_pulses[j][1]])
+            global_fusion.append([start_tail, pulses[j][1]])
+        elif partially_right:
+            global_fusion_pb.append([pb_pulses[j][0], end_tail_pb])
+            global_fusion.append([pulses[j][0], end_tail])
+        elif completely_inside:
+            global_fusion_pb.append(list(pb_pulses[j]))
+            global_fusion.append(list(pulses[j]))
+        elif completely_ontop:
+            global_fusion_pb.append([start_tail_pb, end_tail_pb])
+            global_fusion.append([start_tail, end_tail])
+        if partially_left or partially_right or completely_inside or completely_ontop:
+            indexes_delete.append(j)
+    if global_fusion_pb:
+        pulse_pb = [min(p[0] for p in global_fusion_pb), max(p[1] for p in global_fusion_pb)]
+        pulse = [min(p[0] for p in global_fusion), max(p[1] for p in global_fusion)]
+        for index in sorted(indexes_delete, reverse=True):
+            del pb_pulses[index]
+            del pulses[index]
+    pb_pulses.append(list(pulse_pb))
+    pulses.append(list(pulse))
+    pb_pulses.sort(key=lambda p: p[0])
+    pulses.sort(key=lambda p: p[0])
+
+
+def legacy_sweep(sequences, start_time, width, function_width, function_start,
+                  iteration_range, delay_on=0, delay_off=0):
+    """
+    Previous loop of `Channel.a_sequence`, with `eval` and a linear search
+    for the sequence of every iteration, kept as the reference.
+    """
+    for k in range(iteration_range[0], iteration_range[1] + 1):
+        index = next(
+            (j for j, sequence in enumerate(sequences) if sequence[0] == k), None
+        )
+        new_width = width
+        new_start_time = start_time
+        if function_width != '':
+            W = width
+            i = k - iteration_range[0] + 1
+            new_width = eval(function_width)
+        if function_start != '':
+            S = start_time
+            i = k - iteration_range[0] + 1
+            new_start_time = eval(function_start)
+        pulse_pb = (new_start_time - delay_on, new_start_time + new_width - delay_off)
+        pulse = (new_start_time, new_start_time + new_width)
+        if index is None:
+            sequence = (k, [], [])
+            legacy_add_pulse(sequence[1], sequence[2], pulse_pb, pulse)
+            sequences.append(sequence)
+        else:
+            legacy_add_pulse(sequences[index][1], sequences[index][2], pulse_pb, pulse)
+    sequences.sort(key=lambda sequence: sequence[0])
+
+
+def legacy_flatten(starts, ends, channels):
+    """
+    Previous sweep line of `Experiment.Order_Exp_i_pb`, kept as the
+    reference. Returns (start, end, channels) of every state.
+    """
+    events = []
+    for start_tail, end_tail, ch in zip(starts, ends, channels):
+        events.append((start_tail, 0, ch))
+        events.append((end_tail, 1, ch))
+    events.sort()
+    pb_sequence = []
+    active_channels = set()
+    last_time = 0
+    for time, event_type, channel in events:
+        sorted_channels = sorted(active_channels.copy())
+        if last_time < time:
+            if active_channels:
+                pb_sequence.append((last_time, time, sorted_channels))
+            else:
+                pb_sequence.append((last_time, time, [0]))
+        if event_type == 0:
+            active_channels.add(channel)
+        else:
+            active_channels.discard(channel)
+        last_time = time
+    return pb_sequence
+
+
+def random_pulses(rng, n, resolution, max_width=None):
+    # Times on a coarse grid, so that touching and identical pulses occur
+    delay_on, delay_off = rng.randint(0, 3), rng.randint(0, 2)
+    max_width = resolution // 4 if max_width is None else max_width
+    for _ in range(n):
+        start = rng.randint(delay_on, resolution)
+        width = rng.randint(delay_off + 1, max(delay_off + 1, max_width))
+        yield (start - delay_on, start + width - delay_off), (start, start + width)
+
+
+def random_states(rng, n):
+    states = np.zeros(n, dtype=STATE_DTYPE)
+    states['duration'] = rng.integers(1, 20, n) / 4
+    states['start'] = np.cumsum(states['duration']) - states['duration']
+    states['channels'] = rng.integers(0, 16, n)
+    return states
+
+
+def random_block(rng, depth=0):
+    kind = rng.integers(0, 3) if depth < 4 else 0
+    if kind == 0:
+        return StateBlock(random_states(rng, int(rng.integers(1, 10))))
+    if kind == 1:
+        return RepeatBlock(random_block(rng, depth + 1), int(rng.integers(0, 4)))
+    return SequenceBlock([random_block(rng, depth + 1) for _ in range(rng.integers(0, 4))])
+
+
+def output_edges(states):
+    # Output changes of states played one after the other, and the STOP
+    times = np.append(np.cumsum(states['duration']) - states['duration'],
+                      states['duration'].sum())
+    flags = np.append(states['channels'], 0).astype(np.int32)
+    change = np.ones(flags.size, dtype=bool)
+    change[1:] = flags[1:] != flags[:-1]
+    return times[change] * 1000.0, flags[change]
+
+
+def test_interval_set_matches_legacy_fusion():
+    rng = random.Random(0)
+    for _ in range(5000):
+        pulses = list(random_pulses(rng, rng.randint(1, 30), rng.choice((10, 50, 500))))
+        interval_set = PulseIntervalSet()
+        legacy_pb, legacy_display = [], []
+        for pulse_pb, pulse in pulses:
+            interval_set.add(*pulse_pb, *pulse)
+            legacy_add_pulse(legacy_pb, legacy_display, pulse_pb, pulse)
+        pb_intervals, display_intervals = interval_set.get_intervals()
+        assert [list(p) for p in pb_intervals] == legacy_pb
+        assert [list(p) for p in display_intervals] == legacy_display
+
+
+def test_merge_pulses_matches_interval_set():
+    rng = random.Random(1)
+    for _ in range(500):
+        table = PulseTable()
+        interval_sets = {}
+        for _ in range(rng.randint(1, 10)):
+            iteration, channel = rng.randint(1, 5), 1 << rng.randint(0, 3)
+            pulses = list(random_pulses(rng, rng.randint(1, 30), rng.choice((10, 50, 500))))
+            (starts, ends), (display_starts, display_ends) = (
+                np.array([pulse[j] for pulse in pulses]).T for j in (0, 1)
+            )
+            table.add(np.full(len(pulses), iteration), channel, starts, ends,
+                      display_starts, display_ends)
+            interval_set = interval_sets.setdefault((iteration, channel), PulseIntervalSet())
+            for pulse_pb, pulse in pulses:
+                interval_set.add(*pulse_pb, *pulse)
+        reference = [
+            (iteration, channel) + pulse
+            for (iteration, channel), interval_set in sorted(interval_sets.items())
+            for pulse in interval_set
+        ]
+        assert table.pulses.tolist() == reference
+
+
+def test_sweep_pulse_matches_legacy_sweep():
+    pulses = [
+        (0.0, 2.0, '', ''),
+        (5.0, 1.0, 'W + 0.01 * i', ''),
+        (10.0, 1.0, '', 'S + np.sqrt(i) / 10'),
+    ]
+    iteration_range = (1, 300)
+    table = PulseTable()
+    legacy_sequences = []
+    for start_time, width, function_width, function_start in pulses:
+        iterations, start_times, widths = sweep_pulse(
+            start_time, width, function_width, function_start, iteration_range
+        )
+        table.add(iterations, 1, start_times - 1, start_times + widths,
+                  start_times, start_times + widths)
+        legacy_sweep(legacy_sequences, start_time, width, function_width,
+                     function_start, iteration_range, delay_on=1)
+    for k, pb_pulses, display_pulses in legacy_sequences:
+        assert table.get_iteration(k)[['start', 'end']].tolist() == [tuple(p) for p in pb_pulses]
+        assert table.get_iteration(k)[['display_start', 'display_end']].tolist() \
+            == [tuple(p) for p in display_pulses]
+
+
+@pytest.mark.parametrize('n_edges', [200, 2000])
+def test_flatten_pulses_matches_legacy_flatten(n_edges):
+    table = PulseTable()
+    times_rng = np.random.default_rng(n_edges)
+    for bit in range(16):
+        n = n_edges // 32
+        starts = np.sort(times_rng.choice(100 * n_edges, n, replace=False)).astype(float)
+        widths = times_rng.integers(1, 50, n)
+        table.add(np.ones(n, dtype=int), 1 << bit, starts, starts + widths)
+    pulses = table.get_iteration(1)
+    args = pulses['start'], pulses['end'], pulses['channel']
+    legacy_states = legacy_flatten(*(arg.tolist() for arg in args))
+    # The previous sweep line did not merge adjacent states with the same channels
+    legacy_table = flatten_pulses(
+        [state[0] for state in legacy_states], [state[1] for state in legacy_states],
+        [sum(state[2]) for state in legacy_states]
+    )
+    assert np.array_equal(flatten_pulses(*args), legacy_table)
+
+
+def test_program_cache_uploads_each_variation_once():
+    class CountingApi:
+        PULSE_PROGRAM = 0
+
+        def __init__(self):
+            self.instructions = 0
+
+        def pb_start_programming(self, target):
+            return 0
+
+        def pb_inst_pbonly(self, flags, inst, inst_data, length):
+            self.instructions += 1
+            return self.instructions - 1
+
+        def pb_stop_programming(self):
+            return 0
+
+    rng = np.random.default_rng(2)
+    variation_states = [random_states(rng, 20) for _ in range(5)]
+    api = CountingApi()
+    cache = PulseProgramCache(api)
+    for _ in range(3):
+        for states in variation_states:
+            cache.load(compile_loop_program(states, 10000))
+    stats = cache.get_stats()
+    assert stats['uploads'] == 5 * 3  # a different program is on the board every time
+    assert api.instructions == 3 * sum(states.size + 1 for states in variation_states)
+    for states in variation_states[-1:] * 3:
+        cache.load(compile_loop_program(states, 10000))
+    assert cache.get_stats()['uploads'] == 5 * 3
+
+
+def test_compiled_loop_program_plays_the_states():
+    rng = np.random.default_rng(3)
+    for n in (1, 2, 7):
+        states = random_states(rng, n)
+        program = compile_loop_program(states, 3)
+        expected = run_program(ProgramCompiler().compile(RepeatBlock(StateBlock(states), 3)),
+                               expand_loops=True)
+        result = run_program(program, expand_loops=True)
+        assert np.isclose(result['duration'], expected['duration'])
+        assert np.array_equal(result['edges']['flags'], expected['edges']['flags'])
+
+
+def test_program_compiler_matches_expanded_blocks():
+    compiler = ProgramCompiler(subroutine_states=4)
+    block_rng = np.random.default_rng(0)
+    programs = 0
+    for _ in range(2000):
+        block = random_block(block_rng)
+        if _normalize_block(block) is None:
+            continue
+        program = compiler.compile(block)
+        expanded = run_program(program, expand_loops=True)
+        fast = run_program(program)
+        times, flags = output_edges(expand_block(block))
+        duration = 1000.0 * block_duration(block)
+        programs += 1
+        assert expanded['complete']
+        assert expanded['edges'].size == times.size
+        assert np.allclose(expanded['edges']['time'], times)
+        assert np.array_equal(expanded['edges']['flags'], flags)
+        assert np.isclose(expanded['duration'], duration)
+        assert np.isclose(fast['duration'], duration)
+    assert programs > 0
+
+
+def test_program_compiler_splits_repeats_larger_than_the_loop_counter():
+    # A counter of 3 bits, so the programs are small enough to be played
+    # repetition by repetition
+    compiler = ProgramCompiler(max_loop_count=7, subroutine_states=4)
+    block_rng = np.random.default_rng(1)
+    for count in range(1, 400):
+        block = RepeatBlock(StateBlock(random_states(block_rng, int(block_rng.integers(1, 6)))), count)
+        program = compiler.compile(block)
+        expanded = run_program(program, expand_loops=True)
+        times, flags = output_edges(expand_block(block))
+        assert program['inst_data'][program['inst'] == LOOP].max(initial=0) <= 7
+        assert expanded['edges'].size == times.size
+        assert np.allclose(expanded['edges']['time'], times)
+        assert np.array_equal(expanded['edges']['flags'], flags)